@@ -2,15 +2,18 @@
 Database models for AI roof calculator using PostgreSQL
 """
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import json
+import threading
 from datetime import datetime
 from typing import Dict, List, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+def _dict_cursor():
+    from psycopg2.extras import RealDictCursor
+    return RealDictCursor
+
 class AIRoofDatabase:
     """Database handler for AI roof calculator data"""
     
@@ -20,6 +23,7 @@ class AIRoofDatabase:
     
     def get_connection(self):
         """Get database connection"""
+        import psycopg2  # deferred so importing this module stays cheap
         return psycopg2.connect(self.connection_string)
     
     def init_tables(self):
@@ -136,11 +140,51 @@ class AIRoofDatabase:
             logger.error(f"Failed to save calculation: {e}")
             return None
     
+    def save_calculations(self, calculations: List[Dict]) -> List[Optional[int]]:
+        """Save many roof calculations with one multi-row INSERT; returns
+        their ids in order (all None if the insert failed)"""
+        if not calculations:
+            return []
+        try:
+            from psycopg2.extras import execute_values
+            rows = [(
+                calculation_data.get('user_id'),
+                calculation_data['length'],
+                calculation_data['width'],
+                calculation_data['roof_type'],
+                calculation_data['material_type'],
+                calculation_data.get('location', ''),
+                calculation_data.get('slope', 0.0),
+                calculation_data.get('complexity', 'simple'),
+                json.dumps(calculation_data['materials_needed']),
+                json.dumps(calculation_data['cost_estimate']),
+                json.dumps(calculation_data['recommendations']),
+                calculation_data.get('confidence_score', 0.0),
+                calculation_data.get('calculation_source', 'unknown')
+            ) for calculation_data in calculations]
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    # page_size covers every row, so this is a single statement
+                    ids = execute_values(cursor, """
+                        INSERT INTO roof_calculations 
+                        (user_id, length, width, roof_type, material_type, location, 
+                         slope, complexity, materials_needed, cost_estimate, 
+                         recommendations, confidence_score, calculation_source)
+                        VALUES %s
+                        RETURNING id
+                    """, rows, page_size=len(rows), fetch=True)
+                    conn.commit()
+                    return [row[0] for row in ids]
+                    
+        except Exception as e:
+            logger.error(f"Failed to save calculations: {e}")
+            return [None] * len(calculations)
+    
     def get_user_calculations(self, user_id: int, limit: int = 10) -> List[Dict]:
         """Get user's calculation history"""
         try:
             with self.get_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                with conn.cursor(cursor_factory=_dict_cursor()) as cursor:
                     cursor.execute("""
                         SELECT * FROM roof_calculations 
                         WHERE user_id = %s 
@@ -199,7 +243,7 @@ class AIRoofDatabase:
         """Get knowledge items by category and material"""
         try:
             with self.get_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                with conn.cursor(cursor_factory=_dict_cursor()) as cursor:
                     if material:
                         cursor.execute("""
                             SELECT * FROM roof_knowledge 
@@ -264,7 +308,7 @@ class AIRoofDatabase:
         """Get training data for ML model improvement"""
         try:
             with self.get_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                with conn.cursor(cursor_factory=_dict_cursor()) as cursor:
                     cursor.execute("""
                         SELECT rc.*, ch.user_feedback, ch.actual_cost
                         FROM roof_calculations rc
@@ -295,7 +339,7 @@ class AIRoofDatabase:
         """Get statistics about calculations for monitoring"""
         try:
             with self.get_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                with conn.cursor(cursor_factory=_dict_cursor()) as cursor:
                     # Get basic stats
                     cursor.execute("""
                         SELECT 
@@ -331,12 +375,15 @@ class AIRoofDatabase:
             logger.error(f"Failed to get calculation stats: {e}")
             return {}
 
-# Initialize global database instance
+# Global database instance, created on first use
 ai_db = None
+_ai_db_lock = threading.Lock()
 
 def get_ai_database():
     """Get or create AI database instance"""
     global ai_db
     if ai_db is None:
-        ai_db = AIRoofDatabase()
+        with _ai_db_lock:
+            if ai_db is None:
+                ai_db = AIRoofDatabase()
     return ai_db
\ No newline at end of file
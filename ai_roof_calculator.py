@@ -1,24 +1,41 @@
 """
 AI-Powered Roof Calculator with Knowledge Base and Vector Database
 Combines OpenAI API, vector database, and machine learning for intelligent roof calculations
+
+    python ai_roof_calculator.py check  -- offline calculate_stream self-check
 """
 import os
+import sys
 import json
-import numpy as np
-import chromadb
-from chromadb.config import Settings
-from openai import OpenAI
+import time
+import hashlib
 import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass
+from dataclasses import dataclass, field, asdict
 from datetime import datetime
 import sqlite3
 import pickle
+from llm_gateway import get_llm_gateway
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Seconds calculate_hybrid waits for the AI path before answering with ML alone
+HYBRID_LATENCY_BUDGET = float(os.environ.get('SMARTROOF_HYBRID_BUDGET', 8.0))
+HYBRID_WORKERS = int(os.environ.get('SMARTROOF_HYBRID_WORKERS', 8))
+
+# Calculation cache (see CalculationCache); a bucket of 0 keeps exact dimensions
+CALC_CACHE_SIZE = int(os.environ.get('SMARTROOF_CALC_CACHE_SIZE', 512))
+CALC_CACHE_TTL = float(os.environ.get('SMARTROOF_CALC_CACHE_TTL', 24 * 3600))
+CALC_CACHE_BUCKET = float(os.environ.get('SMARTROOF_CALC_CACHE_BUCKET', 0))
+# Shared-tier lookup; checked by migrations.hot_queries()
+CACHE_LOOKUP_SQL = 'SELECT result FROM ai_calculation_cache WHERE cache_key = ? AND expires_at > ?'
+
 @dataclass
 class RoofCalculationRequest:
     """Data structure for roof calculation requests"""
@@ -38,26 +55,197 @@ class RoofCalculationResult:
     recommendations: List[str]
     confidence_score: float
     source: str  # 'ai', 'ml', or 'hybrid'
+    # Per component (retrieval, llm, ml): status and seconds, set by calculate_hybrid
+    components: Dict = field(default_factory=dict)
+
+class CalculationCache:
+    """Results of AI and hybrid calculations keyed by the canonical request.
+
+    Two tiers: a per-process LRU with TTL, and the ai_calculation_cache
+    table in the shared SQLite database so every gunicorn worker reuses a
+    result computed by any other. Only results that actually came from the
+    AI path are stored, so an outage never pins the ML fallback.
+    """
+    
+    def __init__(self, max_size: int = CALC_CACHE_SIZE, ttl: float = CALC_CACHE_TTL,
+                 bucket: float = CALC_CACHE_BUCKET, shared: bool = True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bucket = bucket
+        self.shared = shared
+        self._entries: 'OrderedDict[str, Tuple[float, Dict]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'stores': 0, 'bypassed': 0}
+    
+    def canonical_request(self, request: RoofCalculationRequest) -> RoofCalculationRequest:
+        """Normalized copy of request; with bucket > 0 the dimensions are
+        rounded to the nearest multiple of bucket"""
+        def dimension(value):
+            if self.bucket > 0:
+                value = max(self.bucket, round(value / self.bucket) * self.bucket)
+            return round(float(value), 2)
+        return RoofCalculationRequest(
+            length=dimension(request.length),
+            width=dimension(request.width),
+            roof_type=request.roof_type.strip().lower(),
+            material_type=request.material_type.strip().lower(),
+            location=' '.join(request.location.lower().split()),
+            slope=round(float(request.slope), 1),
+            complexity=request.complexity.strip().lower()
+        )
+    
+    def key(self, request: RoofCalculationRequest, method: str) -> str:
+        payload = json.dumps([method, asdict(self.canonical_request(request))], sort_keys=True)
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+    
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+    
+    def get(self, key: str) -> Optional[RoofCalculationResult]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return RoofCalculationResult(**entry[1])
+                del self._entries[key]
+        
+        if self.shared:
+            try:
+                from database import get_db_connection
+                conn = get_db_connection()
+                try:
+                    row = conn.execute(CACHE_LOOKUP_SQL, (key, now)).fetchone()
+                finally:
+                    conn.close()
+                if row:
+                    data = json.loads(row[0])
+                    self._remember(key, data, now + self.ttl)
+                    self._count('shared_hits')
+                    return RoofCalculationResult(**data)
+            except Exception as e:
+                logger.error(f"Calculation cache read failed: {e}")
+        
+        self._count('misses')
+        return None
+    
+    def _remember(self, key: str, data: Dict, expires_at: float):
+        with self._lock:
+            self._entries[key] = (expires_at, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def put(self, key: str, result: RoofCalculationResult):
+        if result.source not in ('ai', 'hybrid'):
+            return
+        data = asdict(result)
+        data['components'] = {}
+        expires_at = time.time() + self.ttl
+        self._remember(key, data, expires_at)
+        self._count('stores')
+        if not self.shared:
+            return
+        try:
+            from database import get_db_connection
+            conn = get_db_connection()
+            try:
+                conn.execute('''
+                    INSERT OR REPLACE INTO ai_calculation_cache (cache_key, result, expires_at)
+                    VALUES (?, ?, ?)
+                ''', (key, json.dumps(data), expires_at))
+                # Expired rows are pruned by the writers, a few at a time
+                conn.execute('''
+                    DELETE FROM ai_calculation_cache WHERE cache_key IN (
+                        SELECT cache_key FROM ai_calculation_cache WHERE expires_at <= ? LIMIT 16
+                    )
+                ''', (time.time(),))
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Calculation cache write failed: {e}")
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.shared:
+            from database import get_db_connection
+            conn = get_db_connection()
+            conn.execute('DELETE FROM ai_calculation_cache')
+            conn.commit()
+            conn.close()
+    
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._entries))
+        lookups = stats['memory_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['shared_hits']) / lookups, 3) if lookups else 0.0
+        return stats
 
 class AIRoofCalculator:
     """AI-powered roof calculator with knowledge base and ML predictions"""
     
     def __init__(self):
-        self.openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        self.chroma_client = None
-        self.collection = None
         self.ml_model = None
         self.knowledge_base = []
         self.offline_predictions = {}
         
-        # Initialize components
-        self._initialize_vector_db()
+        # Read-only state, safe to build before fork and share copy-on-write
         self._build_knowledge_base()
         self._train_ml_model()
         
+        # Network and file handles (ChromaDB, thread pool) must not cross
+        # fork(), so they are opened lazily in each process; the OpenAI
+        # client lives in llm_gateway
+        self._pid = os.getpid()
+        self._clients_lock = threading.Lock()
+        self._vector_db_loaded = False
+        self.chroma_client = None
+        self._collection = None
+        self._executor = None
+        self.cache = CalculationCache()
+    
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._clients_lock = threading.Lock()
+            self._vector_db_loaded = False
+            self.chroma_client = None
+            self._collection = None
+            self._executor = None
+    
+    @property
+    def executor(self):
+        """Thread pool running the AI path of calculate_hybrid"""
+        self._check_pid()
+        if self._executor is None:
+            with self._clients_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=HYBRID_WORKERS, thread_name_prefix='hybrid'
+                    )
+        return self._executor
+    
+    @property
+    def collection(self):
+        """ChromaDB knowledge collection for this process, or None if unavailable"""
+        self._check_pid()
+        if not self._vector_db_loaded:
+            with self._clients_lock:
+                if not self._vector_db_loaded:
+                    self._initialize_vector_db()
+                    self._vector_db_loaded = True
+        return self._collection
+        
     def _initialize_vector_db(self):
         """Initialize ChromaDB for vector storage"""
         try:
+            import chromadb
+            from chromadb.config import Settings
             # Use persistent storage for vector database
             self.chroma_client = chromadb.PersistentClient(
                 path="./chroma_db",
@@ -68,7 +256,7 @@ class AIRoofCalculator:
             )
             
             # Get or create collection for roof knowledge
-            self.collection = self.chroma_client.get_or_create_collection(
+            self._collection = self.chroma_client.get_or_create_collection(
                 name="roof_knowledge",
                 metadata={"description": "Roof calculation knowledge base"}
             )
@@ -76,6 +264,9 @@ class AIRoofCalculator:
             logger.info("Vector database initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize vector database: {e}")
+            return
+        
+        self._add_knowledge_to_vector_db()
             
     def _build_knowledge_base(self):
         """Build comprehensive knowledge base for roof calculations"""
@@ -143,14 +334,16 @@ class AIRoofCalculator:
         ]
         
         self.knowledge_base = roof_knowledge
-        
-        # Add knowledge to vector database
-        if self.collection and len(roof_knowledge) > 0:
+    
+    def _add_knowledge_to_vector_db(self):
+        """Seed the vector collection with the knowledge base if it is empty"""
+        roof_knowledge = self.knowledge_base
+        if self._collection and len(roof_knowledge) > 0:
             try:
                 # Check if knowledge already exists
-                existing_docs = self.collection.get()
+                existing_docs = self._collection.get()
                 if len(existing_docs['ids']) == 0:
-                    self.collection.add(
+                    self._collection.add(
                         documents=[item['content'] for item in roof_knowledge],
                         metadatas=[{
                             'category': item['category'],
@@ -338,132 +531,371 @@ class AIRoofCalculator:
             # Fallback to basic calculation
             return self._basic_fallback_calculation(request)
     
+    def predict_offline_batch(self, requests: List[RoofCalculationRequest]) -> List[RoofCalculationResult]:
+        """predict_offline for many requests in one vectorized NumPy pass.
+        
+        Gives the same figures as calling predict_offline on each request;
+        requests with no positive area get the basic fallback, as there.
+        """
+        import numpy as np
+        if not requests:
+            return []
+        
+        model = self.ml_model
+        default_info = model['material_factors']['shingles']
+        materials = [request.material_type.lower().replace(' ', '_') for request in requests]
+        infos = [model['material_factors'].get(material, default_info) for material in materials]
+        
+        area = np.array([request.length * request.width for request in requests], dtype=np.float64)
+        complexity_factor = np.array([model['complexity_factors'].get(request.complexity, 1.15)
+                                      for request in requests])
+        slope_multiplier = np.array([
+            model['slope_multipliers'].get(f"{int(request.slope)}/12" if request.slope > 0 else "4/12", 1.05)
+            for request in requests
+        ])
+        waste = np.array([info['waste_factor'] for info in infos])
+        cost_per_sqft = np.array([info['cost_per_sqft'] for info in infos])
+        
+        # Same operation order as predict_offline, so results match exactly
+        adjusted_area = area * slope_multiplier * complexity_factor
+        waste_factor = 1 + waste
+        is_shingles = np.array([material == 'shingles' for material in materials])
+        is_metal = np.array([material == 'metal_sheets' for material in materials])
+        quantity = np.where(is_shingles, adjusted_area / 33.3 * waste_factor,
+                            np.where(is_metal, adjusted_area / 110 * waste_factor,
+                                     adjusted_area / 90 * 100 * waste_factor))
+        quantity = np.maximum(1, np.trunc(quantity)).astype(np.int64)
+        
+        material_cost = adjusted_area * cost_per_sqft
+        labor_cost = material_cost * 0.75
+        total_cost = material_cost + labor_cost
+        valid = area > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            per_sqft = total_cost / area
+        
+        # Back to Python scalars once, rather than per element
+        columns = zip(requests, infos, valid.tolist(), is_shingles.tolist(), is_metal.tolist(),
+                      quantity.tolist(), area.tolist(), adjusted_area.tolist(), material_cost.tolist(),
+                      labor_cost.tolist(), total_cost.tolist(), per_sqft.tolist())
+        results = []
+        for (request, info, ok, shingles, metal, needed, item_area, item_adjusted,
+             item_material, item_labor, item_total, item_per_sqft) in columns:
+            if not ok:
+                results.append(self._basic_fallback_calculation(request))
+                continue
+            unit = 'bundles' if shingles else 'sheets' if metal else 'tiles'
+            results.append(RoofCalculationResult(
+                materials_needed={unit: needed, 'area_covered': item_adjusted},
+                cost_estimate={
+                    'material_cost': item_material,
+                    'labor_cost': item_labor,
+                    'total_cost': item_total,
+                    'cost_per_sqft': item_per_sqft
+                },
+                recommendations=[
+                    f"Based on {item_area:.0f} sq ft roof area",
+                    f"Adjusted for {request.complexity} roof complexity",
+                    f"Material waste factor: {info['waste_factor']*100:.0f}%"
+                ],
+                confidence_score=0.85,
+                source='ml'
+            ))
+        return results
+    
+    def _knowledge_query(self, request: RoofCalculationRequest) -> str:
+        return f"{request.material_type} roof {request.roof_type} {request.length}x{request.width}"
+    
+    def _ai_messages(self, request: RoofCalculationRequest, relevant_knowledge: List[Dict]) -> List[Dict]:
+        """Chat messages asking for a JSON calculation with the given knowledge as context"""
+        # Build context for AI
+        context = "Roof calculation knowledge base:\n"
+        for knowledge in relevant_knowledge:
+            context += f"- {knowledge['content']}\n"
+        
+        # Create AI prompt
+        prompt = f"""
+        You are an expert roof calculator. Use the provided knowledge base to calculate materials and costs.
+        
+        {context}
+        
+        Calculate for this roof:
+        - Dimensions: {request.length}ft × {request.width}ft ({request.length * request.width} sq ft)
+        - Roof Type: {request.roof_type}
+        - Material: {request.material_type}
+        - Complexity: {request.complexity}
+        - Slope: {request.slope}/12 pitch
+        - Location: {request.location}
+        
+        Provide detailed calculations in JSON format with:
+        1. materials_needed (specific quantities)
+        2. cost_estimate (material, labor, total costs)
+        3. recommendations (3-5 practical tips)
+        4. confidence_score (0-1)
+        
+        Be precise and use the knowledge base information.
+        """
+        
+        return [
+            {"role": "system", "content": "You are an expert roof calculation assistant. Always respond with valid JSON."},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _ask_ai(self, request: RoofCalculationRequest, relevant_knowledge: List[Dict],
+                timeout: Optional[float] = None) -> RoofCalculationResult:
+        """One OpenAI round-trip with the given knowledge as context; raises on failure"""
+        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+        # do not change this unless explicitly requested by the user
+        content = get_llm_gateway().chat(
+            model="gpt-4o",
+            messages=self._ai_messages(request, relevant_knowledge),
+            response_format={"type": "json_object"},
+            temperature=0.1,
+            timeout=timeout
+        )
+        return self._parse_ai_content(content)
+    
+    def _parse_ai_content(self, content: Optional[str]) -> RoofCalculationResult:
+        # Parse AI response
+        if content:
+            ai_result = json.loads(content)
+        else:
+            raise ValueError("Empty response from AI")
+        
+        return RoofCalculationResult(
+            materials_needed=ai_result.get('materials_needed', {}),
+            cost_estimate=ai_result.get('cost_estimate', {}),
+            recommendations=ai_result.get('recommendations', []),
+            confidence_score=ai_result.get('confidence_score', 0.9),
+            source='ai'
+        )
+    
     def calculate_with_ai(self, request: RoofCalculationRequest) -> RoofCalculationResult:
         """Calculate using OpenAI API with knowledge base context"""
         try:
-            # Get relevant knowledge
-            query = f"{request.material_type} roof {request.roof_type} {request.length}x{request.width}"
-            relevant_knowledge = self.get_relevant_knowledge(query)
-            
-            # Build context for AI
-            context = "Roof calculation knowledge base:\n"
-            for knowledge in relevant_knowledge:
-                context += f"- {knowledge['content']}\n"
-            
-            # Create AI prompt
-            prompt = f"""
-            You are an expert roof calculator. Use the provided knowledge base to calculate materials and costs.
-            
-            {context}
-            
-            Calculate for this roof:
-            - Dimensions: {request.length}ft × {request.width}ft ({request.length * request.width} sq ft)
-            - Roof Type: {request.roof_type}
-            - Material: {request.material_type}
-            - Complexity: {request.complexity}
-            - Slope: {request.slope}/12 pitch
-            - Location: {request.location}
-            
-            Provide detailed calculations in JSON format with:
-            1. materials_needed (specific quantities)
-            2. cost_estimate (material, labor, total costs)
-            3. recommendations (3-5 practical tips)
-            4. confidence_score (0-1)
-            
-            Be precise and use the knowledge base information.
-            """
-            
-            # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-            # do not change this unless explicitly requested by the user
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are an expert roof calculation assistant. Always respond with valid JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"},
-                temperature=0.1
-            )
-            
-            # Parse AI response
-            content = response.choices[0].message.content
-            if content:
-                ai_result = json.loads(content)
-            else:
-                raise ValueError("Empty response from AI")
-            
-            return RoofCalculationResult(
-                materials_needed=ai_result.get('materials_needed', {}),
-                cost_estimate=ai_result.get('cost_estimate', {}),
-                recommendations=ai_result.get('recommendations', []),
-                confidence_score=ai_result.get('confidence_score', 0.9),
-                source='ai'
-            )
-            
+            relevant_knowledge = self.get_relevant_knowledge(self._knowledge_query(request))
+            return self._ask_ai(request, relevant_knowledge)
         except Exception as e:
             logger.error(f"AI calculation failed: {e}")
             # Fallback to offline prediction
             return self.predict_offline(request)
     
-    def calculate_hybrid(self, request: RoofCalculationRequest) -> RoofCalculationResult:
-        """Hybrid calculation combining AI and ML predictions"""
+    def _timed_ai_path(self, request: RoofCalculationRequest, components: Dict,
+                       deadline: float) -> RoofCalculationResult:
+        """Retrieval then the LLM call, recording each step in components"""
+        started = time.perf_counter()
+        components['retrieval'] = {'status': 'running'}
+        relevant_knowledge = self.get_relevant_knowledge(self._knowledge_query(request))
+        components['retrieval'] = {'status': 'ok', 'seconds': round(time.perf_counter() - started, 3)}
+        
+        started = time.perf_counter()
+        components['llm'] = {'status': 'running'}
+        try:
+            # Do not keep the HTTP request open past the caller's budget
+            result = self._ask_ai(request, relevant_knowledge,
+                                  timeout=max(deadline - time.monotonic(), 0.1))
+        except Exception as e:
+            components['llm'] = {'status': 'error', 'error': str(e),
+                                 'seconds': round(time.perf_counter() - started, 3)}
+            raise
+        components['llm'] = {'status': 'ok', 'seconds': round(time.perf_counter() - started, 3)}
+        return result
+    
+    def calculate_hybrid(self, request: RoofCalculationRequest,
+                         budget: Optional[float] = None) -> RoofCalculationResult:
+        """Hybrid calculation combining AI and ML predictions.
+        
+        Retrieval and the LLM call run on the thread pool while the offline
+        model runs in the calling thread. If the AI path fails or has not
+        finished within budget seconds (HYBRID_LATENCY_BUDGET), the ML
+        result is returned alone. result.components records which parts
+        finished in time.
+        """
+        budget = HYBRID_LATENCY_BUDGET if budget is None else budget
+        deadline = time.monotonic() + budget
+        components = {}
+        ai_future = self.executor.submit(self._timed_ai_path, request, components, deadline)
+        
+        started = time.perf_counter()
+        ml_result = self.predict_offline(request)
+        components['ml'] = {'status': 'ok' if ml_result.source == 'ml' else ml_result.source,
+                            'seconds': round(time.perf_counter() - started, 3)}
+        
         try:
-            # Get both AI and ML predictions
-            ai_result = self.calculate_with_ai(request)
-            ml_result = self.predict_offline(request)
-            
-            # Combine results intelligently
-            hybrid_materials = {}
-            hybrid_costs = {}
-            
-            # Average numerical values where possible
-            if ai_result.materials_needed and ml_result.materials_needed:
-                for key in ai_result.materials_needed:
-                    if key in ml_result.materials_needed:
-                        if isinstance(ai_result.materials_needed[key], (int, float)):
-                            hybrid_materials[key] = (
-                                ai_result.materials_needed[key] + ml_result.materials_needed[key]
-                            ) / 2
-                        else:
-                            hybrid_materials[key] = ai_result.materials_needed[key]
+            ai_result = ai_future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            logger.warning(f"AI path missed the {budget}s budget; returning the ML result")
+            ai_result = None
+        except Exception as e:
+            logger.error(f"AI calculation failed: {e}")
+            ai_result = None
+        
+        # Snapshot now: a late AI thread keeps writing to components
+        components = {name: dict(value) for name, value in list(components.items())}
+        for name in ('retrieval', 'llm'):
+            if components.get(name, {'status': 'running'})['status'] == 'running':
+                components[name] = {'status': 'timeout'}
+        if ai_result is None:
+            ml_result.components = components
+            return ml_result
+        
+        try:
+            result = self._combine_results(ai_result, ml_result)
+        except Exception as e:
+            logger.error(f"Hybrid calculation failed: {e}")
+            result = ml_result
+        result.components = components
+        return result
+    
+    def _combine_results(self, ai_result: RoofCalculationResult,
+                         ml_result: RoofCalculationResult) -> RoofCalculationResult:
+        """Average the numeric AI and ML figures, merge recommendations"""
+        # Combine results intelligently
+        hybrid_materials = {}
+        hybrid_costs = {}
+        
+        # Average numerical values where possible
+        if ai_result.materials_needed and ml_result.materials_needed:
+            for key in ai_result.materials_needed:
+                if key in ml_result.materials_needed:
+                    if isinstance(ai_result.materials_needed[key], (int, float)):
+                        hybrid_materials[key] = (
+                            ai_result.materials_needed[key] + ml_result.materials_needed[key]
+                        ) / 2
                     else:
                         hybrid_materials[key] = ai_result.materials_needed[key]
-            else:
-                hybrid_materials = ai_result.materials_needed or ml_result.materials_needed or {}
-            
-            if ai_result.cost_estimate and ml_result.cost_estimate:
-                for key in ai_result.cost_estimate:
-                    if key in ml_result.cost_estimate:
-                        if isinstance(ai_result.cost_estimate[key], (int, float)):
-                            hybrid_costs[key] = (
-                                ai_result.cost_estimate[key] + ml_result.cost_estimate[key]
-                            ) / 2
-                        else:
-                            hybrid_costs[key] = ai_result.cost_estimate[key]
+                else:
+                    hybrid_materials[key] = ai_result.materials_needed[key]
+        else:
+            hybrid_materials = ai_result.materials_needed or ml_result.materials_needed or {}
+        
+        if ai_result.cost_estimate and ml_result.cost_estimate:
+            for key in ai_result.cost_estimate:
+                if key in ml_result.cost_estimate:
+                    if isinstance(ai_result.cost_estimate[key], (int, float)):
+                        hybrid_costs[key] = (
+                            ai_result.cost_estimate[key] + ml_result.cost_estimate[key]
+                        ) / 2
                     else:
                         hybrid_costs[key] = ai_result.cost_estimate[key]
-            else:
-                hybrid_costs = ai_result.cost_estimate or ml_result.cost_estimate or {}
-            
-            # Combine recommendations
-            combined_recommendations = list(set(
-                ai_result.recommendations + ml_result.recommendations
-            ))[:5]  # Limit to 5 recommendations
-            
-            # Average confidence scores
-            hybrid_confidence = (ai_result.confidence_score + ml_result.confidence_score) / 2
-            
-            return RoofCalculationResult(
-                materials_needed=hybrid_materials,
-                cost_estimate=hybrid_costs,
-                recommendations=combined_recommendations,
-                confidence_score=hybrid_confidence,
-                source='hybrid'
-            )
-            
-        except Exception as e:
-            logger.error(f"Hybrid calculation failed: {e}")
+                else:
+                    hybrid_costs[key] = ai_result.cost_estimate[key]
+        else:
+            hybrid_costs = ai_result.cost_estimate or ml_result.cost_estimate or {}
+        
+        # Combine recommendations
+        combined_recommendations = list(set(
+            ai_result.recommendations + ml_result.recommendations
+        ))[:5]  # Limit to 5 recommendations
+        
+        # Average confidence scores
+        hybrid_confidence = (ai_result.confidence_score + ml_result.confidence_score) / 2
+        
+        return RoofCalculationResult(
+            materials_needed=hybrid_materials,
+            cost_estimate=hybrid_costs,
+            recommendations=combined_recommendations,
+            confidence_score=hybrid_confidence,
+            source='hybrid'
+        )
+    
+    def calculate(self, request: RoofCalculationRequest, method: str = 'hybrid') -> RoofCalculationResult:
+        """Run method ('ai', 'ml' or 'hybrid') through the calculation cache.
+        
+        The offline model is cheaper than a cache lookup, so 'ml' bypasses it.
+        """
+        if method == 'ml':
+            self.cache._count('bypassed')
             return self.predict_offline(request)
+        
+        method = 'ai' if method == 'ai' else 'hybrid'
+        key = self.cache.key(request, method)
+        cached = self.cache.get(key)
+        if cached is not None:
+            cached.components = {'cache': {'status': 'hit'}}
+            return cached
+        
+        # The key is built from the canonical request, so the result must be
+        # too: 'Complex' and 'complex' share a key and must share a quote
+        canonical = self.cache.canonical_request(request)
+        if method == 'ai':
+            result = self.calculate_with_ai(canonical)
+        else:
+            result = self.calculate_hybrid(canonical)
+        self.cache.put(key, result)
+        return result
+    
+    def calculate_stream(self, request: RoofCalculationRequest, method: str = 'hybrid',
+                         budget: Optional[float] = None):
+        """Yield (event, data) pairs as each part of the calculation is ready.
+        
+        'ml' comes first (the offline model, milliseconds), then 'knowledge'
+        (retrieved snippets), then 'token' events while the LLM writes its
+        answer, then exactly one 'result' with the final calculation. When
+        the AI path fails or runs past budget seconds, 'result' is the ML
+        result and a 'warning' event says why. Cached results skip straight
+        to 'result'.
+        """
+        budget = HYBRID_LATENCY_BUDGET if budget is None else budget
+        deadline = time.monotonic() + budget
+        components = {}
+        # As in calculate(): every cached method works on the canonical request,
+        # so the ML estimate shown first matches the result cached with it
+        if method != 'ml':
+            request = self.cache.canonical_request(request)
+        
+        started = time.perf_counter()
+        ml_result = self.predict_offline(request)
+        components['ml'] = {'status': 'ok' if ml_result.source == 'ml' else ml_result.source,
+                            'seconds': round(time.perf_counter() - started, 3)}
+        yield 'ml', asdict(ml_result)
+        if method == 'ml':
+            self.cache._count('bypassed')
+            ml_result.components = components
+            yield 'result', asdict(ml_result)
+            return
+        
+        method = 'ai' if method == 'ai' else 'hybrid'
+        key = self.cache.key(request, method)
+        cached = self.cache.get(key)
+        if cached is not None:
+            cached.components = {'cache': {'status': 'hit'}}
+            yield 'result', asdict(cached)
+            return
+        
+        started = time.perf_counter()
+        relevant_knowledge = self.get_relevant_knowledge(self._knowledge_query(request))
+        components['retrieval'] = {'status': 'ok', 'seconds': round(time.perf_counter() - started, 3)}
+        yield 'knowledge', [{'id': item.get('id'), 'content': item['content']} for item in relevant_knowledge]
+        
+        started = time.perf_counter()
+        content = []
+        try:
+            # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+            # do not change this unless explicitly requested by the user
+            for delta in get_llm_gateway().stream_chat(
+                model="gpt-4o",
+                messages=self._ai_messages(request, relevant_knowledge),
+                response_format={"type": "json_object"},
+                temperature=0.1,
+                timeout=max(deadline - time.monotonic(), 0.1)
+            ):
+                content.append(delta)
+                yield 'token', {'text': delta}
+            ai_result = self._parse_ai_content(''.join(content))
+            components['llm'] = {'status': 'ok', 'seconds': round(time.perf_counter() - started, 3)}
+        except Exception as e:
+            status = 'timeout' if isinstance(e, TimeoutError) else 'error'
+            components['llm'] = {'status': status, 'seconds': round(time.perf_counter() - started, 3)}
+            logger.error(f"Streaming AI calculation failed: {e}")
+            yield 'warning', {'message': f"AI refinement unavailable ({status}); showing the ML estimate"}
+            ml_result.components = components
+            yield 'result', asdict(ml_result)
+            return
+        
+        result = ai_result if method == 'ai' else self._combine_results(ai_result, ml_result)
+        self.cache.put(key, result)
+        result.components = components
+        yield 'result', asdict(result)
     
     def _basic_fallback_calculation(self, request: RoofCalculationRequest) -> RoofCalculationResult:
         """Basic fallback calculation when other methods fail"""
@@ -501,12 +933,78 @@ class AIRoofCalculator:
             source='fallback'
         )
 
-# Initialize global calculator instance
+# Global calculator instance, created on first use
 ai_calculator = None
+_ai_calculator_lock = threading.Lock()
 
 def get_ai_calculator():
     """Get or create AI calculator instance"""
     global ai_calculator
     if ai_calculator is None:
-        ai_calculator = AIRoofCalculator()
-    return ai_calculator
\ No newline at end of file
+        with _ai_calculator_lock:
+            if ai_calculator is None:
+                ai_calculator = AIRoofCalculator()
+    return ai_calculator
+
+def self_check() -> bool:
+    """Validate calculate_stream against llm_gateway's fake OpenAI server:
+    event order, the budget fallback, and that streamed and cached results
+    are computed on the canonical request"""
+    from llm_gateway import start_fake_server
+    server = start_fake_server(delay=0.1)
+    os.environ['OPENAI_BASE_URL'] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ.setdefault('OPENAI_API_KEY', 'test')
+    calculator = AIRoofCalculator()
+    # Knowledge comes from the in-memory list; no vector database needed
+    calculator._vector_db_loaded = True
+    calculator.cache = CalculationCache(bucket=5, shared=False)
+    ok = True
+
+    def report(name, passed, detail):
+        nonlocal ok
+        ok = ok and passed
+        print(f"{'PASS' if passed else 'FAIL'} {name}: {detail}")
+
+    raw = RoofCalculationRequest(length=41.3, width=28.9, roof_type='Gable',
+                                 material_type='Shingles', slope=6, complexity='Complex')
+    canonical = calculator.cache.canonical_request(raw)
+    events = list(calculator.calculate_stream(raw))
+    names = [name for name, _ in events]
+    expected = ['ml', 'knowledge'] + ['token'] * (len(names) - 3) + ['result']
+    report('event order', names == expected and names.count('token') > 0,
+           f"{names[0]}, {names[1]}, {names.count('token')} x token, {names[-1]}")
+
+    ml_event = events[0][1]
+    report('canonical ml estimate', ml_event == asdict(calculator.predict_offline(canonical)),
+           f"{raw.length} x {raw.width} streamed the estimate for {canonical.length} x {canonical.width}")
+
+    streamed = events[-1][1]
+    restreamed = list(calculator.calculate_stream(
+        RoofCalculationRequest(length=40, width=30, roof_type='gable', material_type='shingles',
+                               slope=6, complexity='complex')))
+    computed = calculator.calculate(raw)
+    same_quote = (restreamed[-1][1]['cost_estimate'] == streamed['cost_estimate']
+                  == computed.cost_estimate)
+    report('one quote per key', len(restreamed) == 2 and same_quote,
+           f"'Complex' and 'complex' -> {restreamed[-1][1]['components']}, "
+           f"total {streamed['cost_estimate']['total_cost']}")
+
+    server.delay = 2.0
+    calculator.cache.clear()
+    started = time.perf_counter()
+    events = list(calculator.calculate_stream(raw, budget=0.5))
+    elapsed = time.perf_counter() - started
+    names = [name for name, _ in events]
+    report('budget fallback', names[-2:] == ['warning', 'result'] and events[-1][1]['source'] == 'ml'
+           and elapsed < 1.5, f"2s upstream, 0.5s budget -> {names[-2]} and ML result after {elapsed:.2f}s")
+
+    print(f"cache: {calculator.cache.get_stats()}")
+    server.shutdown()
+    return ok
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description='AI roof calculator tools')
+    parser.add_argument('command', choices=['check'])
+    parser.parse_args()
+    sys.exit(0 if self_check() else 1)
@@ -1,15 +1,27 @@
 """
 AI-powered roof calculator routes
 """
-from flask import request, jsonify, render_template, flash, redirect, url_for
+from flask import request, jsonify, render_template, flash, redirect, url_for, Response, stream_with_context
 from flask_login import login_required, current_user
+import json
 import logging
-from ai_roof_calculator import get_ai_calculator, RoofCalculationRequest
+from ai_roof_calculator import get_ai_calculator, RoofCalculationRequest, RoofCalculationResult
 from ai_models import get_ai_database
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
+import time
 import traceback
 
 logger = logging.getLogger(__name__)
 
+BATCH_MAX_ITEMS = int(os.environ.get('SMARTROOF_BATCH_MAX_ITEMS', 500))
+# AI refinement of a batch: parallel calls and total seconds
+BATCH_AI_CONCURRENCY = int(os.environ.get('SMARTROOF_BATCH_AI_CONCURRENCY', 4))
+BATCH_AI_BUDGET = float(os.environ.get('SMARTROOF_BATCH_AI_BUDGET', 20))
+# Accepted input ranges: dimensions in feet, slope as rise per 12 of run
+MAX_DIMENSION = 10000.0
+MAX_SLOPE = 24.0
+
 def register_ai_routes(app):
     """Register AI calculator routes with Flask app"""
     
@@ -33,78 +45,17 @@ def register_ai_routes(app):
     def ai_calculate():
         """Process AI roof calculation"""
         try:
-            # Get form data
-            length = float(request.form.get('length', 0))
-            width = float(request.form.get('width', 0))
-            roof_type = request.form.get('roof_type', 'gable')
-            material_type = request.form.get('material_type', 'shingles')
-            location = request.form.get('location', '')
-            slope = float(request.form.get('slope', 4))
-            complexity = request.form.get('complexity', 'simple')
-            calculation_method = request.form.get('method', 'hybrid')
-            
-            # Validate input
-            if length <= 0 or width <= 0:
-                return jsonify({
-                    'error': 'Invalid dimensions. Length and width must be positive numbers.'
-                }), 400
-            
-            # Create calculation request
-            calc_request = RoofCalculationRequest(
-                length=length,
-                width=width,
-                roof_type=roof_type,
-                material_type=material_type,
-                location=location,
-                slope=slope,
-                complexity=complexity
-            )
+            calc_request, calculation_method = _calculation_request_from_form()
             
             # Get AI calculator
             calculator = get_ai_calculator()
             
-            # Perform calculation based on method
-            if calculation_method == 'ai':
-                result = calculator.calculate_with_ai(calc_request)
-            elif calculation_method == 'ml':
-                result = calculator.predict_offline(calc_request)
-            else:  # hybrid
-                result = calculator.calculate_hybrid(calc_request)
+            # Perform calculation based on method (ai, ml or hybrid), cached
+            result = calculator.calculate(calc_request, calculation_method)
             
-            # Save to database
-            ai_db = get_ai_database()
-            calculation_data = {
-                'user_id': current_user.id,
-                'length': length,
-                'width': width,
-                'roof_type': roof_type,
-                'material_type': material_type,
-                'location': location,
-                'slope': slope,
-                'complexity': complexity,
-                'materials_needed': result.materials_needed,
-                'cost_estimate': result.cost_estimate,
-                'recommendations': result.recommendations,
-                'confidence_score': result.confidence_score,
-                'calculation_source': result.source
-            }
+            calculation_id = _save_calculation(calc_request, result)
             
-            calculation_id = ai_db.save_calculation(calculation_data)
-            
-            # Format response
-            response_data = {
-                'success': True,
-                'calculation_id': calculation_id,
-                'area': length * width,
-                'materials': result.materials_needed,
-                'costs': result.cost_estimate,
-                'recommendations': result.recommendations,
-                'confidence': result.confidence_score,
-                'method': result.source,
-                'formatted_costs': _format_costs(result.cost_estimate)
-            }
-            
-            return jsonify(response_data)
+            return jsonify(_response_data(calc_request, result, calculation_id))
             
         except ValueError as e:
             logger.error(f"Validation error in AI calculate: {e}")
@@ -116,6 +67,105 @@ def register_ai_routes(app):
                 'error': 'Calculation failed. Please check your inputs and try again.'
             }), 500
     
+    @app.route('/ai-calculate/stream', methods=['POST'])
+    @login_required
+    def ai_calculate_stream():
+        """Server-sent events version of /ai-calculate.
+        
+        Sends 'ml' (the offline estimate) at once, then 'knowledge',
+        'token' events while the AI answer is written, and finally 'result'
+        with the same fields /ai-calculate returns.
+        """
+        try:
+            calc_request, calculation_method = _calculation_request_from_form()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        calculator = get_ai_calculator()
+        
+        def generate():
+            try:
+                for event, data in calculator.calculate_stream(calc_request, calculation_method):
+                    if event == 'ml':
+                        data = _response_data(calc_request, RoofCalculationResult(**data), None)
+                    elif event == 'result':
+                        result = RoofCalculationResult(**data)
+                        data = _response_data(calc_request, result, _save_calculation(calc_request, result))
+                    yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+            except Exception as e:
+                logger.error(f"AI calculation stream error: {e}")
+                logger.error(traceback.format_exc())
+                yield 'event: error\ndata: {"error": "Calculation failed. Please try again."}\n\n'
+        
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    @app.route('/api/ai-calculate/batch', methods=['POST'])
+    @login_required
+    def ai_calculate_batch():
+        """Estimate many roof sections at once.
+        
+        Body: {"items": [{length, width, roof_type, material_type, slope,
+        complexity, location}, ...], "refine": "none" | "ai" | "hybrid",
+        "save": true}. Every item gets the vectorized offline estimate;
+        refine also asks the AI for each item, with bounded concurrency.
+        Returns per-item results (or errors) in request order plus totals.
+        """
+        started = time.perf_counter()
+        payload = request.get_json(silent=True) or {}
+        items = payload.get('items')
+        refine = payload.get('refine', 'none')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'items must be a non-empty list'}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'At most {BATCH_MAX_ITEMS} items per batch'}), 400
+        if refine not in ('none', 'ai', 'hybrid'):
+            return jsonify({'error': 'refine must be none, ai or hybrid'}), 400
+        
+        try:
+            responses = [None] * len(items)
+            indexes, requests = [], []
+            for i, item in enumerate(items):
+                try:
+                    requests.append(_batch_item_request(item))
+                    indexes.append(i)
+                except (TypeError, ValueError) as e:
+                    responses[i] = {'index': i, 'success': False, 'error': str(e)}
+            
+            calculator = get_ai_calculator()
+            results = calculator.predict_offline_batch(requests)
+            refined = 0
+            if refine != 'none' and requests:
+                refined = _refine_batch(calculator, requests, results, refine)
+            
+            calculation_ids = [None] * len(requests)
+            if payload.get('save', True) and requests:
+                calculation_ids = get_ai_database().save_calculations([
+                    _calculation_data(calc_request, result)
+                    for calc_request, result in zip(requests, results)
+                ])
+            
+            totals = {'items': len(items), 'succeeded': len(requests),
+                      'failed': len(items) - len(requests), 'refined': refined,
+                      'area': 0.0, 'materials': {}, 'costs': {}, 'methods': {}}
+            for i, calc_request, result, calculation_id in zip(indexes, requests, results, calculation_ids):
+                responses[i] = dict(_response_data(calc_request, result, calculation_id), index=i)
+                totals['area'] += calc_request.length * calc_request.width
+                totals['methods'][result.source] = totals['methods'].get(result.source, 0) + 1
+                for group, values in (('materials', result.materials_needed), ('costs', result.cost_estimate)):
+                    for key, value in (values or {}).items():
+                        if isinstance(value, (int, float)) and key not in ('area_covered', 'cost_per_sqft'):
+                            totals[group][key] = totals[group].get(key, 0) + value
+            totals['formatted_costs'] = _format_costs(totals['costs'])
+            totals['seconds'] = round(time.perf_counter() - started, 3)
+            
+            return jsonify({'success': True, 'results': responses, 'totals': totals})
+            
+        except Exception as e:
+            logger.error(f"Batch calculation error: {e}")
+            logger.error(traceback.format_exc())
+            return jsonify({'error': 'Batch calculation failed. Please try again.'}), 500
+    
     @app.route('/ai-feedback', methods=['POST'])
     @login_required
     def ai_feedback():
@@ -178,6 +228,15 @@ def register_ai_routes(app):
             logger.error(f"History retrieval error: {e}")
             return jsonify({'error': 'Failed to load history'}), 500
     
+    @app.route('/ai-cache-stats')
+    @login_required
+    def ai_cache_stats():
+        """Calculation cache hit/miss counters for this worker"""
+        if not current_user.is_admin:
+            return jsonify({'error': 'Access denied'}), 403
+        
+        return jsonify(get_ai_calculator().cache.get_stats())
+    
     @app.route('/ai-knowledge')
     @login_required
     def ai_knowledge():
@@ -199,6 +258,110 @@ def register_ai_routes(app):
             logger.error(f"Knowledge retrieval error: {e}")
             return jsonify({'error': 'Failed to retrieve knowledge'}), 500
 
+def _calculation_request_from_form():
+    """(RoofCalculationRequest, method) from the calculator form; raises
+    ValueError for invalid input"""
+    length, width, slope = _checked_numbers(request.form)
+    
+    calc_request = RoofCalculationRequest(
+        length=length,
+        width=width,
+        roof_type=request.form.get('roof_type', 'gable'),
+        material_type=request.form.get('material_type', 'shingles'),
+        location=request.form.get('location', ''),
+        slope=slope,
+        complexity=request.form.get('complexity', 'simple')
+    )
+    return calc_request, request.form.get('method', 'hybrid')
+
+def _checked_numbers(values):
+    """(length, width, slope) from a form or JSON object; raises ValueError
+    unless all are finite and within range"""
+    length = float(values.get('length', 0))
+    width = float(values.get('width', 0))
+    slope = float(values.get('slope', 4))
+    # Comparisons are False for NaN, so it is rejected with infinities
+    if not (0 < length <= MAX_DIMENSION and 0 < width <= MAX_DIMENSION):
+        raise ValueError(f'Invalid dimensions. Length and width must be positive numbers '
+                         f'up to {MAX_DIMENSION:g}.')
+    if not 0 <= slope <= MAX_SLOPE:
+        raise ValueError(f'Invalid slope. Slope must be between 0 and {MAX_SLOPE:g} (rise per 12).')
+    return length, width, slope
+
+def _calculation_data(calc_request, result):
+    return {
+        'user_id': current_user.id,
+        'length': calc_request.length,
+        'width': calc_request.width,
+        'roof_type': calc_request.roof_type,
+        'material_type': calc_request.material_type,
+        'location': calc_request.location,
+        'slope': calc_request.slope,
+        'complexity': calc_request.complexity,
+        'materials_needed': result.materials_needed,
+        'cost_estimate': result.cost_estimate,
+        'recommendations': result.recommendations,
+        'confidence_score': result.confidence_score,
+        'calculation_source': result.source
+    }
+
+def _save_calculation(calc_request, result):
+    """Store the calculation for the current user; returns its id"""
+    return get_ai_database().save_calculation(_calculation_data(calc_request, result))
+
+def _batch_item_request(item):
+    """RoofCalculationRequest from one JSON batch item; raises ValueError"""
+    if not isinstance(item, dict):
+        raise ValueError('Each item must be an object')
+    length, width, slope = _checked_numbers(item)
+    return RoofCalculationRequest(
+        length=length,
+        width=width,
+        roof_type=str(item.get('roof_type', 'gable')),
+        material_type=str(item.get('material_type', 'shingles')),
+        location=str(item.get('location', '')),
+        slope=slope,
+        complexity=str(item.get('complexity', 'simple'))
+    )
+
+def _refine_batch(calculator, requests, results, method):
+    """Replace results[i] with calculator.calculate(requests[i], method),
+    BATCH_AI_CONCURRENCY at a time, for at most BATCH_AI_BUDGET seconds;
+    items not refined in time keep their ML result. Returns the number
+    refined (results that actually came from the AI or hybrid path, not
+    the offline fallback)."""
+    pool = ThreadPoolExecutor(max_workers=BATCH_AI_CONCURRENCY, thread_name_prefix='batch-ai')
+    futures = {pool.submit(calculator.calculate, calc_request, method): i
+               for i, calc_request in enumerate(requests)}
+    done, not_done = wait(futures, timeout=BATCH_AI_BUDGET)
+    pool.shutdown(wait=False, cancel_futures=True)
+    refined = 0
+    for future in done:
+        try:
+            result = future.result()
+            results[futures[future]] = result
+            if result.source in ('ai', 'hybrid'):
+                refined += 1
+        except Exception as e:
+            logger.error(f"Batch AI refinement failed: {e}")
+    if not_done:
+        logger.warning(f"{len(not_done)} batch items missed the {BATCH_AI_BUDGET}s refinement budget")
+    return refined
+
+def _response_data(calc_request, result, calculation_id):
+    return {
+        'success': True,
+        'calculation_id': calculation_id,
+        'area': calc_request.length * calc_request.width,
+        'materials': result.materials_needed,
+        'costs': result.cost_estimate,
+        'recommendations': result.recommendations,
+        'confidence': result.confidence_score,
+        'method': result.source,
+        'components': result.components,
+        'formatted_costs': _format_costs(result.cost_estimate)
+    }
+
 def _format_costs(cost_estimate):
     """Format cost estimates for display"""
     if not cost_estimate:
@@ -3,17 +3,14 @@ import logging
 from flask import Flask
 from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
+from startup import StartupTimer
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
-
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)  # needed for url_for to generate with https
+logger = logging.getLogger(__name__)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 
@@ -22,12 +19,35 @@ def load_user(user_id):
     from models import User
     return User.get(int(user_id))
 
-# Initialize database
-import database
+def create_app():
+    """Application factory.
+
+    Only the web layer is imported here; ML and AI dependencies (sklearn,
+    nltk, chromadb, openai) load on first use of the features that need them.
+    """
+    timer = StartupTimer()
+
+    with timer.stage('flask'):
+        app = Flask(__name__)
+        app.secret_key = os.environ.get("SESSION_SECRET")
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)  # needed for url_for to generate with https
+        login_manager.init_app(app)
+
+    # Initialize database
+    with timer.stage('database'):
+        import database
+        database.init_database()
+        database.init_app(app)
+
+    with timer.stage('routes'):
+        from routes import register_routes
+        register_routes(app)
 
-# Import routes after app initialization
-from routes import *
+    # AI routes
+    with timer.stage('ai_routes'):
+        from ai_routes import register_ai_routes
+        register_ai_routes(app)
 
-# Import AI routes
-from ai_routes import register_ai_routes
-register_ai_routes(app)
+    timer.report()
+    app.config['STARTUP_TIMINGS'] = timer.timings
+    return app
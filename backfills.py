@@ -0,0 +1,181 @@
+"""
+Batch jobs for derived data
+Row backfills walk their source table in primary-key order, one bounded
+chunk per transaction, and record their position in backfill_state so an
+interrupted run picks up where it stopped. Rebuild jobs recompute a derived
+table in bounded blocks and swap it in with one transaction.
+
+    python backfills.py order_items [--batch-size 500]
+    python backfills.py product_similar [--batch-size 512]
+    python backfills.py review_sentiment [--batch-size N]
+    python backfills.py customer_segments [--batch-size 500]
+"""
+import argparse
+import logging
+import os
+import time
+from typing import Dict, Optional
+from database import get_db_connection, init_database
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+def _get_position(conn, name: str) -> int:
+    row = conn.execute('SELECT last_id FROM backfill_state WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+def _set_position(conn, name: str, last_id: int):
+    conn.execute('''
+        INSERT INTO backfill_state (name, last_id, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id, updated_at = excluded.updated_at
+    ''', (name, last_id))
+
+def backfill_order_items(batch_size: int = DEFAULT_BATCH_SIZE) -> Dict:
+    """Expand orders.items JSON into order_items for orders that lack rows.
+
+    The JSON is expanded inside SQLite with json_each, so only the chunk
+    boundaries ever reach Python.
+    """
+    started = time.perf_counter()
+    orders_done = 0
+    rows_written = 0
+    conn = get_db_connection()
+    try:
+        position = _get_position(conn, 'order_items')
+        while True:
+            upper = conn.execute('''
+                SELECT MAX(id), COUNT(*) FROM (
+                    SELECT id FROM orders WHERE id > ? ORDER BY id LIMIT ?
+                )
+            ''', (position, batch_size)).fetchone()
+            if not upper[1]:
+                break
+            cursor = conn.execute('''
+                INSERT INTO order_items
+                (order_id, user_id, product_id, product_name, quantity, price, subtotal)
+                SELECT o.id, o.user_id,
+                       json_extract(i.value, '$.product_id'),
+                       json_extract(i.value, '$.product_name'),
+                       json_extract(i.value, '$.quantity'),
+                       json_extract(i.value, '$.price'),
+                       json_extract(i.value, '$.subtotal')
+                FROM orders o,
+                     json_each(CASE WHEN json_valid(o.items) THEN o.items ELSE '[]' END) i
+                WHERE o.id > ? AND o.id <= ?
+                  AND json_extract(i.value, '$.product_id') IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = o.id)
+            ''', (position, upper[0]))
+            _set_position(conn, 'order_items', upper[0])
+            conn.commit()
+
+            position = upper[0]
+            orders_done += upper[1]
+            rows_written += cursor.rowcount
+            logger.info(f"order_items backfill: through order {position}, {rows_written} rows written")
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'orders_scanned': orders_done,
+        'rows_written': rows_written,
+        'last_order_id': position,
+        'seconds': round(elapsed, 3)
+    }
+
+def rebuild_product_similar(batch_size: int = 512) -> Dict:
+    """Refit the recommender and rewrite every product_similar row.
+
+    Similarities are computed batch_size products at a time with sparse
+    matrix products, so memory stays bounded by batch_size x catalog size.
+    The refreshed index is persisted for the web workers.
+    """
+    from catalog import store_similar_products
+    from ml_models import ProductRecommender
+    from models import catalog_cache
+
+    started = time.perf_counter()
+    products = catalog_cache.get_all()
+    recommender = ProductRecommender()
+    recommender.fit(products, block_size=batch_size)
+    recommender.catalog_version = catalog_cache.version()
+    recommender.save()
+    store_similar_products(recommender.neighbors)
+
+    return {
+        'products': len(products),
+        'rows_written': sum(len(similar) for similar in recommender.neighbors.values()),
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+def backfill_review_sentiment(batch_size: Optional[int] = None) -> Dict:
+    """Score every review that has no sentiment yet, one batch of review ids
+    per transaction, across os.cpu_count() processes. Reports reviews/sec.
+
+    One process pool serves the whole run, and a batch defaults to one
+    scoring chunk per process so every worker has work.
+    """
+    from sentiment import SENTIMENT_CHUNK_SIZE, process_pool, score_reviews, scorer
+
+    processes = os.cpu_count() or 1
+    batch_size = batch_size or SENTIMENT_CHUNK_SIZE * processes
+    started = time.perf_counter()
+    scored = 0
+    pool = process_pool(processes)
+    conn = get_db_connection()
+    try:
+        position = _get_position(conn, 'review_sentiment')
+        while True:
+            ids = [row[0] for row in conn.execute('''
+                SELECT id FROM reviews WHERE id > ? AND sentiment IS NULL ORDER BY id LIMIT ?
+            ''', (position, batch_size)).fetchall()]
+            if not ids:
+                break
+            scored += score_reviews(ids, pool=pool)
+            position = ids[-1]
+            _set_position(conn, 'review_sentiment', position)
+            conn.commit()
+            logger.info(f"review sentiment backfill: through review {position}, "
+                        f"{scored / (time.perf_counter() - started):.0f} reviews/sec")
+    finally:
+        conn.close()
+        if pool is not None:
+            pool.shutdown()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'reviews_scored': scored,
+        'last_review_id': position,
+        'seconds': round(elapsed, 3),
+        'reviews_per_sec': round(scored / elapsed, 1) if elapsed else 0.0,
+        'processes': processes,
+        'batch_size': batch_size,
+        'cache': scorer.stats()
+    }
+
+def rebuild_customer_segments(batch_size: int = DEFAULT_BATCH_SIZE) -> Dict:
+    """Recompute every customer's segment (recency ages without new orders)
+    and refit the KMeans clusters"""
+    import ml_models
+    return ml_models.customer_segmentation.refresh(full=True, clusters=True, batch_size=batch_size)
+
+BACKFILLS = {
+    'order_items': backfill_order_items,
+    'product_similar': rebuild_product_similar,
+    'review_sentiment': backfill_review_sentiment,
+    'customer_segments': rebuild_customer_segments,
+}
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Run a resumable backfill')
+    parser.add_argument('name', choices=sorted(BACKFILLS))
+    parser.add_argument('--batch-size', type=int,
+                        help=f'rows per transaction (default {DEFAULT_BATCH_SIZE}; '
+                             'review_sentiment: one chunk per process)')
+    args = parser.parse_args()
+    init_database()
+    kwargs = {'batch_size': args.batch_size} if args.batch_size else {}
+    print(BACKFILLS[args.name](**kwargs))
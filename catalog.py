@@ -0,0 +1,304 @@
+"""
+Catalog query layer for the storefront
+Filtering, search, sorting and keyset pagination are done in SQL so a page
+view only ever reads one page of product rows.
+"""
+import base64
+import difflib
+import json
+import math
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+from database import get_db_connection
+from models import Product, catalog_cache
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+AUTOCOMPLETE_LIMIT = 8
+
+# bm25 column weights for products_fts (name, description, category)
+BM25_RANK = 'bm25(products_fts, 10.0, 1.0, 4.0)'
+
+# sort name -> (column, direction); product id is always the tie-breaker
+SORT_OPTIONS = {
+    'default': (None, 'ASC'),
+    'relevance': ('rank', 'ASC'),
+    'newest': (None, 'DESC'),
+    'price_asc': ('price', 'ASC'),
+    'price_desc': ('price', 'DESC'),
+    'name': ('name', 'ASC'),
+}
+
+# sort column -> JSON types its cursor value may have
+CURSOR_VALUE_TYPES = {
+    'rank': (int, float),
+    'price': (int, float),
+    'name': (str,),
+}
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+# Statements checked by migrations.hot_queries() along with catalog_query()
+AUTOCOMPLETE_SQL = f'''
+    SELECT p.id, p.name, p.category, p.price
+    FROM products_fts JOIN products p ON p.id = products_fts.rowid
+    WHERE products_fts MATCH ?
+    ORDER BY {BM25_RANK}
+    LIMIT ?
+'''
+SIMILAR_PRODUCTS_SQL = '''
+    SELECT p.* FROM product_similar s JOIN products p ON p.id = s.similar_id
+    WHERE s.product_id = ?
+    ORDER BY s.rank
+    LIMIT ?
+'''
+
+SORT_LABELS = {
+    'default': 'Featured',
+    'relevance': 'Best Match',
+    'newest': 'Newest',
+    'price_asc': 'Price: Low to High',
+    'price_desc': 'Price: High to Low',
+    'name': 'Name',
+}
+
+@dataclass
+class CatalogPage:
+    """One page of catalog results"""
+    products: List[Product]
+    next_cursor: Optional[str]
+    sort: str
+    page_size: int
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+def encode_cursor(values) -> str:
+    """Opaque keyset cursor for the last row of a page"""
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str):
+    """Decode a cursor from encode_cursor; returns None if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+def _cursor_value_ok(value, types) -> bool:
+    # bool is an int subclass but never a sort value; SQLite integers are 64-bit
+    if isinstance(value, bool) or not isinstance(value, types):
+        return False
+    if isinstance(value, int):
+        return -SQLITE_MAX_INT <= value <= SQLITE_MAX_INT
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return True
+
+def cursor_matches(values, types) -> bool:
+    """Whether decoded cursor values hold exactly one value per entry of
+    types, each of one of that entry's types (ints within SQLite's range,
+    finite floats, never bools)"""
+    return len(values) == len(types) and all(
+        _cursor_value_ok(value, value_types) for value, value_types in zip(values, types)
+    )
+
+def _valid_cursor(values, column: Optional[str]) -> bool:
+    """Whether decoded cursor values fit the keyset of column: [value, id],
+    or [id] when sorting by id alone"""
+    if column is None:
+        return cursor_matches(values, [(int,)])
+    return cursor_matches(values, [CURSOR_VALUE_TYPES[column], (int,)])
+
+def _search_terms(text: str) -> List[str]:
+    return re.findall(r'\w+', text.lower())
+
+def build_match_query(text: str, prefix_last: bool = False) -> Optional[str]:
+    """Turn free text into an FTS5 MATCH expression (every term must match)"""
+    terms = _search_terms(text)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    if prefix_last:
+        quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def catalog_query(sort: str, match: Optional[str] = None, category: str = '',
+                  after: Optional[list] = None, limit: int = DEFAULT_PAGE_SIZE):
+    """(sql, params) for one keyset page of the catalog listing.
+
+    sort must be a SORT_OPTIONS key, match an FTS5 expression (required for
+    'relevance') and after already validated cursor values. search_catalog
+    runs exactly this statement and migrations.hot_queries() checks its plans.
+    """
+    column, direction = SORT_OPTIONS[sort]
+    comparison = '>' if direction == 'ASC' else '<'
+    where = []
+    params = []
+    if sort == 'relevance':
+        source = f'''(
+            SELECT p.*, {BM25_RANK} AS rank
+            FROM products_fts JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH ?
+        ) p'''
+        params.append(match)
+    else:
+        source = 'products p'
+        if match:
+            where.append('p.id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)')
+            params.append(match)
+
+    if category:
+        where.append('p.category = ?')
+        params.append(category)
+
+    if after:
+        if column:
+            where.append(f'(p.{column}, p.id) {comparison} (?, ?)')
+            params.extend(after)
+        else:
+            where.append(f'p.id {comparison} ?')
+            params.append(after[0])
+
+    order_by = f'p.{column} {direction}, p.id {direction}' if column else f'p.id {direction}'
+    sql = f'SELECT p.* FROM {source}'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY {order_by} LIMIT ?'
+    params.append(limit)
+    return sql, params
+
+def search_catalog(category: str = '', search: str = '', sort: str = 'default',
+                   cursor: Optional[str] = None,
+                   page_size: int = DEFAULT_PAGE_SIZE) -> CatalogPage:
+    """Return one page of products matching the filters.
+
+    Searches use the products_fts index; with no explicit sort, results are
+    ordered by BM25 relevance.
+    """
+    search = search.strip()
+    if sort not in SORT_OPTIONS or (sort == 'relevance' and not search):
+        sort = 'default'
+    if search and sort == 'default':
+        sort = 'relevance'
+    page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+    column = SORT_OPTIONS[sort][0]
+
+    match = build_match_query(search) if search else None
+    if search and match is None:
+        return CatalogPage(products=[], next_cursor=None, sort=sort, page_size=page_size)
+
+    # A malformed or tampered cursor starts from the first page
+    after = decode_cursor(cursor) if cursor else None
+    if after is not None and not _valid_cursor(after, column):
+        after = None
+    sql, params = catalog_query(sort, match, category, after, page_size + 1)
+
+    conn = get_db_connection()
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor([last[column], last['id']] if column else [last['id']])
+
+    return CatalogPage(
+        products=[Product.from_row(row) for row in rows],
+        next_cursor=next_cursor,
+        sort=sort,
+        page_size=page_size
+    )
+
+def get_categories() -> List[str]:
+    """Distinct product categories, cached per catalog version"""
+    return catalog_cache.categories()
+
+def _closest_term(conn, term: str) -> Optional[str]:
+    """Nearest indexed term, for typo-tolerant autocomplete.
+
+    Indexed terms are porter stems ("corrugated" -> "corrug"), so each
+    candidate is also compared against the same-length prefix of the term.
+    """
+    # Only compare against vocabulary sharing the first letter
+    rows = conn.execute(
+        'SELECT term FROM products_fts_vocab WHERE term >= ? AND term < ?',
+        (term[0], chr(ord(term[0]) + 1))
+    ).fetchall()
+    best, best_score = None, 0.75
+    for (candidate,) in rows:
+        if len(candidate) < 3 or len(candidate) > len(term) + 2:
+            continue
+        score = max(
+            difflib.SequenceMatcher(None, term, candidate).ratio(),
+            difflib.SequenceMatcher(None, term[:len(candidate)], candidate).ratio()
+        )
+        if score > best_score:
+            best, best_score = candidate, score
+    return best
+
+def autocomplete(text: str, limit: int = AUTOCOMPLETE_LIMIT) -> List[dict]:
+    """Prefix suggestions ranked by BM25, retrying with corrected terms on a miss"""
+    terms = _search_terms(text)
+    if not terms:
+        return []
+    conn = get_db_connection()
+    rows = conn.execute(AUTOCOMPLETE_SQL, (build_match_query(' '.join(terms), prefix_last=True), limit)).fetchall()
+    if not rows:
+        corrected = [_closest_term(conn, term) or term for term in terms]
+        if corrected != terms:
+            rows = conn.execute(
+                AUTOCOMPLETE_SQL, (build_match_query(' '.join(corrected), prefix_last=True), limit)
+            ).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def get_similar_products(product_id: int, limit: int = 4) -> List[Product]:
+    """Precomputed most-similar products, best first (one primary-key range read).
+
+    A product without rows (fresh database, or workers started without
+    the preload warmup) is answered from the in-memory recommender, which
+    also writes the missing rows for the next read.
+    """
+    conn = get_db_connection()
+    rows = conn.execute(SIMILAR_PRODUCTS_SQL, (product_id, limit)).fetchall()
+    conn.close()
+    if rows:
+        return [Product.from_row(row) for row in rows]
+
+    import ml_models
+    recommender = ml_models.refresh_product_recommender()
+    products = [catalog_cache.get(pid) for pid in recommender.get_similar_products(product_id, limit)]
+    return [product for product in products if product]
+
+def has_similar_products() -> bool:
+    """Whether product_similar holds any rows"""
+    conn = get_db_connection()
+    row = conn.execute('SELECT 1 FROM product_similar LIMIT 1').fetchone()
+    conn.close()
+    return row is not None
+
+def store_similar_products(neighbors: dict, product_ids=None):
+    """Replace the product_similar rows of product_ids (default: all) with
+    neighbors[id], a best-first list of (similar id, score)"""
+    conn = get_db_connection()
+    try:
+        if product_ids is None:
+            conn.execute('DELETE FROM product_similar')
+            product_ids = neighbors.keys()
+        else:
+            conn.executemany('DELETE FROM product_similar WHERE product_id = ?',
+                             [(pid,) for pid in product_ids])
+        conn.executemany('''
+            INSERT INTO product_similar (product_id, rank, similar_id, score)
+            VALUES (?, ?, ?, ?)
+        ''', [(pid, rank, similar_id, score)
+              for pid in product_ids
+              for rank, (similar_id, score) in enumerate(neighbors.get(pid, []))])
+        conn.commit()
+    finally:
+        conn.close()
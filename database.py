@@ -1,13 +1,25 @@
 import sqlite3
 import os
+from flask import g, has_app_context
 from werkzeug.security import generate_password_hash
 from datetime import datetime
+from db_pool import ConnectionPool
+import migrations
 
 DATABASE_PATH = 'smartroof.db'
 
+# Shared connection pool; size bounds concurrent connections per worker process
+pool = ConnectionPool(
+    DATABASE_PATH,
+    max_size=int(os.environ.get('SMARTROOF_DB_POOL_SIZE', 8)),
+    timeout=float(os.environ.get('SMARTROOF_DB_POOL_TIMEOUT', 10)),
+)
+
 def init_database():
     """Initialize SQLite database with tables"""
     conn = sqlite3.connect(DATABASE_PATH)
+    # WAL is persistent in the database file, so readers never block the writer
+    conn.execute('PRAGMA journal_mode = WAL')
     cursor = conn.cursor()
     
     # Users table
@@ -79,6 +91,9 @@ def init_database():
     
     conn.commit()
     
+    # Indexes, triggers and derived tables are applied as versioned migrations
+    migrations.migrate(conn)
+    
     # Insert default admin user if not exists
     cursor.execute('SELECT COUNT(*) FROM users WHERE username = ?', ('admin',))
     if cursor.fetchone()[0] == 0:
@@ -118,10 +133,32 @@ def init_database():
     conn.close()
 
 def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Get a pooled database connection.
+
+    Inside a Flask app context the same connection is reused for the whole
+    request and returned to the pool on teardown; calling close() on it only
+    rolls back uncommitted work. Outside an app context close() hands the
+    connection straight back to the pool.
+    """
+    if has_app_context():
+        conn = g.get('_db_conn')
+        if conn is None:
+            conn = pool.acquire()
+            conn._bound = True
+            g._db_conn = conn
+        return conn
+    return pool.acquire()
+
+def release_db_connection(exception=None):
+    """Return the app-context connection to the pool"""
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        conn.release()
+
+def get_pool_stats():
+    """Connection pool metrics (checkouts, wait and hold times)"""
+    return pool.stats()
 
-# Initialize database when module is imported
-init_database()
\ No newline at end of file
+def init_app(app):
+    """Bind pooled connections to the Flask app context lifecycle"""
+    app.teardown_appcontext(release_db_connection)
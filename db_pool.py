@@ -0,0 +1,198 @@
+"""
+Bounded, thread-safe SQLite connection pool
+Connections are opened once with WAL journaling and tuned pragmas, reused
+across requests and handed out per thread / per Flask app context.
+"""
+import sqlite3
+import threading
+import time
+import queue
+import logging
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# Pragmas applied to every pooled connection
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA mmap_size = 134217728',
+)
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available in time"""
+
+class PooledConnection:
+    """Wrapper around sqlite3.Connection whose close() returns it to the pool.
+
+    Calling close() discards any uncommitted work, the same as closing a
+    plain sqlite3 connection would, but keeps the underlying connection
+    (and its prepared-statement cache) alive for the next caller.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._released = False
+        self._bound = False  # True while owned by a Flask app context
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self._raw.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._raw.__exit__(exc_type, exc, tb)
+
+    def __del__(self):
+        # Never leak a pool slot if a caller forgets to close()
+        if not getattr(self, '_released', True):
+            try:
+                self.release()
+            except Exception:
+                pass
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def close(self):
+        """Roll back pending work; hand the connection back unless request-bound"""
+        if self._released:
+            return
+        if self._raw.in_transaction:
+            self._raw.rollback()
+        if not self._bound:
+            self.release()
+
+    def release(self):
+        """Return the underlying connection to the pool"""
+        if self._released:
+            return
+        self._released = True
+        self._pool._checkin(self._raw)
+
+class ConnectionPool:
+    """Fixed-size pool of SQLite connections with checkout metrics"""
+
+    def __init__(self, database_path: str, max_size: int = 8, timeout: float = 10.0,
+                 cached_statements: int = 256):
+        self.database_path = database_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'total_hold_ms': 0.0,
+            'max_hold_ms': 0.0,
+        }
+        self._checked_out_at: Dict[int, float] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.database_path,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        """Check a connection out of the pool, opening one if below max_size"""
+        started = time.perf_counter()
+        raw = None
+        try:
+            raw = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._created < self.max_size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                with self._lock:
+                    self._stats['waits'] += 1
+                try:
+                    raw = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise PoolTimeout(
+                        f"No database connection available after {self.timeout}s "
+                        f"(pool size {self.max_size})"
+                    )
+
+        wait_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['total_wait_ms'] += wait_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+            self._checked_out_at[id(raw)] = time.perf_counter()
+        return PooledConnection(self, raw)
+
+    def _checkin(self, raw: sqlite3.Connection):
+        if raw.in_transaction:
+            raw.rollback()
+        with self._lock:
+            checked_out = self._checked_out_at.pop(id(raw), None)
+            if checked_out is not None:
+                hold_ms = (time.perf_counter() - checked_out) * 1000
+                self._stats['total_hold_ms'] += hold_ms
+                self._stats['max_hold_ms'] = max(self._stats['max_hold_ms'], hold_ms)
+        self._idle.put(raw)
+
+    def close_idle(self):
+        """Close every idle connection (e.g. in a master before it forks)"""
+        while True:
+            try:
+                raw = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            raw.close()
+            with self._lock:
+                self._created -= 1
+
+    def reset(self):
+        """Forget every connection (e.g. in a freshly forked worker).
+
+        SQLite handles must not cross fork(), so the inherited ones are
+        abandoned rather than closed; new connections open lazily.
+        """
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._checked_out_at = {}
+
+    def stats(self) -> Dict:
+        """Snapshot of pool usage and checkout/wait timings"""
+        with self._lock:
+            stats = dict(self._stats)
+            checkouts = stats['checkouts'] or 1
+            stats['avg_wait_ms'] = stats['total_wait_ms'] / checkouts
+            stats['avg_hold_ms'] = stats['total_hold_ms'] / checkouts
+            stats['size'] = self._created
+            stats['max_size'] = self.max_size
+            stats['idle'] = self._idle.qsize()
+            stats['in_use'] = len(self._checked_out_at)
+        return stats
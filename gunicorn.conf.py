@@ -0,0 +1,48 @@
+"""
+Gunicorn settings, picked up automatically from the working directory
+With preload_app the master imports main:app and warms the ML/AI models
+once, then freezes the heap so forked workers share those pages
+copy-on-write. Worker memory is logged after fork, once the worker is
+ready and at exit, so the sharing can be checked (compare pss, not rss).
+
+SMARTROOF_PRELOAD=0 disables preloading; it is off by default under
+--reload, where workers must re-import changed code.
+"""
+import gc
+import os
+import sys
+
+preload_app = os.environ.get('SMARTROOF_PRELOAD', '0' if '--reload' in sys.argv else '1') == '1'
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    import database
+    from warmup import warm_models, freeze_heap, memory_usage, format_memory
+    before = memory_usage()
+    timings = warm_models()
+    # SQLite handles must not be inherited by workers
+    database.pool.close_idle()
+    frozen = freeze_heap()
+    server.log.info(f"Warmed models in master: {timings}")
+    server.log.info(f"Master memory before warmup: {format_memory(before)}")
+    server.log.info(f"Master memory after warmup: {format_memory(memory_usage())} "
+                    f"({frozen} objects frozen)")
+
+def pre_fork(server, worker):
+    # Objects created since the last fork (e.g. on worker respawn) stay shared too
+    gc.freeze()
+
+def post_fork(server, worker):
+    import database
+    from warmup import memory_usage, format_memory
+    database.pool.reset()
+    server.log.info(f"Worker {worker.pid} forked: {format_memory(memory_usage())}")
+
+def post_worker_init(worker):
+    from warmup import memory_usage, format_memory
+    worker.log.info(f"Worker {worker.pid} ready: {format_memory(memory_usage())}")
+
+def worker_exit(server, worker):
+    from warmup import memory_usage, format_memory
+    server.log.info(f"Worker {worker.pid} exiting: {format_memory(memory_usage())}")
@@ -0,0 +1,382 @@
+"""
+Gateway for OpenAI chat completions
+Calls go through one AsyncOpenAI client per process, driven by an event loop
+on a background thread, so HTTP keep-alive connections are reused across
+requests. Every call has a deadline, at most LLM_MAX_CONCURRENCY calls are
+in flight per process, and identical in-flight requests share one upstream
+call (single-flight).
+
+    python llm_gateway.py serve [--port 8099] [--delay 0.5]  -- fake OpenAI server
+    python llm_gateway.py check                               -- offline self-check
+"""
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+LLM_TIMEOUT = float(os.environ.get('SMARTROOF_LLM_TIMEOUT', 30))
+LLM_MAX_CONCURRENCY = int(os.environ.get('SMARTROOF_LLM_CONCURRENCY', 8))
+LLM_MAX_RETRIES = int(os.environ.get('SMARTROOF_LLM_RETRIES', 1))
+
+class LLMTimeoutError(TimeoutError):
+    """The call did not finish before its deadline"""
+
+class LLMGateway:
+    """Pooled, deadline-bound and coalescing access to chat completions"""
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY, timeout: float = LLM_TIMEOUT):
+        self.api_key = api_key or os.environ.get('OPENAI_API_KEY')
+        self.base_url = base_url or os.environ.get('OPENAI_BASE_URL')
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop = None
+        self._client = None
+        self._semaphore = None
+        self._inflight: Dict[str, list] = {}
+        self.stats = {'calls': 0, 'upstream': 0, 'coalesced': 0, 'timeouts': 0, 'errors': 0}
+
+    def _ensure_loop(self):
+        # The loop thread and the client's sockets do not survive fork()
+        with self._lock:
+            if self._pid == os.getpid() and self._loop is not None:
+                return self._loop
+            from openai import AsyncOpenAI
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='llm-gateway', daemon=True).start()
+
+            async def setup():
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                           timeout=self.timeout, max_retries=LLM_MAX_RETRIES)
+            asyncio.run_coroutine_threadsafe(setup(), loop).result()
+            self._inflight = {}
+            self._loop = loop
+            self._pid = os.getpid()
+            return loop
+
+    @staticmethod
+    def request_key(request: Dict) -> str:
+        payload = json.dumps(request, sort_keys=True, default=str)
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    async def _upstream(self, request: Dict, timeout: float) -> str:
+        async with self._semaphore:
+            self._count('upstream')
+            response = await self._client.chat.completions.create(timeout=timeout, **request)
+        return response.choices[0].message.content
+
+    async def _call(self, request: Dict, timeout: float) -> str:
+        key = self.request_key(request)
+        entry = self._inflight.get(key)
+        if entry is None:
+            # The shared call must outlive any waiter's deadline, so it runs
+            # under the gateway default; each caller's own wait_for below
+            # enforces that caller's deadline
+            task = asyncio.ensure_future(self._upstream(request, max(self.timeout, timeout)))
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(
+                lambda done: self._inflight.pop(key) if self._inflight.get(key, [None])[0] is done else None
+            )
+        else:
+            self._count('coalesced')
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            self._count('timeouts')
+            raise LLMTimeoutError(f"LLM call exceeded {timeout:.1f}s")
+        finally:
+            entry[1] -= 1
+            # Nobody is waiting any more: free the slot and the connection
+            if entry[1] == 0 and not task.done():
+                task.cancel()
+
+    def chat(self, messages: List[Dict], model: str = 'gpt-4o', timeout: Optional[float] = None,
+             **options) -> str:
+        """Message content of one chat completion; blocks the calling thread
+        for at most timeout seconds (default LLM_TIMEOUT)"""
+        timeout = self.timeout if timeout is None else timeout
+        request = dict(options, model=model, messages=messages)
+        loop = self._ensure_loop()
+        self._count('calls')
+        future = asyncio.run_coroutine_threadsafe(self._call(request, timeout), loop)
+        try:
+            # _call enforces the deadline; the margin only covers loop scheduling
+            return future.result(timeout + 1)
+        except LLMTimeoutError:
+            raise
+        except TimeoutError:
+            future.cancel()
+            self._count('timeouts')
+            raise LLMTimeoutError(f"LLM call exceeded {timeout:.1f}s")
+        except Exception:
+            self._count('errors')
+            raise
+
+    async def _stream(self, request: Dict, timeout: float, out: queue.Queue):
+        try:
+            async with self._semaphore:
+                self._count('upstream')
+                stream = await self._client.chat.completions.create(
+                    timeout=timeout, stream=True, **request
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        out.put(chunk.choices[0].delta.content)
+            out.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            out.put(e)
+
+    def stream_chat(self, messages: List[Dict], model: str = 'gpt-4o',
+                    timeout: Optional[float] = None, **options) -> Iterator[str]:
+        """Yield the completion's content as it arrives.
+
+        Streams are not coalesced. The whole stream shares one deadline;
+        LLMTimeoutError is raised when it passes, and the upstream request is
+        cancelled if the caller stops iterating early.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        request = dict(options, model=model, messages=messages)
+        loop = self._ensure_loop()
+        self._count('calls')
+        out = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._stream(request, timeout, out), loop)
+        try:
+            while True:
+                try:
+                    item = out.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    self._count('timeouts')
+                    raise LLMTimeoutError(f"LLM stream exceeded {timeout:.1f}s")
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    self._count('errors')
+                    raise item
+                yield item
+        finally:
+            if not future.done():
+                loop.call_soon_threadsafe(future.cancel)
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get_stats(self) -> Dict:
+        return dict(self.stats, in_flight=len(self._inflight), max_concurrency=self.max_concurrency)
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_llm_gateway() -> LLMGateway:
+    """Process-wide gateway, created on first use"""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = LLMGateway()
+    return _gateway
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers POST /v1/chat/completions with a canned roof calculation
+    after server.delay seconds"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.connections.add(self.client_address)
+        try:
+            time.sleep(server.delay)
+            content = json.dumps({
+                'materials_needed': {'bundles': 42},
+                'cost_estimate': {'material_cost': 3000, 'labor_cost': 2000, 'total_cost': 5000},
+                'recommendations': ['Fake upstream response'],
+                'confidence_score': 0.9
+            })
+            if body.get('stream'):
+                self._send_stream(body, content)
+                return
+            payload = json.dumps({
+                'id': f"chatcmpl-fake-{server.requests}",
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _send_stream(self, body, content, pieces=8):
+        """content as server-sent chat.completion.chunk events, chunked
+        transfer encoding, server.token_delay apart"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        size = max(1, len(content) // pieces + 1)
+        deltas = [content[i:i + size] for i in range(0, len(content), size)]
+        for i, delta in enumerate(deltas):
+            chunk = {
+                'id': f"chatcmpl-fake-{self.server.requests}",
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{'index': 0, 'delta': {'content': delta},
+                             'finish_reason': 'stop' if i == len(deltas) - 1 else None}]
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            time.sleep(self.server.token_delay)
+        self._write_chunk(b'data: [DONE]\n\n')
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def start_fake_server(port: int = 0, delay: float = 0.5) -> ThreadingHTTPServer:
+    """Fake OpenAI server on a background thread; its base URL is
+    f"http://127.0.0.1:{server.server_port}/v1" """
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.token_delay = 0.05
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.active = 0
+    server.max_active = 0
+    server.connections = set()
+    threading.Thread(target=server.serve_forever, name='fake-openai', daemon=True).start()
+    return server
+
+def self_check() -> bool:
+    """Validate coalescing, the concurrency bound, deadlines and connection
+    reuse against the fake server"""
+    from concurrent.futures import ThreadPoolExecutor
+    server = start_fake_server(delay=0.3)
+    gateway = LLMGateway(api_key='test', base_url=f"http://127.0.0.1:{server.server_port}/v1",
+                         max_concurrency=4, timeout=5)
+    messages = [{'role': 'user', 'content': 'same prompt'}]
+    ok = True
+
+    def report(name, passed, detail):
+        nonlocal ok
+        ok = ok and passed
+        print(f"{'PASS' if passed else 'FAIL'} {name}: {detail}")
+
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(lambda _: gateway.chat(messages), range(20)))
+        elapsed = time.perf_counter() - started
+    report('single-flight', server.requests == 1 and len(set(results)) == 1,
+           f"20 identical calls -> {server.requests} upstream request in {elapsed:.2f}s")
+
+    server.requests = 0
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        started = time.perf_counter()
+        list(pool.map(lambda i: gateway.chat([{'role': 'user', 'content': f"prompt {i}"}]), range(20)))
+        elapsed = time.perf_counter() - started
+    report('bounded concurrency', server.max_active <= 4 and server.requests == 20,
+           f"20 distinct calls, at most {server.max_active} in flight upstream, {elapsed:.2f}s")
+    report('connection reuse', len(server.connections) <= 4,
+           f"{server.requests + 1} requests over {len(server.connections)} connections")
+
+    server.delay = 2.0
+    started = time.perf_counter()
+    try:
+        gateway.chat([{'role': 'user', 'content': 'slow'}], timeout=0.5)
+        timed_out = False
+    except LLMTimeoutError:
+        timed_out = True
+    elapsed = time.perf_counter() - started
+    report('deadline', timed_out and elapsed < 1.0, f"2s upstream, 0.5s deadline -> returned after {elapsed:.2f}s")
+
+    # A short deadline opening a shared call must not cut it short for a
+    # patient caller that joins it
+    server.requests = 0
+    shared = [{'role': 'user', 'content': 'shared deadlines'}]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        impatient = pool.submit(gateway.chat, shared, timeout=0.5)
+        time.sleep(0.1)
+        patient = pool.submit(gateway.chat, shared, timeout=5)
+        try:
+            impatient.result()
+            impatient_timed_out = False
+        except LLMTimeoutError:
+            impatient_timed_out = True
+        try:
+            patient_ok = bool(patient.result())
+        except Exception as e:
+            patient_ok = False
+            logger.info(f"patient caller failed: {e!r}")
+    report('per-caller deadlines', impatient_timed_out and patient_ok and server.requests == 1,
+           f"0.5s and 5s callers on one 2s call -> 0.5s timed out, 5s "
+           f"{'succeeded' if patient_ok else 'failed'}, {server.requests} upstream request")
+
+    server.delay = 0.2
+    started = time.perf_counter()
+    first = None
+    deltas = []
+    for delta in gateway.stream_chat([{'role': 'user', 'content': 'stream'}]):
+        first = first or time.perf_counter() - started
+        deltas.append(delta)
+    elapsed = time.perf_counter() - started
+    report('streaming', len(deltas) > 1 and json.loads(''.join(deltas))['materials_needed'] == {'bundles': 42},
+           f"{len(deltas)} deltas, first after {first:.2f}s, complete after {elapsed:.2f}s")
+
+    print(f"stats: {gateway.get_stats()}")
+    server.shutdown()
+    return ok
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='LLM gateway tools')
+    parser.add_argument('command', choices=['serve', 'check'])
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--delay', type=float, default=0.5)
+    args = parser.parse_args()
+    if args.command == 'serve':
+        server = start_fake_server(args.port, args.delay)
+        print(f"Fake OpenAI server on http://127.0.0.1:{server.server_port}/v1 "
+              f"(set OPENAI_BASE_URL to use it)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        sys.exit(0 if self_check() else 1)
@@ -0,0 +1,668 @@
+"""
+Versioned schema migrations for the SQLite store
+Each migration runs once, in order, inside its own transaction and is
+recorded in the schema_version table. Every statement is idempotent so a
+database created before the migration table existed upgrades cleanly.
+"""
+import re
+import sqlite3
+import sys
+import logging
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+def _catalog_indexes(cursor):
+    """Indexes for filtered, sorted and keyset-paginated catalog listings"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_category_price ON products(category, price)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_category_name ON products(category, name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_price ON products(price)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_name ON products(name)')
+
+def _catalog_version(cursor):
+    """Catalog version, bumped on every product write so per-process caches
+    in every worker can tell when their copy of the catalog is stale"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO catalog_meta (id, version) VALUES (1, 0)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS products_version_{event.lower()}
+            AFTER {event} ON products
+            BEGIN
+                UPDATE catalog_meta SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+
+def _products_fts(cursor):
+    """Full-text index over the catalog, kept in sync with products by triggers"""
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description, category,
+            content='products', content_rowid='id',
+            tokenize='porter unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS products_fts_vocab USING fts5vocab(products_fts, 'row')")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name, description, category)
+            VALUES (new.id, new.name, new.description, new.category);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description, category)
+            VALUES ('delete', old.id, old.name, old.description, old.category);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description, category)
+            VALUES ('delete', old.id, old.name, old.description, old.category);
+            INSERT INTO products_fts (rowid, name, description, category)
+            VALUES (new.id, new.name, new.description, new.category);
+        END
+    ''')
+    cursor.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+def _cart_items_unique(cursor):
+    """One row per (user, product): merge duplicates, then enforce it"""
+    cursor.execute('''
+        UPDATE cart_items
+        SET quantity = (
+            SELECT SUM(c2.quantity) FROM cart_items c2
+            WHERE c2.user_id = cart_items.user_id AND c2.product_id = cart_items.product_id
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM cart_items
+            GROUP BY user_id, product_id HAVING COUNT(*) > 1
+        )
+    ''')
+    cursor.execute('''
+        DELETE FROM cart_items
+        WHERE id NOT IN (SELECT MIN(id) FROM cart_items GROUP BY user_id, product_id)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_items_user_product
+        ON cart_items(user_id, product_id)
+    ''')
+
+def _order_and_review_indexes(cursor):
+    """Indexes for per-user order history, admin listings and review lookups"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reviews_product_created ON reviews(product_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reviews_user ON reviews(user_id)')
+
+def _store_stats(cursor):
+    """Dashboard totals maintained incrementally by triggers on every write"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS store_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            total_products INTEGER NOT NULL DEFAULT 0,
+            total_orders INTEGER NOT NULL DEFAULT 0,
+            total_revenue REAL NOT NULL DEFAULT 0,
+            refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO store_stats
+        (id, total_users, total_products, total_orders, total_revenue, refreshed_at)
+        VALUES (1,
+            (SELECT COUNT(*) FROM users),
+            (SELECT COUNT(*) FROM products),
+            (SELECT COUNT(*) FROM orders),
+            (SELECT COALESCE(SUM(total), 0) FROM orders),
+            CURRENT_TIMESTAMP)
+    ''')
+    for table, column in (('users', 'total_users'), ('products', 'total_products')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_stats_insert AFTER INSERT ON {table} BEGIN
+                UPDATE store_stats SET {column} = {column} + 1 WHERE id = 1;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_stats_delete AFTER DELETE ON {table} BEGIN
+                UPDATE store_stats SET {column} = {column} - 1 WHERE id = 1;
+            END
+        ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_stats_insert AFTER INSERT ON orders BEGIN
+            UPDATE store_stats
+            SET total_orders = total_orders + 1, total_revenue = total_revenue + new.total
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_stats_delete AFTER DELETE ON orders BEGIN
+            UPDATE store_stats
+            SET total_orders = total_orders - 1, total_revenue = total_revenue - old.total
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_stats_update AFTER UPDATE OF total ON orders BEGIN
+            UPDATE store_stats
+            SET total_revenue = total_revenue - old.total + new.total
+            WHERE id = 1;
+        END
+    ''')
+
+def _sales_rollups(cursor):
+    """Daily revenue, per-product sales and review sentiment rollups.
+
+    Triggers on orders expand the items JSON with json_each, so reports never
+    have to deserialize orders in Python.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_sales (
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_product_sales (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_sales (
+            product_id INTEGER PRIMARY KEY,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS review_sentiment_counts (
+            sentiment TEXT PRIMARY KEY,
+            reviews INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_sales_revenue ON product_sales(revenue)')
+
+    # Rebuild from existing data, then keep current with triggers
+    for table in ('daily_sales', 'daily_product_sales', 'product_sales', 'review_sentiment_counts'):
+        cursor.execute(f'DELETE FROM {table}')
+    cursor.execute('''
+        INSERT INTO daily_sales (day, orders, revenue)
+        SELECT date(created_at), COUNT(*), SUM(total) FROM orders GROUP BY date(created_at)
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_product_sales (day, product_id, quantity, revenue)
+        SELECT date(o.created_at), json_extract(i.value, '$.product_id'),
+               SUM(json_extract(i.value, '$.quantity')), SUM(json_extract(i.value, '$.subtotal'))
+        FROM orders o, json_each(CASE WHEN json_valid(o.items) THEN o.items ELSE '[]' END) i
+        WHERE json_extract(i.value, '$.product_id') IS NOT NULL
+        GROUP BY 1, 2
+    ''')
+    cursor.execute('''
+        INSERT INTO product_sales (product_id, quantity, revenue)
+        SELECT product_id, SUM(quantity), SUM(revenue) FROM daily_product_sales GROUP BY product_id
+    ''')
+    cursor.execute('''
+        INSERT INTO review_sentiment_counts (sentiment, reviews)
+        SELECT sentiment, COUNT(*) FROM reviews WHERE sentiment IS NOT NULL GROUP BY sentiment
+    ''')
+
+    def apply_order(row, sign):
+        # SQL applying one order row ('new' or 'old') to the rollups
+        items = f"json_each(CASE WHEN json_valid({row}.items) THEN {row}.items ELSE '[]' END)"
+        return f'''
+            INSERT INTO daily_sales (day, orders, revenue)
+            VALUES (date({row}.created_at), {sign}1, {sign}{row}.total)
+            ON CONFLICT (day) DO UPDATE SET
+                orders = orders + excluded.orders, revenue = revenue + excluded.revenue;
+            INSERT INTO daily_product_sales (day, product_id, quantity, revenue)
+            SELECT date({row}.created_at), json_extract(value, '$.product_id'),
+                   {sign}json_extract(value, '$.quantity'), {sign}json_extract(value, '$.subtotal')
+            FROM {items} WHERE json_extract(value, '$.product_id') IS NOT NULL
+            ON CONFLICT (day, product_id) DO UPDATE SET
+                quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue;
+            INSERT INTO product_sales (product_id, quantity, revenue)
+            SELECT json_extract(value, '$.product_id'),
+                   {sign}json_extract(value, '$.quantity'), {sign}json_extract(value, '$.subtotal')
+            FROM {items} WHERE json_extract(value, '$.product_id') IS NOT NULL
+            ON CONFLICT (product_id) DO UPDATE SET
+                quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue;
+        '''
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS orders_rollup_insert AFTER INSERT ON orders BEGIN
+            {apply_order('new', '+')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS orders_rollup_delete AFTER DELETE ON orders BEGIN
+            {apply_order('old', '-')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS orders_rollup_update
+        AFTER UPDATE OF items, total, created_at ON orders BEGIN
+            {apply_order('old', '-')}
+            {apply_order('new', '+')}
+        END
+    ''')
+
+    def count_sentiment(row, sign):
+        return f'''
+            INSERT INTO review_sentiment_counts (sentiment, reviews)
+            SELECT {row}.sentiment, {sign}1 WHERE {row}.sentiment IS NOT NULL
+            ON CONFLICT (sentiment) DO UPDATE SET reviews = reviews + excluded.reviews;
+        '''
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS reviews_sentiment_insert AFTER INSERT ON reviews BEGIN
+            {count_sentiment('new', '+')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS reviews_sentiment_delete AFTER DELETE ON reviews BEGIN
+            {count_sentiment('old', '-')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS reviews_sentiment_update AFTER UPDATE OF sentiment ON reviews BEGIN
+            {count_sentiment('old', '-')}
+            {count_sentiment('new', '+')}
+        END
+    ''')
+
+def _order_items(cursor):
+    """Normalized order lines, written with the order; see backfills.py for
+    existing orders"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            product_name TEXT,
+            quantity INTEGER NOT NULL,
+            price REAL NOT NULL,
+            subtotal REAL NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders(id),
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)')
+    # Covering indexes: per-product and per-user sales never touch the table
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_items_product_sales
+        ON order_items(product_id, quantity, subtotal)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_items_user_sales
+        ON order_items(user_id, product_id, quantity, subtotal)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_state (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_items_delete AFTER DELETE ON orders BEGIN
+            DELETE FROM order_items WHERE order_id = old.id;
+        END
+    ''')
+
+def _payments(cursor):
+    """Payment attempts, settled asynchronously by payments.py"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            provider TEXT NOT NULL,
+            phone TEXT,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            reference TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_order ON payments(order_id)')
+
+def _cart_counts(cursor):
+    """Per-user cart quantity, so the navbar badge is a primary-key read.
+
+    version changes on every cart write and serves as the ETag of
+    /api/cart/count.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cart_counts (
+            user_id INTEGER PRIMARY KEY,
+            items INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('DELETE FROM cart_counts')
+    cursor.execute('''
+        INSERT INTO cart_counts (user_id, items, version)
+        SELECT user_id, SUM(quantity), 1 FROM cart_items GROUP BY user_id
+    ''')
+
+    def apply_line(row, sign):
+        return f'''
+            INSERT INTO cart_counts (user_id, items, version)
+            VALUES ({row}.user_id, {sign}{row}.quantity, 1)
+            ON CONFLICT (user_id) DO UPDATE SET
+                items = items + excluded.items, version = version + 1;
+        '''
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cart_items_count_insert AFTER INSERT ON cart_items BEGIN
+            {apply_line('new', '+')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cart_items_count_delete AFTER DELETE ON cart_items BEGIN
+            {apply_line('old', '-')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cart_items_count_update
+        AFTER UPDATE OF user_id, quantity ON cart_items BEGIN
+            {apply_line('old', '-')}
+            {apply_line('new', '+')}
+        END
+    ''')
+
+def _product_similar(cursor):
+    """Precomputed similar products, written by the recommender (ml_models)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_similar (
+            product_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            similar_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (product_id, rank)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_similar_similar ON product_similar(similar_id)')
+    # A deleted product disappears from every list at once
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_similar_delete AFTER DELETE ON products BEGIN
+            DELETE FROM product_similar WHERE product_id = old.id OR similar_id = old.id;
+        END
+    ''')
+
+def _customer_segments(cursor):
+    """RFM customer segments written by ml_models.CustomerSegmentation.
+
+    Order triggers bump a per-user version in customer_segments_stale, so a
+    refresh only recomputes customers whose orders changed and never drops a
+    mark made while it was running.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customer_segments (
+            user_id INTEGER PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            total_spent REAL NOT NULL,
+            avg_order_value REAL NOT NULL,
+            last_order_at TIMESTAMP,
+            recency_days INTEGER NOT NULL,
+            segment TEXT NOT NULL,
+            cluster TEXT,
+            refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_customer_segments_segment ON customer_segments(segment)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customer_segments_stale (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO customer_segments_stale (user_id)
+        SELECT DISTINCT user_id FROM orders
+    ''')
+
+    def mark(row):
+        return f'''
+            INSERT INTO customer_segments_stale (user_id) VALUES ({row}.user_id)
+            ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+        '''
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS orders_segments_insert AFTER INSERT ON orders BEGIN
+            {mark('new')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS orders_segments_delete AFTER DELETE ON orders BEGIN
+            {mark('old')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS orders_segments_update
+        AFTER UPDATE OF user_id, total, created_at ON orders BEGIN
+            {mark('old')}
+            {mark('new')}
+        END
+    ''')
+
+def _ai_calculation_cache(cursor):
+    """Shared tier of the AI roof calculation cache (ai_roof_calculator)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ai_calculation_cache (
+            cache_key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_calculation_cache_expires ON ai_calculation_cache(expires_at)')
+
+def _unsettled_payments_index(cursor):
+    """Lets the payment recovery sweep find stale unsettled payments
+    without scanning settled ones"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_unsettled ON payments(updated_at)
+        WHERE status IN ('pending', 'processing')
+    ''')
+
+def _nullable_payment_order(cursor):
+    """A failed payment's order is deleted, so payments.order_id must be
+    nullable; SQLite cannot drop NOT NULL in place, so the table is rebuilt"""
+    cursor.execute('''
+        CREATE TABLE payments_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            user_id INTEGER NOT NULL,
+            provider TEXT NOT NULL,
+            phone TEXT,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            reference TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Payments that already point at a deleted order lose the reference
+    cursor.execute('''
+        INSERT INTO payments_new
+        SELECT p.id, o.id, p.user_id, p.provider, p.phone, p.amount, p.status,
+               p.reference, p.error, p.created_at, p.updated_at
+        FROM payments p LEFT JOIN orders o ON o.id = p.order_id
+    ''')
+    cursor.execute('DROP TABLE payments')
+    cursor.execute('ALTER TABLE payments_new RENAME TO payments')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_order ON payments(order_id)')
+    _unsettled_payments_index(cursor)
+
+def _category_listing_index(cursor):
+    """Category pages in id order (the default and newest sorts); the index
+    ends with the rowid, so it serves both the filter and the order"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)')
+
+# (version, description, function) -- append only, never renumber
+MIGRATIONS = [
+    (1, 'catalog indexes', _catalog_indexes),
+    (2, 'catalog version counter', _catalog_version),
+    (3, 'products full-text index', _products_fts),
+    (4, 'unique cart line per user and product', _cart_items_unique),
+    (5, 'order and review indexes', _order_and_review_indexes),
+    (6, 'incremental dashboard totals', _store_stats),
+    (7, 'sales and sentiment rollups', _sales_rollups),
+    (8, 'normalized order items', _order_items),
+    (9, 'asynchronous payments', _payments),
+    (10, 'per-user cart counts', _cart_counts),
+    (11, 'precomputed similar products', _product_similar),
+    (12, 'customer segments', _customer_segments),
+    (13, 'AI calculation cache', _ai_calculation_cache),
+    (14, 'unsettled payments index', _unsettled_payments_index),
+    (15, 'nullable payment order', _nullable_payment_order),
+    (16, 'category listing index', _category_listing_index),
+]
+
+def get_schema_version(conn) -> int:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def migrate(conn) -> int:
+    """Apply pending migrations in order; returns the resulting version"""
+    conn.commit()
+    current = get_schema_version(conn)
+    conn.commit()
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            # Another process may have applied it while we waited for the lock
+            if conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone():
+                conn.rollback()
+                continue
+            apply(cursor)
+            cursor.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (version, description)
+            )
+            conn.commit()
+            logger.info(f"Applied migration {version}: {description}")
+        except Exception:
+            conn.rollback()
+            logger.error(f"Migration {version} ({description}) failed")
+            raise
+        current = version
+    return current
+
+def hot_queries(conn) -> Dict[str, Tuple[str, tuple]]:
+    """name -> (sql, sample params) for every hot statement, taken from the
+    constants and query builders the application itself executes, so a
+    change to a query is plan-checked as written"""
+    import models
+    import catalog
+    import reports
+    import payments
+    import ml_models
+    import ai_roof_calculator
+
+    queries = {
+        'product_by_id': (models.PRODUCT_BY_ID_SQL, (1,)),
+        'user_by_id': (models.USER_BY_ID_SQL, (1,)),
+        'user_by_email': (models.USER_BY_EMAIL_SQL, ('admin@smartroof.com',)),
+        'cart_load': (models.CART_LOAD_SQL, (1,)),
+        'cart_count': (models.CART_COUNT_SQL, (1,)),
+        'cart_add': (models.CART_ADD_SQL, (1, 1, 1)),
+        'cart_line_update': (models.CART_LINE_UPDATE_SQL, (1, 1, 1)),
+        'cart_line_delete': (models.CART_LINE_DELETE_SQL, (1, 1)),
+        'autocomplete': (catalog.AUTOCOMPLETE_SQL, ('"roof"*', catalog.AUTOCOMPLETE_LIMIT)),
+        'similar_products': (catalog.SIMILAR_PRODUCTS_SQL, (1, 4)),
+        'recent_orders': (reports.RECENT_ORDERS_SQL, (reports.RECENT_ORDERS_LIMIT,)),
+        'revenue_by_period': (reports.REVENUE_BY_PERIOD_SQL, (reports.REVENUE_PERIODS['month'], 12)),
+        'product_sales_report': (reports.PRODUCT_SALES_REPORT_SQL, (50,)),
+        'stale_payments': (payments.STALE_PAYMENTS_SQL, ('-300 seconds',)),
+        'segment_counts': (ml_models.SEGMENT_COUNTS_SQL, ()),
+        'ai_calculation_cache': (ai_roof_calculator.CACHE_LOOKUP_SQL, ('key', 0)),
+    }
+
+    # Every catalog listing the products page can request: each sort, with
+    # and without a category, a search and a next-page cursor
+    cursors = {None: [1], 'price': [1.0, 1], 'name': ['a', 1], 'rank': [-1.0, 1]}
+    for sort, (column, _) in catalog.SORT_OPTIONS.items():
+        match = '"roof"' if sort == 'relevance' else None
+        for category in ('', 'Tiles'):
+            for after in (None, cursors[column]):
+                name = '_'.join(part for part in (
+                    'catalog', sort, category and 'category', after and 'next') if part)
+                queries[name] = catalog.catalog_query(sort, match, category, after, catalog.DEFAULT_PAGE_SIZE + 1)
+        if sort != 'relevance':
+            queries[f'catalog_{sort}_search'] = catalog.catalog_query(
+                sort, '"roof"', '', None, catalog.DEFAULT_PAGE_SIZE + 1)
+
+    # Admin order listing and export, unfiltered and with each filter
+    for name, filters in (('', reports.OrderFilters()),
+                          ('_status', reports.OrderFilters(status='completed')),
+                          ('_dates', reports.OrderFilters(date_from='2024-01-01', date_to='2024-12-31')),
+                          ('_user', reports.OrderFilters(user='1'))):
+        for suffix, after in (('', None), ('_next', ['2024-06-01 00:00:00', 1])):
+            queries[f'orders_page{name}{suffix}'] = reports.orders_query(
+                conn, filters, after, reports.ORDERS_PAGE_SIZE + 1, with_items=False)
+    return queries
+
+# (query name pattern, plan step, why it stays bounded): the only scans and
+# temporary sorts check_query_plans accepts
+ACCEPTED_PLAN_STEPS = [
+    (r'catalog_(default|newest)', 'SCAN p',
+     'walks the primary key in order and stops after one page'),
+    (r'catalog_relevance.*|catalog_\w+_search|autocomplete', 'USE TEMP B-TREE FOR ORDER BY',
+     'sorts only the full-text matches; bm25 rank has no index'),
+    (r'revenue_by_period', 'SCAN daily_sales', 'rollup with one row per day'),
+    (r'revenue_by_period', 'USE TEMP B-TREE FOR GROUP BY', 'periods are computed from the day'),
+]
+
+def _accepted_plan_step(name: str, detail: str) -> bool:
+    return any(re.fullmatch(pattern, name) and detail == step
+               for pattern, step, _ in ACCEPTED_PLAN_STEPS)
+
+def check_query_plans(conn) -> List[Tuple[str, str]]:
+    """EXPLAIN QUERY PLAN every hot query; returns (name, plan step) for any
+    full table scan or temporary sort not in ACCEPTED_PLAN_STEPS"""
+    regressions = []
+    for name, (sql, params) in hot_queries(conn).items():
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall():
+            detail = row[3]
+            full_scan = (detail.startswith('SCAN') and 'USING' not in detail
+                         and 'VIRTUAL TABLE' not in detail)
+            if (full_scan or 'TEMP B-TREE' in detail) and not _accepted_plan_step(name, detail):
+                regressions.append((name, detail))
+    return regressions
+
+if __name__ == '__main__':
+    # python migrations.py [database] -- migrate, then fail on plan regressions
+    from database import DATABASE_PATH
+    conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else DATABASE_PATH)
+    print(f"Schema version: {migrate(conn)}")
+    regressions = check_query_plans(conn)
+    for name, detail in regressions:
+        print(f"REGRESSION {name}: {detail}")
+    conn.close()
+    sys.exit(1 if regressions else 0)
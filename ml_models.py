@@ -1,22 +1,43 @@
-import numpy as np
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.naive_bayes import MultinomialNB
-from sklearn.cluster import KMeans
-from sklearn.metrics.pairwise import cosine_similarity
-import nltk
-from nltk.sentiment import SentimentIntensityAnalyzer
+"""
+Machine learning helpers for the storefront
+Heavy libraries (sklearn, nltk) are imported inside the models that
+need them, and the module-level model singletons are built on first access,
+so importing this module is cheap.
+"""
+import os
+import math
+import hashlib
+import heapq
+import pickle
+import threading
 import re
-from collections import Counter
+import logging
+from collections import Counter, OrderedDict, deque
 
-# Download required NLTK data
-try:
-    nltk.data.find('vader_lexicon')
-except LookupError:
-    nltk.download('vader_lexicon')
+logger = logging.getLogger(__name__)
+
+# Persisted similar-products index (see ProductRecommender)
+RECOMMENDER_INDEX_PATH = os.environ.get('SMARTROOF_RECOMMENDER_INDEX', 'recommender_index.pkl')
+RECOMMENDER_INDEX_FORMAT = 1
+RECOMMENDER_TOP_K = 8
+# Rows per sparse similarity block in fit()
+RECOMMENDER_BLOCK_SIZE = 512
+# Share of the catalog that may change before update() falls back to fit()
+RECOMMENDER_REFIT_FRACTION = 0.25
+
+_TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
+
+def _ensure_vader_lexicon():
+    import nltk
+    try:
+        nltk.data.find('sentiment/vader_lexicon.zip')
+    except LookupError:
+        nltk.download('vader_lexicon')
 
 class SentimentAnalyzer:
     def __init__(self):
+        from nltk.sentiment import SentimentIntensityAnalyzer
+        _ensure_vader_lexicon()
         self.analyzer = SentimentIntensityAnalyzer()
     
     def analyze_sentiment(self, text):
@@ -30,122 +51,493 @@ class SentimentAnalyzer:
             return 'negative', compound
         else:
             return 'neutral', compound
+    
+    def analyze_many(self, texts):
+        """analyze_sentiment for a batch of texts, in order"""
+        polarity_scores = self.analyzer.polarity_scores
+        results = []
+        for text in texts:
+            compound = polarity_scores(text)['compound']
+            if compound >= 0.05:
+                results.append(('positive', compound))
+            elif compound <= -0.05:
+                results.append(('negative', compound))
+            else:
+                results.append(('neutral', compound))
+        return results
+
+def _fingerprint(text):
+    # Stable across processes, unlike hash()
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+def _recommender_terms(text):
+    """Tokens as TfidfVectorizer(stop_words='english') would produce them"""
+    from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+    return [t for t in _TOKEN_PATTERN.findall(text.lower()) if t not in ENGLISH_STOP_WORDS]
 
 class ProductRecommender:
-    def __init__(self):
-        self.vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-        self.product_features = None
-        self.products = None
+    """Content-based similar products over an incrementally maintained
+    TF-IDF index.
+
+    The index holds per-product term counts, document frequencies, an
+    inverted index and each product's top-k neighbours. fit() builds it from
+    scratch, update() re-indexes only the products that were added, changed
+    or removed, and get_similar_products() is a dict lookup. The index is
+    persisted with save()/load(); vectors and postings are rebuilt on load.
+    """
     
-    def fit(self, products):
-        """Fit the recommender with product data"""
-        self.products = products
-        descriptions = [f"{p.name} {p.description} {p.category}" for p in products.values()]
-        self.product_features = self.vectorizer.fit_transform(descriptions)
+    def __init__(self, top_k=RECOMMENDER_TOP_K):
+        self.top_k = top_k
+        self.vocabulary = {}      # term -> column
+        self.df = Counter()       # column -> number of products containing it
+        self.term_counts = {}     # product id -> {column: count}
+        self.fingerprints = {}    # product id -> hash of the indexed text
+        self.neighbors = {}       # product id -> [(product id, score)], best first
+        self.changes_since_fit = 0
+        self.catalog_version = None
+        self._lock = threading.RLock()
+        self._postings = {}       # column -> set of product ids
+        self._vectors = {}        # product id -> {column: L2-normalized weight}
+        self._changed_lists = set()  # ids whose neighbours changed since sync()
     
-    def get_similar_products(self, product_id, num_recommendations=4):
-        """Get similar products based on content similarity"""
-        if not self.product_features:
-            return []
+    @staticmethod
+    def _text(product):
+        return f"{product.name} {product.description} {product.category}"
+    
+    def _idf(self, column):
+        # Smoothed idf, as in sklearn's TfidfTransformer
+        n = len(self.term_counts)
+        return math.log((1 + n) / (1 + self.df[column])) + 1
+    
+    def _vectorize(self, product_id):
+        weights = {col: count * self._idf(col) for col, count in self.term_counts[product_id].items()}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        self._vectors[product_id] = {col: w / norm for col, w in weights.items()}
+    
+    def _add(self, product_id, text):
+        counts = Counter()
+        for term in _recommender_terms(text):
+            counts[self.vocabulary.setdefault(term, len(self.vocabulary))] += 1
+        self.term_counts[product_id] = dict(counts)
+        self.fingerprints[product_id] = _fingerprint(text)
+        for col in counts:
+            self.df[col] += 1
+            self._postings.setdefault(col, set()).add(product_id)
+    
+    def _remove(self, product_id):
+        for col in self.term_counts.pop(product_id, {}):
+            self.df[col] -= 1
+            self._postings[col].discard(product_id)
+        self.fingerprints.pop(product_id, None)
+        self.neighbors.pop(product_id, None)
+        self._vectors.pop(product_id, None)
+    
+    def _scores(self, product_id):
+        """Cosine similarity to every product sharing a term, via the postings"""
+        scores = {}
+        for col, weight in self._vectors[product_id].items():
+            for other in self._postings[col]:
+                if other != product_id:
+                    scores[other] = scores.get(other, 0.0) + weight * self._vectors[other][col]
+        return scores
+    
+    def _top_k(self, scores):
+        # Ties go to the lower product id, so results are deterministic
+        best = heapq.nlargest(self.top_k, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [(pid, round(score, 6)) for pid, score in best if score > 0]
+    
+    def _matrix(self):
+        """(row ids, CSR matrix of the normalized vectors, one row per product)"""
+        from scipy.sparse import csr_matrix
+        ids = sorted(self._vectors)
+        indptr, indices, data = [0], [], []
+        for product_id in ids:
+            vector = self._vectors[product_id]
+            indices.extend(vector.keys())
+            data.extend(vector.values())
+            indptr.append(len(indices))
+        matrix = csr_matrix((data, indices, indptr), shape=(len(ids), len(self.vocabulary)))
+        return ids, matrix
+    
+    def _blocked_neighbors(self, block_size):
+        """Top-k neighbours of every product, block_size rows at a time.
         
-        product_idx = list(self.products.keys()).index(product_id)
-        similarity_scores = cosine_similarity(
-            self.product_features[product_idx:product_idx+1], 
-            self.product_features
-        ).flatten()
+        Each block multiplies block_size rows by the transposed matrix, so
+        memory is bounded by block_size x n (sparse), never n x n.
+        """
+        import numpy as np
+        ids, matrix = self._matrix()
+        id_array = np.array(ids)
+        transposed = matrix.T.tocsr()
+        neighbors = {}
+        for start in range(0, len(ids), block_size):
+            block = (matrix[start:start + block_size] @ transposed).tocsr()
+            for offset in range(block.shape[0]):
+                row = slice(block.indptr[offset], block.indptr[offset + 1])
+                columns, scores = block.indices[row], block.data[row]
+                keep = columns != start + offset
+                columns, scores = columns[keep], scores[keep]
+                if len(scores) > self.top_k:
+                    best = np.argpartition(-scores, self.top_k - 1)[:self.top_k]
+                    columns, scores = columns[best], scores[best]
+                neighbors[ids[start + offset]] = self._top_k(
+                    {int(pid): float(score) for pid, score in zip(id_array[columns], scores)}
+                )
+        return neighbors
+    
+    def fit(self, products, block_size=RECOMMENDER_BLOCK_SIZE):
+        """Build the index from scratch for {product id: Product}"""
+        with self._lock:
+            previous = set(self.term_counts)
+            self.vocabulary, self.df, self.term_counts, self.fingerprints = {}, Counter(), {}, {}
+            self._postings, self._vectors = {}, {}
+            for product_id, product in products.items():
+                self._add(product_id, self._text(product))
+            for product_id in self.term_counts:
+                self._vectorize(product_id)
+            self.neighbors = self._blocked_neighbors(block_size)
+            self.changes_since_fit = 0
+            self._changed_lists |= previous | set(self.neighbors)
+    
+    def update(self, products):
+        """Re-index only the products added, changed or removed since the last
+        fit/update. Returns the number of products re-indexed.
         
-        # Get indices of most similar products (excluding the product itself)
-        similar_indices = similarity_scores.argsort()[-num_recommendations-1:-1][::-1]
-        product_ids = list(self.products.keys())
+        Document frequencies drift as products change; once more than
+        RECOMMENDER_REFIT_FRACTION of the catalog has changed, the index is
+        rebuilt so every weight reflects current frequencies again.
+        """
+        with self._lock:
+            texts = {pid: self._text(p) for pid, p in products.items()}
+            removed = set(self.term_counts) - set(texts)
+            changed = {pid for pid, text in texts.items() if self.fingerprints.get(pid) != _fingerprint(text)}
+            if not removed and not changed:
+                return 0
+            
+            self.changes_since_fit += len(removed) + len(changed)
+            if self.changes_since_fit > RECOMMENDER_REFIT_FRACTION * max(len(texts), 1):
+                self.fit(products)
+                return len(removed) + len(changed)
+            
+            touched = removed | changed
+            self._changed_lists |= touched
+            for pid in touched:
+                self._remove(pid)
+            for pid in changed:
+                self._add(pid, texts[pid])
+            for pid in changed:
+                self._vectorize(pid)
+            
+            # Lists that referenced a touched product are recomputed in full
+            stale = {pid for pid, similar in self.neighbors.items()
+                     if any(other in touched for other, _ in similar)}
+            for pid in changed:
+                scores = self._scores(pid)
+                self.neighbors[pid] = self._top_k(scores)
+                # Similarity is symmetric: offer pid to every product it scored against
+                for other, score in scores.items():
+                    if other in changed or other in stale:
+                        continue
+                    similar = self.neighbors.get(other, [])
+                    if len(similar) < self.top_k or score > similar[-1][1]:
+                        candidates = dict(similar)
+                        candidates[pid] = score
+                        self.neighbors[other] = self._top_k(candidates)
+                        self._changed_lists.add(other)
+            for pid in stale - changed:
+                self.neighbors[pid] = self._top_k(self._scores(pid))
+            self._changed_lists |= stale
+            return len(touched)
+    
+    def sync(self, products, catalog_version):
+        """Update the index to catalog_version and persist it, if it lags.
         
-        return [product_ids[i] for i in similar_indices if product_ids[i] != product_id]
+        Returns the ids whose neighbour lists changed since the last sync.
+        """
+        if catalog_version == self.catalog_version:
+            return set()
+        with self._lock:
+            if catalog_version == self.catalog_version:
+                return set()
+            self.update(products)
+            self.catalog_version = catalog_version
+            try:
+                self.save()
+            except OSError as e:
+                # The in-memory index is still current; only persistence failed
+                logger.warning(f"Could not save recommender index: {e}")
+            changed, self._changed_lists = self._changed_lists, set()
+            return changed
+    
+    def get_similar_products(self, product_id, num_recommendations=4):
+        """Ids of the most similar products, best first"""
+        return [pid for pid, _ in self.neighbors.get(product_id, [])[:num_recommendations]]
+    
+    def save(self, path=None):
+        """Atomically write the index to path (RECOMMENDER_INDEX_PATH)"""
+        path = path or RECOMMENDER_INDEX_PATH
+        state = {
+            'format': RECOMMENDER_INDEX_FORMAT,
+            'top_k': self.top_k,
+            'vocabulary': self.vocabulary,
+            'df': dict(self.df),
+            'term_counts': self.term_counts,
+            'fingerprints': self.fingerprints,
+            'neighbors': self.neighbors,
+            'changes_since_fit': self.changes_since_fit,
+            'catalog_version': self.catalog_version,
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(cls, path=None):
+        """Index saved by save(), or an empty one if missing or incompatible"""
+        recommender = cls()
+        try:
+            with open(path or RECOMMENDER_INDEX_PATH, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return recommender
+        if state.get('format') != RECOMMENDER_INDEX_FORMAT or state.get('top_k') != recommender.top_k:
+            return recommender
+        recommender.vocabulary = state['vocabulary']
+        recommender.df = Counter(state['df'])
+        recommender.term_counts = state['term_counts']
+        recommender.fingerprints = state['fingerprints']
+        recommender.neighbors = state['neighbors']
+        recommender.changes_since_fit = state['changes_since_fit']
+        recommender.catalog_version = state['catalog_version']
+        for product_id, counts in recommender.term_counts.items():
+            for col in counts:
+                recommender._postings.setdefault(col, set()).add(product_id)
+        for product_id in recommender.term_counts:
+            recommender._vectorize(product_id)
+        return recommender
+
+# Checked by migrations.hot_queries(); served by idx_customer_segments_segment
+SEGMENT_COUNTS_SQL = 'SELECT segment, COUNT(*) AS customers FROM customer_segments GROUP BY segment'
 
 class CustomerSegmentation:
+    """RFM segments computed with one SQL aggregate over orders and NumPy
+    rules, stored in customer_segments (see migrations).
+
+    refresh() only recomputes customers whose orders changed since the last
+    refresh. The admin pages only read the table and ask a background thread
+    for that refresh, so a new order shows up on the next page load. Recency
+    keeps moving without new orders, so run a full refresh periodically:
+    python backfills.py customer_segments
+    """
+    # Fewer customers than this are all labelled "New Customer"
+    MIN_CUSTOMERS = 3
+    DEFAULT_SEGMENT = "Standard Customer"
+    
     def __init__(self):
-        self.kmeans = KMeans(n_clusters=3, random_state=42, n_init=10)
+        # Fitted by refresh(clusters=True); sklearn is only imported then
+        self.kmeans = None
+        self._cluster_names = {}
+        self._lock = threading.Lock()
+        self._refresh_pid = None
+        self._refresh_wanted = None
         self.segments = {
             0: "Budget Conscious",
             1: "Premium Buyers", 
             2: "Bulk Purchasers"
         }
     
-    def segment_customers(self, orders):
-        """Enhanced customer segmentation based on RFM analysis and purchase behavior"""
-        if not orders:
-            return {}
-        
-        import datetime
-        current_date = datetime.datetime.now()
-        
-        # Create customer features with RFM analysis
-        customer_data = {}
-        for order in orders.values():
-            user_id = order.user_id
-            if user_id not in customer_data:
-                customer_data[user_id] = {
-                    'total_spent': 0,
-                    'num_orders': 0,
-                    'avg_order_value': 0,
-                    'last_order_date': None,
-                    'recency_days': 0
-                }
-            
-            customer_data[user_id]['total_spent'] += order.total
-            customer_data[user_id]['num_orders'] += 1
-            
-            # Parse order date for recency calculation
-            try:
-                if hasattr(order, 'created_at'):
-                    if isinstance(order.created_at, str):
-                        order_date = datetime.datetime.fromisoformat(order.created_at.replace('Z', '+00:00'))
-                    else:
-                        order_date = order.created_at
-                    
-                    if customer_data[user_id]['last_order_date'] is None or order_date > customer_data[user_id]['last_order_date']:
-                        customer_data[user_id]['last_order_date'] = order_date
-            except:
-                # Default to current date if parsing fails
-                customer_data[user_id]['last_order_date'] = current_date
-        
-        # Calculate derived metrics
-        for user_id in customer_data:
-            data = customer_data[user_id]
-            data['avg_order_value'] = data['total_spent'] / data['num_orders']
+    def rfm_features(self, conn, stale_only=False):
+        """Recency/frequency/monetary columns per customer, as NumPy arrays;
+        stale_only limits them to customers in customer_segments_stale"""
+        import numpy as np
+        # A subquery rather than bound ids: the stale set can be every
+        # customer, far past SQLite's limit on bound variables
+        where = 'WHERE user_id IN (SELECT user_id FROM customer_segments_stale)' if stale_only else ''
+        rows = conn.execute(f'''
+            SELECT user_id, COUNT(*), SUM(total), MAX(created_at),
+                   COALESCE(CAST(julianday('now') - julianday(MAX(created_at)) AS INTEGER), 365)
+            FROM orders {where}
+            GROUP BY user_id
+        ''').fetchall()
+        columns = list(zip(*rows)) if rows else [(), (), (), (), ()]
+        num_orders = np.array(columns[1], dtype=np.int64)
+        total_spent = np.array(columns[2], dtype=np.float64)
+        return {
+            'user_id': np.array(columns[0], dtype=np.int64),
+            'num_orders': num_orders,
+            'total_spent': total_spent,
+            'avg_order_value': total_spent / np.maximum(num_orders, 1),
+            'last_order_at': list(columns[3]),
+            'recency_days': np.array(columns[4], dtype=np.int64),
+        }
+    
+    def assign_segments(self, features):
+        """Apply the segment rules to every customer at once"""
+        import numpy as np
+        total_spent = features['total_spent']
+        num_orders = features['num_orders']
+        recency = features['recency_days']
+        conditions = [
+            (total_spent >= 500) & (num_orders >= 5) & (recency <= 30),
+            (total_spent >= 200) & (num_orders >= 3) & (recency <= 60),
+            (total_spent >= 100) & (recency <= 90),
+            recency > 180,
+            (num_orders == 1) & (recency <= 30),
+        ]
+        choices = ["VIP Customer", "Loyal Customer", "Regular Customer", "At Risk", "New Customer"]
+        return np.select(conditions, choices, default=self.DEFAULT_SEGMENT)
+    
+    def _cluster_matrix(self, features):
+        import numpy as np
+        return np.log1p(np.column_stack([
+            features['recency_days'].clip(min=0),
+            features['num_orders'],
+            features['avg_order_value'],
+        ]))
+    
+    def fit_clusters(self, features):
+        """Fit KMeans on log-scaled RFM features and name the clusters by
+        average order value (lowest: budget, highest: premium)"""
+        from sklearn.cluster import KMeans
+        from sklearn.pipeline import make_pipeline
+        from sklearn.preprocessing import StandardScaler
+        import numpy as np
+        n_clusters = len(self.segments)
+        if len(features['user_id']) < n_clusters:
+            return None
+        self.kmeans = make_pipeline(
+            StandardScaler(), KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
+        ).fit(self._cluster_matrix(features))
+        labels = self.kmeans.predict(self._cluster_matrix(features))
+        spend = [features['avg_order_value'][labels == c].mean() for c in range(n_clusters)]
+        order = np.argsort(spend)
+        self._cluster_names = {
+            int(order[0]): self.segments[0],
+            int(order[-1]): self.segments[1],
+        }
+        for cluster in order[1:-1]:
+            self._cluster_names[int(cluster)] = self.segments[2]
+        return self.assign_clusters(features)
+    
+    def assign_clusters(self, features):
+        if self.kmeans is None or not len(features['user_id']):
+            return None
+        labels = self.kmeans.predict(self._cluster_matrix(features))
+        return [self._cluster_names[int(label)] for label in labels]
+    
+    def refresh(self, full=False, clusters=False, batch_size=500):
+        """Recompute stored segments; returns counts of what was done.
+
+        Incremental by default: only customers marked stale by the order
+        triggers are recomputed. full=True recomputes everyone and
+        clusters=True also refits KMeans.
+        """
+        import time
+        from database import get_db_connection
+        started = time.perf_counter()
+        conn = get_db_connection()
+        try:
+            stale = conn.execute('SELECT user_id, version FROM customer_segments_stale').fetchall()
+            if not full and not stale:
+                return {'customers': 0, 'full': False, 'seconds': 0.0}
+            customers = conn.execute('SELECT COUNT(DISTINCT user_id) FROM orders').fetchone()[0]
+            # The small-population rule depends on every customer
+            full = full or customers <= self.MIN_CUSTOMERS
             
-            # Calculate recency (days since last order)
-            if data['last_order_date']:
-                data['recency_days'] = (current_date - data['last_order_date']).days
+            features = self.rfm_features(conn, stale_only=not full)
+            if customers < self.MIN_CUSTOMERS:
+                segments = ["New Customer"] * len(features['user_id'])
             else:
-                data['recency_days'] = 365  # Default for unknown dates
-        
-        if len(customer_data) < 3:
-            return {uid: "New Customer" for uid in customer_data.keys()}
-        
-        # Enhanced segmentation logic based on multiple criteria
-        user_segments = {}
-        for user_id, data in customer_data.items():
-            total_spent = data['total_spent']
-            num_orders = data['num_orders']
-            recency = data['recency_days']
-            avg_order = data['avg_order_value']
-            
-            # Advanced segmentation rules
-            if total_spent >= 500 and num_orders >= 5 and recency <= 30:
-                segment = "VIP Customer"
-            elif total_spent >= 200 and num_orders >= 3 and recency <= 60:
-                segment = "Loyal Customer"
-            elif total_spent >= 100 and recency <= 90:
-                segment = "Regular Customer"
-            elif recency > 180:
-                segment = "At Risk"
-            elif num_orders == 1 and recency <= 30:
-                segment = "New Customer"
+                segments = self.assign_segments(features).tolist()
+            if clusters:
+                cluster_names = self.fit_clusters(features)
             else:
-                segment = "Standard Customer"
+                cluster_names = self.assign_clusters(features)
             
-            user_segments[user_id] = segment
+            rows = [
+                (int(uid), int(n), float(spent), float(avg), last, int(recency), segment,
+                 cluster_names[i] if cluster_names else None)
+                for i, (uid, n, spent, avg, last, recency, segment) in enumerate(zip(
+                    features['user_id'], features['num_orders'], features['total_spent'],
+                    features['avg_order_value'], features['last_order_at'],
+                    features['recency_days'], segments))
+            ]
+            if full:
+                conn.execute('DELETE FROM customer_segments')
+            else:
+                # Customers whose last order was deleted
+                remaining = set(features['user_id'].tolist())
+                conn.executemany('DELETE FROM customer_segments WHERE user_id = ?',
+                                 [(row[0],) for row in stale if row[0] not in remaining])
+            for i in range(0, len(rows), batch_size):
+                conn.executemany('''
+                    INSERT INTO customer_segments
+                    (user_id, orders, total_spent, avg_order_value, last_order_at,
+                     recency_days, segment, cluster, refreshed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        orders = excluded.orders, total_spent = excluded.total_spent,
+                        avg_order_value = excluded.avg_order_value,
+                        last_order_at = excluded.last_order_at,
+                        recency_days = excluded.recency_days, segment = excluded.segment,
+                        cluster = COALESCE(excluded.cluster, cluster),
+                        refreshed_at = excluded.refreshed_at
+                ''', rows[i:i + batch_size])
+            # Orders placed meanwhile bumped the version and stay marked
+            conn.executemany('DELETE FROM customer_segments_stale WHERE user_id = ? AND version = ?',
+                             [(row[0], row[1]) for row in stale])
+            conn.commit()
+        finally:
+            conn.close()
         
-        return user_segments
+        return {
+            'customers': len(rows),
+            'full': full,
+            'seconds': round(time.perf_counter() - started, 3)
+        }
+    
+    def request_refresh(self):
+        """Ask this process's background thread for an incremental refresh;
+        returns at once. Requests made while a refresh runs are coalesced."""
+        if self._refresh_pid != os.getpid():
+            # One thread per process, started after fork (threads do not survive it)
+            with self._lock:
+                if self._refresh_pid != os.getpid():
+                    self._refresh_wanted = threading.Event()
+                    self._refresh_pid = os.getpid()
+                    threading.Thread(target=self._refresh_loop, args=(self._refresh_wanted,),
+                                     name='segment-refresh', daemon=True).start()
+        self._refresh_wanted.set()
+    
+    def _refresh_loop(self, wanted):
+        while True:
+            wanted.wait()
+            wanted.clear()
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Customer segment refresh failed")
+    
+    def segment_customers(self):
+        """{user_id: segment} for every customer with stored segments; a
+        refresh is requested in the background"""
+        from database import get_db_connection
+        self.request_refresh()
+        conn = get_db_connection()
+        rows = conn.execute('SELECT user_id, segment FROM customer_segments').fetchall()
+        conn.close()
+        return {row['user_id']: row['segment'] for row in rows}
+    
+    def segment_counts(self):
+        """{segment: customers} from the stored segments; a refresh is
+        requested in the background"""
+        from database import get_db_connection
+        self.request_refresh()
+        conn = get_db_connection()
+        rows = conn.execute(SEGMENT_COUNTS_SQL).fetchall()
+        conn.close()
+        return {row['segment']: row['customers'] for row in rows}
 
 class RoofCalculator:
     def __init__(self):
@@ -176,7 +568,7 @@ class RoofCalculator:
         final_area = adjusted_area * 1.1
         
         coverage = self.material_coverage.get(material_type, 2.32)
-        units_needed = int(np.ceil(final_area / coverage))
+        units_needed = int(math.ceil(final_area / coverage))
         
         return {
             'area': area,
@@ -187,8 +579,100 @@ class RoofCalculator:
             'coverage_per_unit': coverage
         }
 
-class ChatBot:
+CHATBOT_CACHE_SIZE = 1024
+FAQ_PRIORITY = 1
+
+_NON_WORD = re.compile(r'[^\w]+')
+
+def _normalize_query(text):
+    """Lowercase words separated by single spaces"""
+    return ' '.join(_NON_WORD.sub(' ', (text or '').lower()).split())
+
+class IntentIndex:
+    """Aho-Corasick automaton over intent keywords.
+
+    Every keyword occurrence in a message is found in one pass over the
+    message, however many keywords there are. A keyword matches at the
+    start of a word, so 'payment' also matches 'payments'.
+    """
+    
     def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self.intents = []
+        self.priorities = []
+        self._built = False
+    
+    def add_intent(self, response, keywords, priority=0):
+        """Register an intent; returns its id.
+        
+        Any match of a higher priority intent beats every lower priority
+        one, whatever the scores; within a priority the highest score wins
+        and earlier intents win ties.
+        """
+        intent = len(self.intents)
+        self.intents.append(response)
+        self.priorities.append(priority)
+        for keyword in keywords:
+            keyword = _normalize_query(keyword)
+            if not keyword:
+                continue
+            node = 0
+            for char in ' ' + keyword:
+                node = self._goto[node].setdefault(char, len(self._goto))
+                if node == len(self._goto):
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+            # Multi-word keywords are more specific than single words
+            self._out[node].append((intent, len(keyword.split())))
+        self._built = False
+        return intent
+    
+    def build(self):
+        """Compute failure links breadth-first"""
+        queue = deque(self._goto[0].values())
+        for node in queue:
+            self._fail[node] = 0
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+                queue.append(child)
+        self._built = True
+    
+    def scores(self, message):
+        """{intent id: summed keyword weight} for one normalized message"""
+        if not self._built:
+            self.build()
+        goto, fail, out = self._goto, self._fail, self._out
+        scores = {}
+        node = 0
+        for char in ' ' + message:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for intent, weight in out[node]:
+                scores[intent] = scores.get(intent, 0) + weight
+        return scores
+    
+    def best(self, message):
+        """Response of the highest scoring intent, or None"""
+        scores = self.scores(message)
+        if not scores:
+            return None
+        intent = max(scores, key=lambda i: (self.priorities[i], scores[i], -i))
+        return self.intents[intent]
+
+class ChatBot:
+    DEFAULT_RESPONSE = "I'm here to help with roofing questions! Ask me about shipping, returns, materials, installation, or use our AI roof calculator for material estimates."
+    
+    def __init__(self, cache_size=CHATBOT_CACHE_SIZE):
         self.faq_data = {
             'shipping': "We offer free shipping on orders over $500. Standard delivery takes 3-5 business days.",
             'returns': "We accept returns within 30 days of purchase. Items must be in original condition.",
@@ -199,22 +683,151 @@ class ChatBot:
             'bulk': "Bulk pricing available for orders over 1000 sq ft. Contact us for custom quotes.",
             'technical': "Our technical team can help with material selection and roof calculations. Use our AI calculator for estimates."
         }
+        # Extra phrasings per FAQ entry, on top of its key
+        self.faq_keywords = {
+            'shipping': ['delivery', 'deliver'],
+            'returns': ['refund'],
+            'warranty': ['guarantee'],
+            'installation': ['install', 'contractor'],
+            'payment': ['pay with', 'financing', 'credit card', 'mobile money'],
+            'bulk': ['wholesale'],
+        }
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.catalog_version = None
+        self.index = self._build_index([])
+    
+    def _build_index(self, products):
+        index = IntentIndex()
+        # Any FAQ hit outranks catalog matches ("shipping for corrugated
+        # metal sheets"); the catalog answers only when no FAQ keyword matched
+        for keyword, response in self.faq_data.items():
+            index.add_intent(response, [keyword] + self.faq_keywords.get(keyword, []),
+                             priority=FAQ_PRIORITY)
+        
+        # Catalog questions: one intent per category and per product
+        categories = {}
+        for product in products:
+            categories.setdefault(product.category, []).append(product)
+        for category, items in sorted(categories.items()):
+            prices = [item.price * 1000 for item in items]  # Convert to RWF
+            index.add_intent(
+                f"We carry {len(items)} product{'s' if len(items) != 1 else ''} in {category}, from RWF {min(prices):,.0f} "
+                f"to RWF {max(prices):,.0f}: {', '.join(item.name for item in items)}.",
+                [category]
+            )
+        for product in products:
+            stock = f"{product.stock} in stock" if product.stock else "currently out of stock"
+            index.add_intent(
+                f"{product.name} ({product.category}) costs RWF {product.price * 1000:,.0f}, {stock}.",
+                [product.name]
+            )
+        index.build()
+        return index
+    
+    def _sync_catalog(self):
+        """Rebuild the index when the product catalog has changed"""
+        from models import catalog_cache
+        version = catalog_cache.version()
+        if version != self.catalog_version:
+            index = self._build_index(list(catalog_cache.get_all().values()))
+            with self._lock:
+                self.index = index
+                self.catalog_version = version
+                self._cache.clear()
     
     def get_response(self, user_message):
         """Get chatbot response based on user message"""
-        message_lower = user_message.lower()
+        try:
+            self._sync_catalog()
+        except Exception as e:
+            logger.error(f"Chatbot catalog refresh failed: {e}")
         
-        # Simple keyword matching
-        for keyword, response in self.faq_data.items():
-            if keyword in message_lower:
+        query = _normalize_query(user_message)
+        with self._lock:
+            response = self._cache.get(query)
+            if response is not None:
+                self._cache.move_to_end(query)
                 return response
+            index = self.index
         
-        # Default response
-        return "I'm here to help with roofing questions! Ask me about shipping, returns, materials, installation, or use our AI roof calculator for material estimates."
-
-# Initialize ML models
-sentiment_analyzer = SentimentAnalyzer()
-product_recommender = ProductRecommender()
-customer_segmentation = CustomerSegmentation()
-roof_calculator = RoofCalculator()
-chatbot = ChatBot()
+        response = index.best(query) or self.DEFAULT_RESPONSE
+        with self._lock:
+            self._cache[query] = response
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return response
+
+# Model singletons, built on first attribute access (PEP 562)
+_SINGLETONS = {
+    'sentiment_analyzer': SentimentAnalyzer,
+    'product_recommender': ProductRecommender.load,
+    'customer_segmentation': CustomerSegmentation,
+    'roof_calculator': RoofCalculator,
+    'chatbot': ChatBot,
+}
+_singleton_lock = threading.Lock()
+
+def __getattr__(name):
+    factory = _SINGLETONS.get(name)
+    if factory is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _singleton_lock:
+        if name not in globals():
+            globals()[name] = factory()
+    return globals()[name]
+
+def refresh_product_recommender():
+    """Bring the shared recommender index up to the current catalog version
+    and write the neighbour lists that changed to product_similar.
+    
+    An empty product_similar (new database, or an index loaded from disk
+    that is already current) is filled with every neighbour list.
+    """
+    from models import catalog_cache
+    from catalog import store_similar_products, has_similar_products
+    recommender = __getattr__('product_recommender')
+    changed = recommender.sync(catalog_cache.get_all(), catalog_cache.version())
+    if recommender.neighbors and not has_similar_products():
+        store_similar_products(recommender.neighbors)
+    elif changed:
+        store_similar_products(recommender.neighbors, changed)
+    return recommender
+
+def check_chatbot(products=None):
+    """Regression check of ChatBot intent ranking; returns failures as
+    (question, expected start, answer)"""
+    from types import SimpleNamespace
+    if products is None:
+        products = [
+            SimpleNamespace(name='Corrugated Metal Sheets', category='Metal Sheets', price=25.99, stock=100),
+            SimpleNamespace(name='Clay Roof Tiles', category='Tiles', price=65.0, stock=100),
+            SimpleNamespace(name='Metallic Valleys', category='Metal Sheets', price=42.25, stock=0),
+        ]
+    bot = ChatBot()
+    faq = bot.faq_data
+    bot.index = bot._build_index(products)
+    expectations = [
+        ("how long is shipping for corrugated metal sheets?", faq['shipping']),
+        ("warranty on clay roof tiles", faq['warranty']),
+        ("can I pay with mobile money for metallic valleys", faq['payment']),
+        ("how much are corrugated metal sheets", "Corrugated Metal Sheets (Metal Sheets) costs"),
+        ("show me tiles", "We carry 1 product in Tiles"),
+        ("hello", ChatBot.DEFAULT_RESPONSE),
+    ]
+    failures = []
+    for question, expected in expectations:
+        answer = bot.index.best(_normalize_query(question)) or ChatBot.DEFAULT_RESPONSE
+        if not answer.startswith(expected):
+            failures.append((question, expected, answer))
+    return failures
+
+if __name__ == '__main__':
+    # python ml_models.py -- chatbot intent ranking regression check
+    import sys
+    failures = check_chatbot()
+    for question, expected, answer in failures:
+        print(f"FAIL {question!r}: expected {expected!r}, got {answer!r}")
+    print(f"chatbot check: {'ok' if not failures else f'{len(failures)} failure(s)'}")
+    sys.exit(1 if failures else 0)
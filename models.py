@@ -2,8 +2,126 @@ from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import json
+import threading
+from flask import g, has_app_context
 from database import get_db_connection
 
+# Hot-path statements; migrations.hot_queries() checks the plans of these
+# very strings, so edit them here rather than inlining SQL below
+PRODUCT_BY_ID_SQL = 'SELECT * FROM products WHERE id = ?'
+USER_BY_ID_SQL = 'SELECT * FROM users WHERE id = ?'
+USER_BY_EMAIL_SQL = 'SELECT * FROM users WHERE email = ?'
+CART_LOAD_SQL = '''
+    SELECT ci.id AS cart_item_id, ci.quantity, p.*
+    FROM cart_items ci
+    JOIN products p ON ci.product_id = p.id
+    WHERE ci.user_id = ?
+'''
+CART_COUNT_SQL = 'SELECT items, version FROM cart_counts WHERE user_id = ?'
+CART_ADD_SQL = '''
+    INSERT INTO cart_items (user_id, product_id, quantity)
+    SELECT ?, id, ? FROM products WHERE id = ?
+    ON CONFLICT (user_id, product_id)
+    DO UPDATE SET quantity = quantity + excluded.quantity
+'''
+CART_LINE_UPDATE_SQL = 'UPDATE cart_items SET quantity = ? WHERE id = ? AND user_id = ?'
+CART_LINE_DELETE_SQL = 'DELETE FROM cart_items WHERE id = ? AND user_id = ?'
+
+def _identity_map():
+    """Per-request map of already materialized rows, keyed by (kind, id)"""
+    if not has_app_context():
+        return None
+    if '_identity_map' not in g:
+        g._identity_map = {}
+    return g._identity_map
+
+class CatalogCache:
+    """Process-level read-through cache of product rows.
+
+    Validity is tied to catalog_meta.version, which database triggers bump on
+    every product write, so admin edits made in any worker invalidate the
+    cache everywhere. The version is read at most once per request.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._products = {}
+        self._complete = False
+        self._categories = None
+    
+    def _current_version(self, conn):
+        if has_app_context() and '_catalog_version' in g:
+            return g._catalog_version
+        row = conn.execute('SELECT version FROM catalog_meta WHERE id = 1').fetchone()
+        version = row[0] if row else 0
+        if has_app_context():
+            g._catalog_version = version
+        return version
+    
+    def _sync(self, conn):
+        version = self._current_version(conn)
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._products = {}
+                    self._complete = False
+                    self._categories = None
+                    self._version = version
+    
+    def version(self):
+        """Current catalog version (changes on every product write)"""
+        conn = get_db_connection()
+        version = self._current_version(conn)
+        conn.close()
+        return version
+    
+    def get(self, product_id):
+        conn = get_db_connection()
+        self._sync(conn)
+        product = self._products.get(product_id)
+        if product is None and not self._complete:
+            row = conn.execute(PRODUCT_BY_ID_SQL, (product_id,)).fetchone()
+            if row:
+                product = Product.from_row(row)
+                self._products[product_id] = product
+        conn.close()
+        return product
+    
+    def get_all(self):
+        conn = get_db_connection()
+        self._sync(conn)
+        if not self._complete:
+            rows = conn.execute('SELECT * FROM products').fetchall()
+            with self._lock:
+                self._products = {row['id']: Product.from_row(row) for row in rows}
+                self._complete = True
+        conn.close()
+        return dict(self._products)
+    
+    def categories(self):
+        conn = get_db_connection()
+        self._sync(conn)
+        categories = self._categories
+        if categories is None:
+            rows = conn.execute('SELECT DISTINCT category FROM products ORDER BY category').fetchall()
+            categories = self._categories = [row[0] for row in rows]
+        conn.close()
+        return list(categories)
+    
+    def invalidate(self):
+        """Drop cached rows; the next read reloads from the database"""
+        with self._lock:
+            self._products = {}
+            self._complete = False
+            self._categories = None
+            self._version = None
+        if has_app_context():
+            g.pop('_catalog_version', None)
+            g.pop('_identity_map', None)
+
+catalog_cache = CatalogCache()
+
 class User(UserMixin):
     def __init__(self, id, username, email, password_hash, is_admin=False, created_at=None):
         self.id = id
@@ -13,21 +131,31 @@ class User(UserMixin):
         self.is_admin = is_admin
         self.created_at = created_at or datetime.now()
     
+    @staticmethod
+    def from_row(user):
+        return User(user['id'], user['username'], user['email'], 
+                   user['password_hash'], user['is_admin'], user['created_at'])
+    
     @staticmethod
     def get(user_id):
+        identity_map = _identity_map()
+        key = ('user', user_id)
+        if identity_map is not None and key in identity_map:
+            return identity_map[key]
+        
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        user = conn.execute(USER_BY_ID_SQL, (user_id,)).fetchone()
         conn.close()
-        if user:
-            return User(user['id'], user['username'], user['email'], 
-                       user['password_hash'], user['is_admin'], user['created_at'])
-        return None
+        result = User.from_row(user) if user else None
+        if identity_map is not None:
+            identity_map[key] = result
+        return result
     
     @staticmethod
     def get_by_email(email):
         print(f"DEBUG: Looking up user by email: {email}")
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+        user = conn.execute(USER_BY_EMAIL_SQL, (email,)).fetchone()
         conn.close()
         if user:
             print(f"DEBUG: User found: {user['username']} (ID: {user['id']})")
@@ -70,28 +198,33 @@ class Product:
         self.created_at = created_at or datetime.now()
     
     @staticmethod
-    def get_all():
-        conn = get_db_connection()
-        products = conn.execute('SELECT * FROM products').fetchall()
-        conn.close()
-        return {product['id']: Product(
+    def from_row(product):
+        return Product(
             product['id'], product['name'], product['description'],
             product['price'], product['category'], product['image_url'],
             product['stock'], product['created_at']
-        ) for product in products}
+        )
+    
+    @staticmethod
+    def get_all():
+        return catalog_cache.get_all()
     
     @staticmethod
     def get(product_id):
-        conn = get_db_connection()
-        product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-        conn.close()
-        if product:
-            return Product(
-                product['id'], product['name'], product['description'],
-                product['price'], product['category'], product['image_url'],
-                product['stock'], product['created_at']
-            )
-        return None
+        identity_map = _identity_map()
+        key = ('product', product_id)
+        if identity_map is not None and key in identity_map:
+            return identity_map[key]
+        
+        product = catalog_cache.get(product_id)
+        if identity_map is not None:
+            identity_map[key] = product
+        return product
+    
+    @staticmethod
+    def invalidate_cache():
+        """Call after writing to the products table"""
+        catalog_cache.invalidate()
 
 class Order:
     def __init__(self, id, user_id, items, total, status='pending'):
@@ -101,6 +234,26 @@ class Order:
         self.total = total
         self.status = status
         self.created_at = datetime.now()
+    
+    @staticmethod
+    def create(conn, user_id, items, total, status='pending'):
+        """Insert an order and its order_items rows; the caller commits.
+        
+        items are dicts with product_id, product_name, quantity, price and
+        subtotal (see Cart.order_items). Returns the new order id.
+        """
+        cursor = conn.execute('''
+            INSERT INTO orders (user_id, items, total, status)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, json.dumps(items), total, status))
+        order_id = cursor.lastrowid
+        conn.executemany('''
+            INSERT INTO order_items
+            (order_id, user_id, product_id, product_name, quantity, price, subtotal)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(order_id, user_id, item['product_id'], item.get('product_name'),
+               item['quantity'], item['price'], item['subtotal']) for item in items])
+        return order_id
 
 class Review:
     def __init__(self, id, user_id, product_id, rating, comment, sentiment=None):
@@ -117,3 +270,101 @@ class CartItem:
         self.product_id = product_id
         self.quantity = quantity
         self.user_id = user_id
+
+class Cart:
+    """A user's cart, loaded with one JOIN over cart_items and products"""
+    
+    def __init__(self, user_id, items):
+        self.user_id = user_id
+        self.items = items
+        self.total = sum(item['subtotal'] for item in items)
+        self.count = sum(item['quantity'] for item in items)
+    
+    def __bool__(self):
+        return bool(self.items)
+    
+    @staticmethod
+    def load(user_id):
+        """Load cart lines with their products built from the joined row"""
+        conn = get_db_connection()
+        rows = conn.execute(CART_LOAD_SQL, (user_id,)).fetchall()
+        conn.close()
+        
+        identity_map = _identity_map()
+        items = []
+        for row in rows:
+            product = Product.from_row(row)
+            if identity_map is not None:
+                identity_map[('product', product.id)] = product
+            items.append({
+                'id': row['cart_item_id'],
+                'product': product,
+                'quantity': row['quantity'],
+                'subtotal': product.price * row['quantity']
+            })
+        return Cart(user_id, items)
+    
+    @staticmethod
+    def count_state(user_id):
+        """(total quantity, version) from the trigger-maintained cart_counts
+        row; version changes whenever the cart does"""
+        conn = get_db_connection()
+        row = conn.execute(CART_COUNT_SQL, (user_id,)).fetchone()
+        conn.close()
+        return (row['items'], row['version']) if row else (0, 0)
+    
+    @staticmethod
+    def count_items(user_id):
+        """Total quantity in the cart without loading its lines"""
+        return Cart.count_state(user_id)[0]
+    
+    @staticmethod
+    def add_items(user_id, items):
+        """Add [(product_id, quantity), ...] to the cart in one transaction.
+
+        Each line is a single upsert on the (user_id, product_id) key, so
+        concurrent adds of the same product accumulate instead of creating
+        duplicate rows. Unknown product ids are skipped. Returns the number
+        of cart lines written.
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.executemany(
+                CART_ADD_SQL, [(user_id, quantity, product_id) for product_id, quantity in items]
+            )
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def update_quantity(user_id, item_id, quantity):
+        """Set a line's quantity; returns False if it is not in the user's cart"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(CART_LINE_UPDATE_SQL, (quantity, item_id, user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def remove_item(user_id, item_id):
+        """Delete a line; returns False if it is not in the user's cart"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(CART_LINE_DELETE_SQL, (item_id, user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+    
+    def order_items(self):
+        """Cart lines in the shape stored on orders.items"""
+        return [{
+            'product_id': item['product'].id,
+            'product_name': item['product'].name,
+            'quantity': item['quantity'],
+            'price': item['product'].price,
+            'subtotal': item['subtotal']
+        } for item in self.items]
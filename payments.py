@@ -0,0 +1,253 @@
+"""
+Asynchronous mobile money payments
+Checkout records a pending order and payment and returns at once; a small
+worker pool settles the payment against the configured provider, so no web
+worker ever waits on the provider. Clients poll the payment status with
+short requests, so no web worker is held open waiting for a settlement.
+
+The pool lives in the web process, so a restart loses queued and in-flight
+settlements. Each process therefore sweeps for payments left pending or
+processing longer than PAYMENT_STALE_AFTER, at startup and every
+PAYMENT_RECOVERY_INTERVAL seconds, and queues them again.
+"""
+import os
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from database import get_db_connection
+from models import Order
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_WORKERS = int(os.environ.get('SMARTROOF_PAYMENT_WORKERS', 4))
+PAYMENT_PROVIDER = os.environ.get('SMARTROOF_PAYMENT_PROVIDER', 'mtn_simulator')
+# Seconds the simulated provider takes to confirm a payment
+SIMULATED_PAYMENT_DELAY = float(os.environ.get('SMARTROOF_PAYMENT_SIM_DELAY', 1.0))
+# Seconds an unsettled payment may sit untouched before it is retried (well
+# above any provider timeout), and seconds between recovery sweeps
+PAYMENT_STALE_AFTER = float(os.environ.get('SMARTROOF_PAYMENT_STALE_AFTER', 300))
+PAYMENT_RECOVERY_INTERVAL = float(os.environ.get('SMARTROOF_PAYMENT_RECOVERY_INTERVAL', 60))
+
+# Unsettled payments untouched for longer than the bound age; the partial
+# index idx_payments_unsettled serves it (checked by migrations.hot_queries())
+STALE_PAYMENTS_SQL = '''
+    SELECT id, status FROM payments
+    WHERE status IN ('pending', 'processing') AND updated_at < datetime('now', ?)
+'''
+
+# pending -> processing -> completed | failed
+SETTLED_STATUSES = ('completed', 'failed')
+
+@dataclass
+class PaymentResult:
+    """Outcome reported by a payment provider"""
+    success: bool
+    reference: Optional[str] = None
+    error: Optional[str] = None
+
+class PaymentProvider:
+    """Interface for payment providers; charge() may block, it runs on a worker.
+
+    A payment whose worker died mid-charge is charged again by the recovery
+    sweep, so providers must treat payment['id'] as an idempotency key.
+    """
+    name = 'base'
+
+    def charge(self, payment: Dict) -> PaymentResult:
+        raise NotImplementedError
+
+class SimulatedMTNProvider(PaymentProvider):
+    """Local stand-in for the MTN Mobile Money collection API.
+
+    Approves every payment after `delay` seconds, except for phone numbers
+    ending in 0000, which are declined (handy for exercising the failure path).
+    """
+    name = 'mtn_simulator'
+
+    def __init__(self, delay: float = SIMULATED_PAYMENT_DELAY):
+        self.delay = delay
+
+    def charge(self, payment: Dict) -> PaymentResult:
+        time.sleep(self.delay)
+        if (payment.get('phone') or '').endswith('0000'):
+            return PaymentResult(False, error='Payment declined by subscriber')
+        return PaymentResult(True, reference=f"MTN{payment['id']:08d}")
+
+# provider name -> class; register real providers here
+PROVIDERS = {
+    SimulatedMTNProvider.name: SimulatedMTNProvider,
+}
+
+class PaymentProcessor:
+    """Creates pending payments and settles them on a background thread pool"""
+
+    def __init__(self, provider: PaymentProvider, max_workers: int = PAYMENT_WORKERS):
+        self.provider = provider
+        self.max_workers = max_workers
+        self._executor = None
+        self._recovery_pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # Created on first use so the pool never exists in a pre-fork master
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='payment'
+                )
+            return self._executor
+
+    def start_recovery(self):
+        """Start this process's recovery sweep thread, if not running yet.
+        Cheap enough to call on every request."""
+        if self._recovery_pid == os.getpid():
+            return
+        # One thread per process, started after fork (threads do not survive it)
+        with self._lock:
+            if self._recovery_pid == os.getpid():
+                return
+            self._recovery_pid = os.getpid()
+            threading.Thread(target=self._recovery_loop, name='payment-recovery',
+                             daemon=True).start()
+
+    def _recovery_loop(self):
+        while True:
+            try:
+                self.recover_stale()
+            except Exception:
+                logger.exception("Payment recovery sweep failed")
+            time.sleep(PAYMENT_RECOVERY_INTERVAL)
+
+    def recover_stale(self, stale_after: float = PAYMENT_STALE_AFTER) -> int:
+        """Queue again every payment left pending or processing for more than
+        stale_after seconds (its settlement was lost, e.g. to a restart).
+        Returns the number queued."""
+        age = f"-{stale_after:g} seconds"
+        conn = get_db_connection()
+        try:
+            stale = conn.execute(STALE_PAYMENTS_SQL, (age,)).fetchall()
+            requeued = []
+            for payment_id, status in stale:
+                if status == 'processing':
+                    # Only one process wins the reset; the others see it fresh
+                    if not conn.execute('''
+                        UPDATE payments SET status = 'pending', updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ? AND status = 'processing' AND updated_at < datetime('now', ?)
+                    ''', (payment_id, age)).rowcount:
+                        continue
+                requeued.append(payment_id)
+            conn.commit()
+        finally:
+            conn.close()
+        for payment_id in requeued:
+            # _claim makes a payment queued twice (by several processes) settle once
+            self._pool().submit(self._settle, payment_id)
+        if requeued:
+            logger.warning(f"Requeued {len(requeued)} stale payments: {requeued}")
+        return len(requeued)
+
+    def start_checkout(self, user_id: int, items: List[Dict], total: float,
+                       phone: Optional[str]) -> int:
+        """Record a pending order and payment, empty the cart and queue the
+        charge. Returns the payment id."""
+        conn = get_db_connection()
+        try:
+            order_id = Order.create(conn, user_id, items, total, 'pending')
+            payment_id = conn.execute('''
+                INSERT INTO payments (order_id, user_id, provider, phone, amount)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (order_id, user_id, self.provider.name, phone, total)).lastrowid
+            conn.execute('DELETE FROM cart_items WHERE user_id = ?', (user_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        self._pool().submit(self._settle, payment_id)
+        return payment_id
+
+    def _claim(self, payment_id: int) -> Optional[Dict]:
+        # Atomic pending -> processing, so a payment is only ever charged once
+        conn = get_db_connection()
+        try:
+            claimed = conn.execute('''
+                UPDATE payments SET status = 'processing', updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending'
+            ''', (payment_id,)).rowcount
+            conn.commit()
+            if not claimed:
+                return None
+            return dict(conn.execute('SELECT * FROM payments WHERE id = ?', (payment_id,)).fetchone())
+        finally:
+            conn.close()
+
+    def _settle(self, payment_id: int):
+        # Runs on the pool, where an exception would vanish with its future;
+        # a payment left processing is picked up by the recovery sweep
+        try:
+            self._settle_payment(payment_id)
+        except Exception:
+            logger.exception(f"Settling payment {payment_id} failed")
+
+    def _settle_payment(self, payment_id: int):
+        payment = self._claim(payment_id)
+        if payment is None:
+            return
+        try:
+            result = self.provider.charge(payment)
+        except Exception:
+            logger.exception(f"Payment {payment_id} provider error")
+            result = PaymentResult(False, error='Payment provider unavailable, please try again')
+
+        conn = get_db_connection()
+        try:
+            if result.success:
+                conn.execute('''
+                    UPDATE payments SET status = 'completed', reference = ?,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (result.reference, payment_id))
+                conn.execute("UPDATE orders SET status = 'completed' WHERE id = ?",
+                             (payment['order_id'],))
+            else:
+                # The order is dropped below, so the payment stops pointing at it
+                conn.execute('''
+                    UPDATE payments SET status = 'failed', error = ?, order_id = NULL,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (result.error, payment_id))
+                # Put the items back in the cart and drop the unpaid order, so
+                # it never counts towards sales totals
+                conn.execute('''
+                    INSERT INTO cart_items (user_id, product_id, quantity)
+                    SELECT user_id, product_id, SUM(quantity) FROM order_items
+                    WHERE order_id = ? GROUP BY product_id
+                    ON CONFLICT (user_id, product_id)
+                    DO UPDATE SET quantity = quantity + excluded.quantity
+                ''', (payment['order_id'],))
+                conn.execute('DELETE FROM orders WHERE id = ?', (payment['order_id'],))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_status(self, payment_id: int, user_id: Optional[int] = None) -> Optional[Dict]:
+        """Payment status, or None if it does not exist (or is not user_id's)"""
+        conn = get_db_connection()
+        row = conn.execute('''
+            SELECT id, order_id, user_id, amount, status, reference, error, updated_at
+            FROM payments WHERE id = ?
+        ''', (payment_id,)).fetchone()
+        conn.close()
+        if row is None or (user_id is not None and row['user_id'] != user_id):
+            return None
+        status = dict(row)
+        status['settled'] = status['status'] in SETTLED_STATUSES
+        return status
+
+def get_provider(name: str = PAYMENT_PROVIDER) -> PaymentProvider:
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown payment provider: {name}")
+    return PROVIDERS[name]()
+
+payment_processor = PaymentProcessor(get_provider())
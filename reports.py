@@ -0,0 +1,266 @@
+"""
+Admin reporting: dashboard aggregates served from incrementally
+maintained tables instead of full-table scans on every page load
+"""
+import os
+import threading
+import time
+import logging
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+from database import get_db_connection
+from catalog import encode_cursor, decode_cursor, cursor_matches, SQLITE_MAX_INT
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on how stale cached dashboard figures may be, in seconds
+DASHBOARD_STATS_TTL = float(os.environ.get('SMARTROOF_DASHBOARD_TTL', 30))
+RECENT_ORDERS_LIMIT = 5
+ORDERS_PAGE_SIZE = 50
+EXPORT_BATCH_SIZE = 500
+
+# Statements checked by migrations.hot_queries() along with orders_query()
+RECENT_ORDERS_SQL = '''
+    SELECT o.id, o.total, o.status, o.created_at, u.username
+    FROM orders o
+    LEFT JOIN users u ON o.user_id = u.id
+    ORDER BY o.created_at DESC
+    LIMIT ?
+'''
+REVENUE_BY_PERIOD_SQL = '''
+    SELECT strftime(?, day) AS period, SUM(revenue) AS revenue
+    FROM daily_sales
+    GROUP BY period
+    ORDER BY period DESC
+    LIMIT ?
+'''
+PRODUCT_SALES_REPORT_SQL = '''
+    SELECT ps.product_id, ps.quantity, ps.revenue, p.name, p.category
+    FROM product_sales ps
+    JOIN products p ON p.id = ps.product_id
+    WHERE ps.quantity > 0
+    ORDER BY ps.revenue DESC
+    LIMIT ?
+'''
+
+_dashboard_lock = threading.Lock()
+_dashboard_cache = {'data': None, 'loaded_at': 0.0}
+
+def _recent_orders(conn):
+    rows = conn.execute(RECENT_ORDERS_SQL, (RECENT_ORDERS_LIMIT,)).fetchall()
+    return [{
+        'id': order['id'],
+        'username': order['username'] or 'Unknown User',
+        'total': order['total'] * 1000,  # Convert to RWF
+        'status': order['status'],
+        'created_at': order['created_at']
+    } for order in rows]
+
+def refresh_store_stats(conn):
+    """Recompute store_stats from the base tables (repairs any drift)"""
+    conn.execute('''
+        UPDATE store_stats SET
+            total_users = (SELECT COUNT(*) FROM users),
+            total_products = (SELECT COUNT(*) FROM products),
+            total_orders = (SELECT COUNT(*) FROM orders),
+            total_revenue = (SELECT COALESCE(SUM(total), 0) FROM orders),
+            refreshed_at = CURRENT_TIMESTAMP
+        WHERE id = 1
+    ''')
+    conn.commit()
+
+def get_dashboard_stats(force_refresh: bool = False) -> Dict:
+    """Dashboard totals and recent orders.
+
+    Reads are O(1): totals come from the trigger-maintained store_stats row
+    and recent orders from the created_at index. The result is cached in
+    process for DASHBOARD_STATS_TTL seconds; force_refresh recomputes the
+    totals from the base tables and bypasses the cache.
+    """
+    now = time.monotonic()
+    cached = _dashboard_cache['data']
+    if not force_refresh and cached and now - _dashboard_cache['loaded_at'] < DASHBOARD_STATS_TTL:
+        return cached
+
+    with _dashboard_lock:
+        conn = get_db_connection()
+        if force_refresh:
+            refresh_store_stats(conn)
+        stats = conn.execute('SELECT * FROM store_stats WHERE id = 1').fetchone()
+        recent_orders = _recent_orders(conn)
+        conn.close()
+
+        data = {
+            'total_users': stats['total_users'],
+            'total_products': stats['total_products'],
+            'total_orders': stats['total_orders'],
+            # Convert revenue to RWF (multiply by 1000)
+            'total_revenue': (stats['total_revenue'] or 0) * 1000,
+            'recent_orders': recent_orders,
+            'refreshed_at': stats['refreshed_at']
+        }
+        _dashboard_cache['data'] = data
+        _dashboard_cache['loaded_at'] = time.monotonic()
+    return data
+
+# period name -> strftime format applied to daily_sales.day
+REVENUE_PERIODS = {
+    'day': '%Y-%m-%d',
+    'week': '%Y-W%W',
+    'month': '%Y-%m',
+    'year': '%Y',
+}
+
+def revenue_by_period(period: str = 'month', limit: int = 12) -> Dict[str, float]:
+    """Revenue per period for the most recent `limit` periods, oldest first"""
+    fmt = REVENUE_PERIODS.get(period, REVENUE_PERIODS['month'])
+    conn = get_db_connection()
+    rows = conn.execute(REVENUE_BY_PERIOD_SQL, (fmt, limit)).fetchall()
+    conn.close()
+    return {row['period']: round(row['revenue'], 2) for row in reversed(rows)}
+
+def product_sales_report(limit: int = 50) -> Tuple[Dict[int, Dict], Dict[int, Dict]]:
+    """Top products by revenue: (sales by product id, product info by id)"""
+    conn = get_db_connection()
+    rows = conn.execute(PRODUCT_SALES_REPORT_SQL, (limit,)).fetchall()
+    conn.close()
+    sales = {row['product_id']: {'quantity': row['quantity'], 'revenue': row['revenue']} for row in rows}
+    products = {row['product_id']: {'name': row['name'], 'category': row['category']} for row in rows}
+    return sales, products
+
+def sentiment_distribution() -> Dict[str, int]:
+    """Review counts per sentiment label; empty when no review is scored"""
+    conn = get_db_connection()
+    rows = conn.execute('SELECT sentiment, reviews FROM review_sentiment_counts').fetchall()
+    conn.close()
+    counts = {row['sentiment']: row['reviews'] for row in rows}
+    if not any(counts.values()):
+        return {}
+    return {label: counts.get(label, 0) for label in ('positive', 'neutral', 'negative')}
+
+@dataclass
+class OrderFilters:
+    """Admin order listing filters; empty values mean no filter"""
+    status: str = ''
+    date_from: str = ''  # YYYY-MM-DD, inclusive
+    date_to: str = ''    # YYYY-MM-DD, inclusive
+    user: str = ''       # user id, username or email
+
+    @staticmethod
+    def from_args(args):
+        return OrderFilters(
+            status=args.get('status', '').strip(),
+            date_from=args.get('date_from', '').strip(),
+            date_to=args.get('date_to', '').strip(),
+            user=args.get('user', '').strip()
+        )
+
+    def as_args(self) -> Dict:
+        return {key: value for key, value in vars(self).items() if value}
+
+    def validate(self) -> 'OrderFilters':
+        """Raise ValueError for filters _order_where cannot use, so callers can
+        reject them before any output (e.g. a streamed export) starts"""
+        for value in (self.date_from, self.date_to):
+            if value:
+                try:
+                    date.fromisoformat(value)
+                except ValueError:
+                    raise ValueError('Invalid date filter, expected YYYY-MM-DD') from None
+        if self.user.isdecimal() and int(self.user) > SQLITE_MAX_INT:
+            raise ValueError('Invalid user filter')
+        return self
+
+def _order_where(conn, filters: OrderFilters) -> Tuple[List[str], List]:
+    where, params = [], []
+    if filters.status:
+        where.append('o.status = ?')
+        params.append(filters.status)
+    if filters.date_from:
+        where.append('o.created_at >= ?')
+        params.append(date.fromisoformat(filters.date_from).isoformat())
+    if filters.date_to:
+        where.append('o.created_at < ?')
+        params.append((date.fromisoformat(filters.date_to) + timedelta(days=1)).isoformat())
+    if filters.user:
+        if filters.user.isdecimal():
+            user_id = int(filters.user)
+        else:
+            row = conn.execute(
+                'SELECT id FROM users WHERE username = ? OR email = ?',
+                (filters.user, filters.user)
+            ).fetchone()
+            user_id = row['id'] if row else -1
+        where.append('o.user_id = ?')
+        params.append(user_id)
+    return where, params
+
+def orders_query(conn, filters: OrderFilters, after, limit: int, with_items: bool):
+    """(sql, params) for one keyset batch of the admin order listing, newest
+    first; also checked by migrations.hot_queries()"""
+    where, params = _order_where(conn, filters)
+    if after:
+        where.append('(o.created_at, o.id) < (?, ?)')
+        params.extend(after)
+    columns = 'o.id, o.user_id, o.total, o.status, o.created_at, u.username, u.email'
+    if with_items:
+        columns += ', o.items'
+    sql = f'''
+        SELECT {columns}
+        FROM orders o
+        LEFT JOIN users u ON o.user_id = u.id
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY o.created_at DESC, o.id DESC
+        LIMIT ?
+    '''
+    params.append(limit)
+    return sql, params
+
+def _fetch_orders(conn, filters: OrderFilters, after, limit: int, with_items: bool):
+    sql, params = orders_query(conn, filters, after, limit, with_items)
+    return conn.execute(sql, params).fetchall()
+
+def _order_row(order) -> Dict:
+    return {
+        'id': order['id'],
+        'user_id': order['user_id'],
+        'username': order['username'] or 'Unknown User',
+        'email': order['email'] or 'N/A',
+        'total': order['total'] * 1000,  # Convert to RWF
+        'status': order['status'],
+        'created_at': order['created_at']
+    }
+
+def list_orders_page(filters: OrderFilters, cursor: Optional[str] = None,
+                     page_size: int = ORDERS_PAGE_SIZE) -> Tuple[List[Dict], Optional[str]]:
+    """One page of orders, newest first, with a keyset cursor for the next"""
+    # [created_at, id]; a malformed or tampered cursor starts from the first page
+    after = decode_cursor(cursor) if cursor else None
+    if after is not None and not cursor_matches(after, [(str,), (int,)]):
+        after = None
+
+    conn = get_db_connection()
+    rows = _fetch_orders(conn, filters, after, page_size + 1, with_items=False)
+    conn.close()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor([rows[-1]['created_at'], rows[-1]['id']])
+    return [_order_row(row) for row in rows], next_cursor
+
+def iter_orders(filters: OrderFilters, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[Dict]:
+    """Yield every matching order in keyset batches, so memory stays bounded"""
+    after = None
+    while True:
+        conn = get_db_connection()
+        rows = _fetch_orders(conn, filters, after, batch_size, with_items=True)
+        conn.close()
+        for row in rows:
+            order = _order_row(row)
+            order['items'] = row['items']
+            yield order
+        if len(rows) < batch_size:
+            return
+        after = [rows[-1]['created_at'], rows[-1]['id']]
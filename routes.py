@@ -1,43 +1,81 @@
-from flask import render_template, request, redirect, url_for, flash, session, jsonify
+from flask import render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, stream_template
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash
-from app import app
-from models import User, Product
-from ml_models import *
-from database import get_db_connection
+from models import User, Product, Cart, Order
+import ml_models
+from database import get_db_connection, get_pool_stats
+from catalog import search_catalog, get_categories, get_similar_products, autocomplete, SORT_LABELS
+from reports import (get_dashboard_stats, OrderFilters, list_orders_page, iter_orders,
+                     revenue_by_period, product_sales_report, sentiment_distribution)
+from payments import payment_processor
+from sentiment import review_sentiment_queue
 import json
+import logging
 
-@app.route('/')
+logger = logging.getLogger(__name__)
+
+class RouteRegistry:
+    """Collects route and context processor registrations at import time and
+    applies them to an application in register_routes()"""
+    
+    def __init__(self):
+        self._deferred = []
+    
+    def route(self, rule, **options):
+        def decorator(func):
+            self._deferred.append(lambda app: app.route(rule, **options)(func))
+            return func
+        return decorator
+    
+    def context_processor(self, func):
+        self._deferred.append(lambda app: app.context_processor(func))
+        return func
+    
+    def register(self, app):
+        for apply in self._deferred:
+            apply(app)
+
+registry = RouteRegistry()
+
+def register_routes(app):
+    """Attach the storefront and admin routes to app (see app.create_app)"""
+    registry.register(app)
+    # Started from the first request so each forked worker gets its own sweep
+    app.before_request(payment_processor.start_recovery)
+
+MAX_BULK_CART_ITEMS = 500
+
+@registry.route('/')
 def index():
-    products = Product.get_all()
-    featured_products = list(products.values())[:6]
+    featured_products = search_catalog(page_size=6).products
     return render_template('index.html', products=featured_products)
 
-@app.route('/products')
+@registry.route('/products')
 def products():
-    products_dict = Product.get_all()
     category = request.args.get('category', '')
     search = request.args.get('search', '')
+    sort = request.args.get('sort', 'default')
+    cursor = request.args.get('after')
     
-    filtered_products = list(products_dict.values())
-    
-    if category:
-        filtered_products = [p for p in filtered_products if p.category == category]
-    
-    if search:
-        filtered_products = [p for p in filtered_products 
-                           if search.lower() in p.name.lower() or 
-                              search.lower() in p.description.lower()]
-    
-    categories = list(set(p.category for p in products_dict.values()))
+    page = search_catalog(category=category, search=search, sort=sort, cursor=cursor)
     
     return render_template('products.html', 
-                         products=filtered_products, 
-                         categories=categories,
+                         products=page.products, 
+                         categories=get_categories(),
                          selected_category=category,
-                         search_query=search)
+                         search_query=search,
+                         sort=page.sort,
+                         sort_options=SORT_LABELS,
+                         next_cursor=page.next_cursor,
+                         is_first_page=not cursor)
 
-@app.route('/product/<int:product_id>')
+@registry.route('/api/products/autocomplete')
+def product_autocomplete():
+    """Search-as-you-type suggestions for the products page"""
+    query = request.args.get('q', '')
+    return jsonify({'suggestions': autocomplete(query)})
+
+@registry.route('/product/<int:product_id>')
 def product_detail(product_id):
     product = Product.get(product_id)
     
@@ -45,12 +83,8 @@ def product_detail(product_id):
         flash('Product not found', 'error')
         return redirect(url_for('products'))
     
-    # Get similar products (simplified)
-    products = Product.get_all()
-    similar_products = []
-    for p in list(products.values())[:4]:
-        if p.id != product_id and p.category == product.category:
-            similar_products.append(p)
+    # Precomputed by the recommender (see ml_models.refresh_product_recommender)
+    similar_products = get_similar_products(product_id, limit=4)
     
     return render_template('product_detail.html', 
                          product=product, 
@@ -58,7 +92,7 @@ def product_detail(product_id):
                          reviews=[],
                          users={})
 
-@app.route('/login', methods=['GET', 'POST'])
+@registry.route('/login', methods=['GET', 'POST'])
 def login():
     print("DEBUG: Login route accessed")
     if request.method == 'POST':
@@ -91,7 +125,7 @@ def login():
     print("DEBUG: Rendering login template")
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@registry.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -114,45 +148,23 @@ def register():
     
     return render_template('register.html')
 
-@app.route('/logout')
+@registry.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('Logged out successfully', 'success')
     return redirect(url_for('index'))
 
-@app.route('/cart')
+@registry.route('/cart')
 @login_required
 def cart():
     try:
-        conn = get_db_connection()
-        cart_items_data = conn.execute('''
-            SELECT ci.*, p.name, p.price, p.image_url 
-            FROM cart_items ci 
-            JOIN products p ON ci.product_id = p.id 
-            WHERE ci.user_id = ?
-        ''', (current_user.id,)).fetchall()
-        conn.close()
-        
-        cart_items = []
-        total = 0
-        
-        for item in cart_items_data:
-            product = Product.get(item['product_id'])
-            if product:
-                cart_items.append({
-                    'id': item['id'],
-                    'product': product,
-                    'quantity': item['quantity'],
-                    'subtotal': product.price * item['quantity']
-                })
-                total += product.price * item['quantity']
-        
-        return render_template('cart.html', cart_items=cart_items, total=total)
+        cart = Cart.load(current_user.id)
+        return render_template('cart.html', cart_items=cart.items, total=cart.total)
     except Exception as e:
         return render_template('cart.html', cart_items=[], total=0)
 
-@app.route('/add_to_cart/<int:product_id>', methods=['POST'])
+@registry.route('/add_to_cart/<int:product_id>', methods=['POST'])
 @login_required
 def add_to_cart(product_id):
     product = Product.get(product_id)
@@ -161,56 +173,26 @@ def add_to_cart(product_id):
         return redirect(url_for('products'))
     
     quantity = int(request.form.get('quantity', 1))
+    if quantity <= 0:
+        flash('Quantity must be at least 1', 'error')
+        return redirect(url_for('product_detail', product_id=product_id))
     
     try:
-        conn = get_db_connection()
-        # Check if item already in cart
-        existing_item = conn.execute(
-            'SELECT * FROM cart_items WHERE user_id = ? AND product_id = ?',
-            (current_user.id, product_id)
-        ).fetchone()
-        
-        if existing_item:
-            # Update quantity
-            conn.execute(
-                'UPDATE cart_items SET quantity = quantity + ? WHERE user_id = ? AND product_id = ?',
-                (quantity, current_user.id, product_id)
-            )
-        else:
-            # Add new item
-            conn.execute(
-                'INSERT INTO cart_items (user_id, product_id, quantity) VALUES (?, ?, ?)',
-                (current_user.id, product_id, quantity)
-            )
-        
-        conn.commit()
-        conn.close()
-        
+        Cart.add_items(current_user.id, [(product_id, quantity)])
         flash(f'{product.name} added to cart!', 'success')
     except Exception as e:
         flash('Error adding item to cart. Please try again.', 'error')
     
     return redirect(url_for('product_detail', product_id=product_id))
 
-@app.route('/remove_from_cart/<int:item_id>', methods=['POST'])
+@registry.route('/remove_from_cart/<int:item_id>', methods=['POST'])
 @login_required
 def remove_from_cart(item_id):
     try:
-        conn = get_db_connection()
-        # Verify the item belongs to the current user
-        item = conn.execute(
-            'SELECT * FROM cart_items WHERE id = ? AND user_id = ?',
-            (item_id, current_user.id)
-        ).fetchone()
-        
-        if item:
-            conn.execute('DELETE FROM cart_items WHERE id = ?', (item_id,))
-            conn.commit()
+        if Cart.remove_item(current_user.id, item_id):
             flash('Item removed from cart!', 'success')
         else:
             flash('Item not found in cart!', 'error')
-        
-        conn.close()
     except Exception as e:
         flash('Error removing item from cart. Please try again.', 'error')
     
@@ -218,44 +200,32 @@ def remove_from_cart(item_id):
 
 
 
-@app.route('/update_cart_quantity/<int:item_id>', methods=['POST'])
+@registry.route('/update_cart_quantity/<int:item_id>', methods=['POST'])
 @login_required
 def update_cart_quantity(item_id):
     quantity = int(request.form.get('quantity', 1))
     
-    if quantity <= 0:
-        return redirect(url_for('remove_from_cart', item_id=item_id))
-    
     try:
-        conn = get_db_connection()
-        # Verify the item belongs to the current user
-        item = conn.execute(
-            'SELECT * FROM cart_items WHERE id = ? AND user_id = ?',
-            (item_id, current_user.id)
-        ).fetchone()
+        if quantity <= 0:
+            updated = Cart.remove_item(current_user.id, item_id)
+        else:
+            updated = Cart.update_quantity(current_user.id, item_id, quantity)
         
-        if item:
-            conn.execute(
-                'UPDATE cart_items SET quantity = ? WHERE id = ?',
-                (quantity, item_id)
-            )
-            conn.commit()
+        if updated:
             flash('Cart updated!', 'success')
         else:
             flash('Item not found in cart!', 'error')
-        
-        conn.close()
     except Exception as e:
         flash('Error updating cart. Please try again.', 'error')
     
     return redirect(url_for('cart'))
 
-@app.route('/profile')
+@registry.route('/profile')
 @login_required
 def profile():
     return render_template('profile.html', orders=[])
 
-@app.route('/calculate_roof', methods=['POST'])
+@registry.route('/calculate_roof', methods=['POST'])
 def calculate_roof():
     try:
         print("DEBUG: calculate_roof endpoint called")
@@ -269,12 +239,7 @@ def calculate_roof():
         
         print(f"DEBUG: Processing - Length: {length}, Width: {width}, Roof Type: {roof_type}, Material: {material_type}")
         
-        # Check if roof_calculator is available
-        if 'roof_calculator' not in globals():
-            print("ERROR: roof_calculator not found in globals")
-            return jsonify({'error': 'Roof calculator not available'}), 500
-        
-        calculation = roof_calculator.calculate_materials(length, width, roof_type, material_type)
+        calculation = ml_models.roof_calculator.calculate_materials(length, width, roof_type, material_type)
         print(f"DEBUG: Calculation result: {calculation}")
         
         # Get recommended products
@@ -302,14 +267,14 @@ def calculate_roof():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 400
 
-@app.route('/chat', methods=['GET', 'POST'])
+@registry.route('/chat', methods=['GET', 'POST'])
 def chat():
     if request.method == 'POST':
         try:
             data = request.get_json()
             user_message = data.get('message', '')
             
-            response = chatbot.get_response(user_message)
+            response = ml_models.chatbot.get_response(user_message)
             
             return jsonify({'response': response})
         except Exception as e:
@@ -318,53 +283,26 @@ def chat():
     return render_template('chat.html')
 
 # Admin routes
-@app.route('/admin')
+@registry.route('/admin')
 @login_required
 def admin_dashboard():
     if not current_user.is_admin:
         flash('Access denied', 'error')
         return redirect(url_for('index'))
     
-    conn = get_db_connection()
-    total_users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-    total_products = conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
-    total_orders = conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
-    total_revenue = conn.execute('SELECT COALESCE(SUM(total), 0) FROM orders').fetchone()[0]
-    
-    # Get recent orders for dashboard
-    recent_orders_data = conn.execute('''
-        SELECT o.*, u.username 
-        FROM orders o
-        LEFT JOIN users u ON o.user_id = u.id
-        ORDER BY o.created_at DESC
-        LIMIT 5
-    ''').fetchall()
-    
-    conn.close()
-    
-    # Convert revenue to RWF (multiply by 1000)
-    total_revenue_rwf = (total_revenue or 0) * 1000
-    
-    recent_orders = []
-    for order in recent_orders_data:
-        recent_orders.append({
-            'id': order['id'],
-            'username': order['username'] or 'Unknown User',
-            'total': order['total'] * 1000,  # Convert to RWF
-            'status': order['status'],
-            'created_at': order['created_at']
-        })
+    force_refresh = request.args.get('refresh') == '1'
+    stats = get_dashboard_stats(force_refresh=force_refresh)
     
     return render_template('admin/dashboard.html',
-                         total_users=total_users,
-                         total_products=total_products,
-                         total_orders=total_orders,
-                         total_revenue=total_revenue_rwf,
-                         recent_orders=recent_orders,
-                         segments={},
-                         users={})
+                         total_users=stats['total_users'],
+                         total_products=stats['total_products'],
+                         total_orders=stats['total_orders'],
+                         total_revenue=stats['total_revenue'],
+                         recent_orders=stats['recent_orders'],
+                         stats_refreshed_at=stats['refreshed_at'],
+                         segments=ml_models.customer_segmentation.segment_counts())
 
-@app.route('/admin/users')
+@registry.route('/admin/users')
 @login_required
 def admin_users():
     if not current_user.is_admin:
@@ -375,16 +313,13 @@ def admin_users():
     users_data = conn.execute('SELECT * FROM users').fetchall()
     conn.close()
     
-    users = {}
-    for user_data in users_data:
-        users[user_data['id']] = User(
-            user_data['id'], user_data['username'], user_data['email'],
-            user_data['password_hash'], user_data['is_admin'], user_data['created_at']
-        )
+    users = {user_data['id']: User.from_row(user_data) for user_data in users_data}
+    
+    segments = ml_models.customer_segmentation.segment_customers()
     
-    return render_template('admin/users.html', users=users, segments={})
+    return render_template('admin/users.html', users=users, segments=segments)
 
-@app.route('/admin/products')
+@registry.route('/admin/products')
 @login_required
 def admin_products():
     if not current_user.is_admin:
@@ -394,7 +329,7 @@ def admin_products():
     products = Product.get_all()
     return render_template('admin/products.html', products=products)
 
-@app.route('/admin/products/add', methods=['GET', 'POST'])
+@registry.route('/admin/products/add', methods=['GET', 'POST'])
 @login_required
 def admin_add_product():
     if not current_user.is_admin:
@@ -418,6 +353,8 @@ def admin_add_product():
             product_id = cursor.lastrowid
             conn.commit()
             conn.close()
+            Product.invalidate_cache()
+            ml_models.refresh_product_recommender()
             
             flash('Product added successfully!', 'success')
             return redirect(url_for('admin_products'))
@@ -427,7 +364,7 @@ def admin_add_product():
     
     return render_template('admin/product_form.html', product=None, action='Add')
 
-@app.route('/admin/products/edit/<int:product_id>', methods=['GET', 'POST'])
+@registry.route('/admin/products/edit/<int:product_id>', methods=['GET', 'POST'])
 @login_required
 def admin_edit_product(product_id):
     if not current_user.is_admin:
@@ -456,6 +393,8 @@ def admin_edit_product(product_id):
             ''', (name, description, price, category, image_url, stock, product_id))
             conn.commit()
             conn.close()
+            Product.invalidate_cache()
+            ml_models.refresh_product_recommender()
             
             flash('Product updated successfully!', 'success')
             return redirect(url_for('admin_products'))
@@ -465,7 +404,7 @@ def admin_edit_product(product_id):
     
     return render_template('admin/product_form.html', product=product, action='Edit')
 
-@app.route('/admin/products/delete/<int:product_id>', methods=['POST'])
+@registry.route('/admin/products/delete/<int:product_id>', methods=['POST'])
 @login_required
 def admin_delete_product(product_id):
     if not current_user.is_admin:
@@ -482,6 +421,8 @@ def admin_delete_product(product_id):
         conn.execute('DELETE FROM products WHERE id = ?', (product_id,))
         conn.commit()
         conn.close()
+        Product.invalidate_cache()
+        ml_models.refresh_product_recommender()
         
         flash('Product deleted successfully!', 'success')
     except Exception as e:
@@ -489,64 +430,52 @@ def admin_delete_product(product_id):
     
     return redirect(url_for('admin_products'))
 
-@app.route('/admin/orders')
+@registry.route('/admin/orders')
 @login_required
 def admin_orders():
     if not current_user.is_admin:
         flash('Access denied', 'error')
         return redirect(url_for('index'))
     
+    filters = OrderFilters.from_args(request.args)
     try:
-        conn = get_db_connection()
-        
-        # Get all orders with user information
-        orders = conn.execute('''
-            SELECT o.*, u.username, u.email 
-            FROM orders o
-            LEFT JOIN users u ON o.user_id = u.id
-            ORDER BY o.created_at DESC
-        ''').fetchall()
-        
-        # Get all users for reference
-        users = conn.execute('SELECT id, username, email FROM users').fetchall()
-        conn.close()
-        
-        # Convert to list of dictionaries for template usage
-        orders_list = []
-        users_dict = {}
-        
-        print(f"DEBUG: Found {len(orders)} orders in database")
-        
-        for order in orders:
-            order_dict = {
-                'id': order['id'],
-                'user_id': order['user_id'],
-                'username': order['username'] or 'Unknown User',
-                'email': order['email'] or 'N/A',
-                'items': order['items'],
-                'total': order['total'] * 1000,  # Convert to RWF
-                'status': order['status'],
-                'shipping_address': '',  # Column doesn't exist in current schema
-                'payment_method': 'Unknown',  # Column doesn't exist in current schema
-                'created_at': order['created_at']
-            }
-            orders_list.append(order_dict)
-            print(f"DEBUG: Added order {order_dict}")
-        
-        for user in users:
-            users_dict[user['id']] = {
-                'username': user['username'],
-                'email': user['email']
-            }
-        
-        print(f"DEBUG: Passing {len(orders_list)} orders to template")
-        return render_template('admin/orders.html', orders=orders_list, users=users_dict)
-        
-    except Exception as e:
-        print(f"Error fetching orders: {e}")
-        return render_template('admin/orders.html', orders=[], users={})
+        orders, next_cursor = list_orders_page(filters.validate(), cursor=request.args.get('after'))
+    except ValueError as e:
+        flash(str(e), 'error')
+        filters, orders, next_cursor = OrderFilters(), [], None
+    except Exception:
+        logger.exception("Error fetching orders")
+        orders, next_cursor = [], None
+    
+    return stream_template('admin/orders.html',
+                         orders=orders,
+                         filters=filters,
+                         next_cursor=next_cursor,
+                         is_first_page='after' not in request.args)
+
+@registry.route('/admin/orders/export')
+@login_required
+def admin_orders_export():
+    """Stream matching orders as JSON lines"""
+    if not current_user.is_admin:
+        flash('Access denied', 'error')
+        return redirect(url_for('index'))
+    
+    # Validated up front: once streaming starts the 200 is already sent
+    try:
+        filters = OrderFilters.from_args(request.args).validate()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def generate():
+        for order in iter_orders(filters):
+            yield json.dumps(order) + '\n'
+    
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=orders.jsonl'})
 
-@app.route('/admin/orders/update/<int:order_id>', methods=['POST'])
+@registry.route('/admin/orders/update/<int:order_id>', methods=['POST'])
 @login_required
 def update_order_status(order_id):
     if not current_user.is_admin:
@@ -565,20 +494,33 @@ def update_order_status(order_id):
     
     return redirect(url_for('admin_orders'))
 
-@app.route('/admin/reports')
+@registry.route('/admin/db-stats')
+@login_required
+def admin_db_stats():
+    """Connection pool metrics for monitoring"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    return jsonify(get_pool_stats())
+
+@registry.route('/admin/reports')
 @login_required
 def admin_reports():
     if not current_user.is_admin:
         flash('Access denied', 'error')
         return redirect(url_for('index'))
     
+    period = request.args.get('period', 'month')
+    product_sales, products = product_sales_report()
+    
     return render_template('admin/reports.html',
-                         revenue_data={},
-                         product_sales={},
-                         sentiment_data={},
-                         products={})
+                         revenue_data=revenue_by_period(period),
+                         period=period,
+                         product_sales=product_sales,
+                         sentiment_data=sentiment_distribution(),
+                         products=products)
 
-@app.route('/add_review/<int:product_id>', methods=['POST'])
+@registry.route('/add_review/<int:product_id>', methods=['POST'])
 @login_required
 def add_review(product_id):
     product = Product.get(product_id)
@@ -591,20 +533,23 @@ def add_review(product_id):
     
     try:
         conn = get_db_connection()
-        conn.execute('''
+        cursor = conn.execute('''
             INSERT INTO reviews (user_id, product_id, rating, comment, created_at)
             VALUES (?, ?, ?, ?, datetime('now'))
         ''', (current_user.id, product_id, rating, comment))
         conn.commit()
         conn.close()
         
+        # Sentiment is scored in the background
+        review_sentiment_queue.submit(cursor.lastrowid)
+        
         flash('Review added successfully!', 'success')
     except Exception as e:
         flash('Error adding review. Please try again.', 'error')
     
     return redirect(url_for('product_detail', product_id=product_id))
 
-@app.route('/debug/cart')
+@registry.route('/debug/cart')
 @login_required
 def debug_cart():
     """Debug route to check cart contents"""
@@ -621,77 +566,94 @@ def debug_cart():
     except Exception as e:
         return jsonify({'error': str(e)})
 
-@app.route('/checkout')
+@registry.route('/checkout')
 @login_required
 def checkout():
     """Checkout page"""
     try:
-        conn = get_db_connection()
-        cart_items_data = conn.execute('''
-            SELECT ci.*, p.name, p.price, p.image_url 
-            FROM cart_items ci 
-            JOIN products p ON ci.product_id = p.id 
-            WHERE ci.user_id = ?
-        ''', (current_user.id,)).fetchall()
-        conn.close()
+        cart = Cart.load(current_user.id)
         
-        cart_items = []
-        total = 0
-        
-        for item in cart_items_data:
-            product = Product.get(item['product_id'])
-            if product:
-                cart_items.append({
-                    'id': item['id'],
-                    'product': product,
-                    'quantity': item['quantity'],
-                    'subtotal': product.price * item['quantity']
-                })
-                total += product.price * item['quantity']
-        
-        if not cart_items:
+        if not cart:
             flash('Your cart is empty', 'error')
             return redirect(url_for('cart'))
         
-        return render_template('checkout.html', cart_items=cart_items, total=total)
+        return render_template('checkout.html', cart_items=cart.items, total=cart.total)
     except Exception as e: 
         flash('Error loading checkout page', 'error')
         return redirect(url_for('cart'))
 
-@app.route('/api/cart/count')
+@registry.context_processor
+def inject_cart_count():
+    """Navbar cart badge, rendered into every page"""
+    if not current_user.is_authenticated:
+        return {'cart_count': 0}
+    return {'cart_count': Cart.count_items(current_user.id)}
+
+@registry.route('/api/cart/count')
 def cart_count():
-    """API endpoint to get cart count"""
+    """API endpoint to get cart count
+    
+    Responses carry an ETag of the cart version, so revalidating clients
+    get a 304 until the cart changes.
+    """
     try:
         if not current_user.is_authenticated:
-            return jsonify({'count': 0})
-            
-        conn = get_db_connection()
-        result = conn.execute('''
-            SELECT SUM(quantity) as total_items 
-            FROM cart_items 
-            WHERE user_id = ?
-        ''', (current_user.id,)).fetchone()
-        conn.close()
+            count, etag = 0, 'cart-anonymous'
+        else:
+            count, version = Cart.count_state(current_user.id)
+            etag = f'cart-{current_user.id}-{version}'
         
-        total_items = result['total_items'] if result['total_items'] else 0
-        return jsonify({'count': total_items})
+        response = jsonify({'count': count})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'count': 0})
 
-@app.route('/place_order', methods=['POST'])
+@registry.route('/api/cart/items', methods=['POST'])
+@login_required
+def bulk_add_to_cart():
+    """Add many items to the cart in one request.
+    
+    Expects JSON: {"items": [{"product_id": 1, "quantity": 2}, ...]}
+    """
+    data = request.get_json(silent=True) or {}
+    raw_items = data.get('items')
+    if not isinstance(raw_items, list) or not raw_items:
+        return jsonify({'error': 'items must be a non-empty list'}), 400
+    if len(raw_items) > MAX_BULK_CART_ITEMS:
+        return jsonify({'error': f'At most {MAX_BULK_CART_ITEMS} items per request'}), 400
+    
+    items = []
+    try:
+        for raw in raw_items:
+            product_id = int(raw['product_id'])
+            quantity = int(raw.get('quantity', 1))
+            if quantity <= 0:
+                raise ValueError('quantity must be positive')
+            items.append((product_id, quantity))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid item: {e}'}), 400
+    
+    try:
+        added = Cart.add_items(current_user.id, items)
+        return jsonify({
+            'success': True,
+            'added': added,
+            'skipped': len(items) - added,
+            'count': Cart.count_items(current_user.id)
+        })
+    except Exception as e:
+        return jsonify({'error': 'Error adding items to cart'}), 500
+
+@registry.route('/place_order', methods=['POST'])
 @login_required
 def place_order():
     """Process order and handle MTN Mobile Money payment"""
     try:
-        conn = get_db_connection()
-        cart_items_data = conn.execute('''
-            SELECT ci.*, p.name, p.price 
-            FROM cart_items ci 
-            JOIN products p ON ci.product_id = p.id 
-            WHERE ci.user_id = ?
-        ''', (current_user.id,)).fetchall()
+        cart = Cart.load(current_user.id)
         
-        if not cart_items_data:
+        if not cart:
             flash('Your cart is empty!', 'error')
             return redirect(url_for('cart'))
         
@@ -704,17 +666,8 @@ def place_order():
         payment_method = request.form.get('payment_method')
         
         # Calculate total and prepare items
-        cart_items = []
-        total = 0
-        for item in cart_items_data:
-            cart_items.append({
-                'product_id': item['product_id'],
-                'product_name': item['name'],
-                'quantity': item['quantity'],
-                'price': item['price'],
-                'subtotal': item['price'] * item['quantity']
-            })
-            total += item['price'] * item['quantity']
+        cart_items = cart.order_items()
+        total = cart.total
         
         if payment_method == 'mtn_mobile_money':
             # Store order data in session for MTN payment processing
@@ -736,12 +689,8 @@ def place_order():
             return render_template('payment/mtn_payment.html', total=total, phone=phone)
         else:
             # For other payment methods, complete order immediately
-            import json
-            order_items = json.dumps(cart_items)
-            conn.execute('''
-                INSERT INTO orders (user_id, items, total, status)
-                VALUES (?, ?, ?, ?)
-            ''', (current_user.id, order_items, total, 'completed'))
+            conn = get_db_connection()
+            Order.create(conn, current_user.id, cart_items, total, 'completed')
             
             # Clear cart
             conn.execute('DELETE FROM cart_items WHERE user_id = ?', (current_user.id,))
@@ -755,10 +704,10 @@ def place_order():
         flash(f'Error processing order: {str(e)}', 'error')
         return redirect(url_for('checkout'))
 
-@app.route('/process_mtn_payment', methods=['POST'])
+@registry.route('/process_mtn_payment', methods=['POST'])
 @login_required 
 def process_mtn_payment():
-    """Simulate MTN Mobile Money payment processing"""
+    """Start an MTN Mobile Money payment; it is settled in the background"""
     try:
         from flask import session
         pending_order = session.get('pending_order')
@@ -767,31 +716,42 @@ def process_mtn_payment():
             flash('No pending order found', 'error')
             return redirect(url_for('checkout'))
         
-        # Simulate payment processing delay
-        import time
-        time.sleep(1)
-        
-        # Create the order
-        import json
-        order_items = json.dumps(pending_order['items'])
-        conn = get_db_connection()
-        conn.execute('''
-            INSERT INTO orders (user_id, items, total, status)
-            VALUES (?, ?, ?, ?)
-        ''', (pending_order['user_id'], order_items, pending_order['total'], 'completed'))
-        
-        # Clear cart
-        conn.execute('DELETE FROM cart_items WHERE user_id = ?', (current_user.id,))
-        conn.commit()
-        conn.close()
+        # Records the order as pending and returns without waiting on the provider
+        payment_id = payment_processor.start_checkout(
+            current_user.id,
+            pending_order['items'],
+            pending_order['total'],
+            pending_order['shipping_info'].get('phone')
+        )
         
         # Clear session
         session.pop('pending_order', None)
         
-        flash('MTN Mobile Money payment successful! Your order has been placed.', 'success')
-        return redirect(url_for('profile'))
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({
+                'payment_id': payment_id,
+                'status_url': url_for('payment_status_api', payment_id=payment_id)
+            }), 202
+        return redirect(url_for('payment_status', payment_id=payment_id))
         
     except Exception as e:
         flash(f'Payment failed: {str(e)}', 'error')
-        return redirect(url_for('checkout')) 
-        return redirect(url_for('cart')) 
+        return redirect(url_for('checkout'))
+
+@registry.route('/payment/<int:payment_id>')
+@login_required
+def payment_status(payment_id):
+    """Waiting page that polls the payment until it settles"""
+    payment = payment_processor.get_status(payment_id, current_user.id)
+    if payment is None:
+        flash('Payment not found', 'error')
+        return redirect(url_for('profile'))
+    return render_template('payment/status.html', payment=payment)
+
+@registry.route('/api/payments/<int:payment_id>')
+@login_required
+def payment_status_api(payment_id):
+    payment = payment_processor.get_status(payment_id, current_user.id)
+    if payment is None:
+        return jsonify({'error': 'Payment not found'}), 404
+    return jsonify(payment)
@@ -0,0 +1,180 @@
+"""
+Batch sentiment scoring for reviews
+Reviews are scored after they are inserted, on a background thread that
+drains a queue in chunks, so add_review never waits on VADER. Scores are
+cached by text hash, and large batches (see backfills.py) fan chunks out to
+a pool of forked processes that share the parent's already-loaded lexicon.
+"""
+import os
+import queue
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from database import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+SENTIMENT_CHUNK_SIZE = int(os.environ.get('SMARTROOF_SENTIMENT_CHUNK', 256))
+SENTIMENT_CACHE_SIZE = int(os.environ.get('SMARTROOF_SENTIMENT_CACHE', 10000))
+
+Score = Tuple[str, float]
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+def _score_chunk(texts: List[str]) -> List[Score]:
+    # Runs in forked workers too, where the analyzer built by the parent is
+    # inherited rather than rebuilt
+    import ml_models
+    return ml_models.sentiment_analyzer.analyze_many(texts)
+
+def process_pool(processes: int) -> Optional[ProcessPoolExecutor]:
+    """A pool of forked scoring workers, or None when processes <= 1.
+
+    Open one for a whole run and pass it to score_reviews, so workers are
+    forked once rather than per batch; the caller shuts it down.
+    """
+    if processes <= 1:
+        return None
+    # Load the lexicon before forking so every worker shares it
+    import ml_models
+    ml_models.sentiment_analyzer
+    context = multiprocessing.get_context('fork')
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+class SentimentScorer:
+    """Scores texts in chunks with a bounded LRU cache keyed by text hash"""
+
+    def __init__(self, cache_size: int = SENTIMENT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[bytes, Score]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, key: bytes) -> Optional[Score]:
+        with self._lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            return score
+
+    def _remember(self, key: bytes, score: Score):
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = score
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def score(self, texts: List[str], pool: Optional[ProcessPoolExecutor] = None) -> List[Score]:
+        """(label, compound) for each text, in order.
+
+        Duplicate and previously seen texts are scored once. Given a pool
+        (see process_pool) and more than one chunk, chunks run in its workers.
+        """
+        keys = [_text_key(text or '') for text in texts]
+        results: Dict[bytes, Score] = {}
+        pending: Dict[bytes, str] = {}
+        for key, text in zip(keys, texts):
+            if key in results or key in pending:
+                continue
+            cached = self._cached(key)
+            if cached is not None:
+                results[key] = cached
+            else:
+                pending[key] = text or ''
+
+        if pending:
+            pending_keys = list(pending)
+            pending_texts = list(pending.values())
+            chunks = [pending_texts[i:i + SENTIMENT_CHUNK_SIZE]
+                      for i in range(0, len(pending_texts), SENTIMENT_CHUNK_SIZE)]
+            if pool is not None and len(chunks) > 1:
+                scored = [score for chunk in pool.map(_score_chunk, chunks) for score in chunk]
+            else:
+                scored = [score for chunk in chunks for score in _score_chunk(chunk)]
+            for key, score in zip(pending_keys, scored):
+                results[key] = score
+                self._remember(key, score)
+
+        return [results[key] for key in keys]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
+
+scorer = SentimentScorer()
+
+def score_reviews(review_ids: Iterable[int], pool: Optional[ProcessPoolExecutor] = None) -> int:
+    """Score the given reviews and store their sentiment labels; returns the
+    number of reviews updated"""
+    review_ids = list(review_ids)
+    if not review_ids:
+        return 0
+    conn = get_db_connection()
+    try:
+        placeholders = ','.join('?' * len(review_ids))
+        rows = conn.execute(
+            f'SELECT id, comment FROM reviews WHERE id IN ({placeholders})', review_ids
+        ).fetchall()
+        scores = scorer.score([row['comment'] or '' for row in rows], pool=pool)
+        conn.executemany('UPDATE reviews SET sentiment = ? WHERE id = ?',
+                         [(label, row['id']) for row, (label, _) in zip(rows, scores)])
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+class ReviewSentimentQueue:
+    """Background thread scoring newly inserted reviews in chunks"""
+
+    def __init__(self, chunk_size: int = SENTIMENT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        # One thread per process, started on first use (threads do not survive fork)
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(
+                    target=self._run, name='review-sentiment', daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, review_id: int):
+        """Queue a review for scoring; returns immediately"""
+        self._ensure_worker()
+        self._queue.put(review_id)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.chunk_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                score_reviews(batch)
+            except Exception:
+                logger.exception(f"Scoring reviews {batch} failed")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def join(self):
+        """Block until every queued review has been scored (tests, shutdown)"""
+        if self._queue is not None:
+            self._queue.join()
+
+review_sentiment_queue = ReviewSentimentQueue()
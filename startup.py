@@ -0,0 +1,75 @@
+"""
+Startup timing for the app factory
+create_app() runs each initialization step inside StartupTimer.stage(), which
+records wall time and how many modules the step imported, and logs a report
+against SMARTROOF_STARTUP_BUDGET_MS.
+
+    python startup.py  -- build the app, serve / once, print the report and
+                          exit 1 if a heavy ML/AI dependency was imported
+"""
+import os
+import sys
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+STARTUP_BUDGET_MS = float(os.environ.get('SMARTROOF_STARTUP_BUDGET_MS', 1500))
+
+# Must only load on first use of an ML/AI feature, never to serve a page
+HEAVY_MODULES = ('sklearn', 'chromadb', 'openai')
+
+class StartupTimer:
+    """Per-stage wall time and import counts for application startup"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings: Dict[str, Dict] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        modules_before = len(sys.modules)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = {
+                'ms': round((time.perf_counter() - started) * 1000, 1),
+                'imported_modules': len(sys.modules) - modules_before,
+            }
+
+    @property
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def report(self, budget_ms: float = STARTUP_BUDGET_MS) -> str:
+        """Log one line per stage; warns when the total exceeds the budget"""
+        total = self.total_ms
+        stages = ', '.join(
+            f"{name} {t['ms']}ms ({t['imported_modules']} modules)"
+            for name, t in self.timings.items()
+        )
+        line = f"Startup {total}ms of {budget_ms:.0f}ms budget: {stages}"
+        if total > budget_ms:
+            logger.warning(line)
+        else:
+            logger.info(line)
+        return line
+
+def loaded_heavy_modules():
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger().setLevel(logging.INFO)
+    from app import create_app
+    app = create_app()
+    for name, timing in app.config['STARTUP_TIMINGS'].items():
+        print(f"{name:<12} {timing['ms']:>8.1f} ms  {timing['imported_modules']:>4} modules")
+
+    response = app.test_client().get('/')
+    loaded = loaded_heavy_modules()
+    print(f"GET / -> {response.status_code}; heavy modules loaded: {', '.join(loaded) or 'none'}")
+    sys.exit(1 if loaded or response.status_code != 200 else 0)
@@ -23,18 +23,10 @@ document.addEventListener('DOMContentLoaded', function() {
         
         try {
             const formData = new FormData(form);
-            const response = await fetch('/ai-calculate', {
-                method: 'POST',
-                body: formData
-            });
-            
-            const data = await response.json();
-            
-            if (data.success) {
-                displayResults(data);
-                currentCalculationId = data.calculation_id;
+            if (window.ReadableStream && window.TextDecoder) {
+                await calculateStreaming(formData);
             } else {
-                showError(data.error || 'Calculation failed');
+                await calculateOnce(formData);
             }
             
         } catch (error) {
@@ -48,8 +40,100 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
     
-    // Display calculation results
-    function displayResults(data) {
+    // One request, one response
+    async function calculateOnce(formData) {
+        const response = await fetch('/ai-calculate', {
+            method: 'POST',
+            body: formData
+        });
+        
+        const data = await response.json();
+        
+        if (data.success) {
+            displayResults(data);
+            currentCalculationId = data.calculation_id;
+        } else {
+            showError(data.error || 'Calculation failed');
+        }
+    }
+    
+    // Server-sent events: the ML estimate first, then the AI refinement
+    async function calculateStreaming(formData) {
+        const response = await fetch('/ai-calculate/stream', {
+            method: 'POST',
+            body: formData
+        });
+        
+        if (!response.ok || !response.body) {
+            const data = await response.json().catch(() => ({}));
+            showError(data.error || 'Calculation failed');
+            return;
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const frame = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                
+                let event = 'message';
+                let data = '';
+                frame.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                handleStreamEvent(event, data ? JSON.parse(data) : {});
+            }
+        }
+    }
+    
+    function handleStreamEvent(event, data) {
+        switch (event) {
+            case 'ml':
+                // Provisional estimate while the AI answer is written
+                displayResults(data, true);
+                break;
+            case 'knowledge': {
+                const list = document.getElementById('ai-knowledge');
+                if (list) {
+                    list.innerHTML = data.map(item =>
+                        `<li class="list-group-item small text-muted">${item.content}</li>`
+                    ).join('');
+                }
+                break;
+            }
+            case 'token': {
+                const output = document.getElementById('ai-stream-output');
+                if (output) {
+                    output.classList.remove('d-none');
+                    output.textContent += data.text;
+                }
+                break;
+            }
+            case 'warning':
+                showToast(data.message, 'warning');
+                break;
+            case 'result':
+                displayResults(data);
+                currentCalculationId = data.calculation_id;
+                break;
+            case 'error':
+                showError(data.error || 'Calculation failed');
+                break;
+        }
+    }
+    
+    // Display calculation results; provisional results leave room for the
+    // streamed AI refinement
+    function displayResults(data, provisional = false) {
         const area = data.area;
         const materials = data.materials;
         const costs = data.formatted_costs;
@@ -120,9 +204,15 @@ document.addEventListener('DOMContentLoaded', function() {
                         </div>
                     </div>
                     
+                    ${provisional ? `
+                    <div class="mt-3 text-start">
+                        <small class="text-muted"><span class="loading"></span> Refining with AI...</small>
+                        <ul id="ai-knowledge" class="list-group list-group-flush mt-2"></ul>
+                        <pre id="ai-stream-output" class="d-none small bg-light p-2 mt-2 text-wrap"></pre>
+                    </div>` : `
                     <button class="btn btn-outline-primary btn-sm mt-3" onclick="openFeedbackModal()">
                         <i data-feather="message-circle"></i> Give Feedback
-                    </button>
+                    </button>`}
                 </div>
             </div>
         `;
@@ -130,7 +220,9 @@ document.addEventListener('DOMContentLoaded', function() {
         feather.replace();
         
         // Show success toast
-        showToast('Calculation completed successfully!', 'success');
+        if (!provisional) {
+            showToast('Calculation completed successfully!', 'success');
+        }
     }
     
     // Show error message
@@ -195,33 +195,67 @@ function addToCartAnimation(button) {
     }, 2000);
 }
 
-// Update cart count
-function updateCartCount() {
+// Update cart count; pass the count when a response already carries it.
+// The badge is rendered server-side, so this only runs after cart changes.
+function updateCartCount(count) {
+    if (typeof count === 'number') {
+        setCartBadge(count);
+        return;
+    }
+    // The endpoint sends an ETag, so an unchanged cart revalidates with a 304
     fetch('/api/cart/count')
         .then(response => response.json())
-        .then(data => {
-            const cartBadge = document.querySelector('.cart-count');
-            if (cartBadge) {
-                if (data.count > 0) {
-                    cartBadge.textContent = data.count;
-                    cartBadge.style.display = 'inline';
-                } else {
-                    cartBadge.style.display = 'none';
-                }
-            }
-        })
+        .then(data => setCartBadge(data.count))
         .catch(error => console.error('Error updating cart count:', error));
 }
 
-// Initialize cart count when page loads
-document.addEventListener('DOMContentLoaded', function() {
-    updateCartCount();
-});
+function setCartBadge(count) {
+    const cartBadge = document.querySelector('.cart-count');
+    if (cartBadge) {
+        if (count > 0) {
+            cartBadge.textContent = count;
+            cartBadge.style.display = 'inline';
+        } else {
+            cartBadge.style.display = 'none';
+        }
+    }
+}
+
+// Search-as-you-type suggestions on the products page
+function initSearchAutocomplete() {
+    const input = document.getElementById('search');
+    const list = document.getElementById('search-suggestions');
+    if (!input || !list) {
+        return;
+    }
+    
+    input.addEventListener('input', debounce(function() {
+        const query = input.value.trim();
+        if (query.length < 2) {
+            list.innerHTML = '';
+            return;
+        }
+        fetch(`/api/products/autocomplete?q=${encodeURIComponent(query)}`)
+            .then(response => response.json())
+            .then(data => {
+                list.innerHTML = '';
+                data.suggestions.forEach(suggestion => {
+                    const option = document.createElement('option');
+                    option.value = suggestion.name;
+                    list.appendChild(option);
+                });
+            })
+            .catch(error => console.error('Error loading suggestions:', error));
+    }, 200));
+}
+
+document.addEventListener('DOMContentLoaded', initSearchAutocomplete);
 
 // Export functions for use in other files
 window.SmartRoof = {
     showToast,
     formatCurrency,
     debounce,
-    addToCartAnimation
+    addToCartAnimation,
+    updateCartCount
 };
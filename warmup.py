@@ -0,0 +1,87 @@
+"""
+Pre-fork model warmup and per-process memory measurement
+With gunicorn preload_app the master imports the app, calls warm_models()
+and freezes the heap (see gunicorn.conf.py), so every worker shares the
+read-only model state copy-on-write instead of building its own copy.
+
+    python warmup.py  -- warm the models once and print memory before/after
+"""
+import gc
+import os
+import time
+import logging
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+def memory_usage() -> Dict[str, int]:
+    """RSS, PSS and shared/private memory of this process in kB (Linux).
+
+    RSS counts shared copy-on-write pages in every worker; PSS splits them
+    between the processes sharing them, so PSS is what shows the savings.
+    """
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    usage[parts[0].rstrip(':')] = int(parts[1])
+    except OSError:
+        import resource
+        return {'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    return {
+        'rss_kb': usage.get('Rss', 0),
+        'pss_kb': usage.get('Pss', 0),
+        'shared_kb': usage.get('Shared_Clean', 0) + usage.get('Shared_Dirty', 0),
+        'private_kb': usage.get('Private_Clean', 0) + usage.get('Private_Dirty', 0),
+    }
+
+def format_memory(usage: Dict[str, int]) -> str:
+    return ' '.join(f"{key[:-3]}={value / 1024:.1f}MB" for key, value in usage.items())
+
+def warm_models() -> Dict[str, float]:
+    """Build every read-only model singleton; returns seconds per model.
+
+    Only state that is safe to share across fork() is built here: no
+    database, HTTP or vector store handles are left open.
+    """
+    import ml_models
+    from ai_roof_calculator import get_ai_calculator
+
+    steps = (
+        ('sentiment_analyzer', lambda: ml_models.sentiment_analyzer),
+        ('product_recommender', ml_models.refresh_product_recommender),
+        ('customer_segmentation', lambda: ml_models.customer_segmentation),
+        ('roof_calculator', lambda: ml_models.roof_calculator),
+        ('chatbot', lambda: ml_models.chatbot),
+        ('ai_calculator', get_ai_calculator),
+    )
+    timings = {}
+    for name, build in steps:
+        started = time.perf_counter()
+        try:
+            build()
+        except Exception as e:
+            logger.error(f"Warmup of {name} failed: {e}")
+        timings[name] = round(time.perf_counter() - started, 3)
+    return timings
+
+def freeze_heap():
+    """Move every live object to the permanent generation so the garbage
+    collector never writes to (and so un-shares) the preloaded pages"""
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    from main import app  # noqa: F401
+    before = memory_usage()
+    timings = warm_models()
+    frozen = freeze_heap()
+    after = memory_usage()
+    print(f"warmup seconds: {timings}")
+    print(f"frozen objects: {frozen}")
+    print(f"pid {os.getpid()} before: {format_memory(before)}")
+    print(f"pid {os.getpid()} after:  {format_memory(after)}")